@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from session_store import SessionStore
+
+
+@dataclass
+class FanOutResult:
+    key: str
+    account: str
+    ok: bool
+    elapsed: float
+    result: object = None
+    error: Exception | None = None
+
+
+class Account:
+    """1 アカウント分のセッションファイルと Client（初回利用時に生成）"""
+
+    def __init__(self, store: SessionStore, client_factory, min_upload_interval: float):
+        self.store = store
+        self.client_factory = client_factory
+        self.min_upload_interval = min_upload_interval
+        self.valid: bool | None = None
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._upload_lock = threading.Lock()
+        self._last_upload: float | None = None
+
+    @property
+    def key(self) -> str:
+        return str(self.store.session_path)
+
+    @property
+    def username(self) -> str:
+        info = self.store.load_info()
+        return info["username"] if info else self.store.session_path.stem
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                client = self.client_factory()
+                if self.store.has_session():
+                    try:
+                        session = client.load_settings(self.store.session_path)
+                        if session:
+                            client.set_settings(session)
+                    except Exception as e:
+                        logging.getLogger().info(f"Couldn't login using session: {e}")
+                self._client = client
+            return self._client
+
+    def adopt(self, client, username: str):
+        """ログイン済みの Client を引き取り、セッションを保存する"""
+        with self._client_lock:
+            self._client = client
+        client.dump_settings(self.store.session_path)
+        self.store.save_info(username)
+        self.valid = True
+
+    def run_upload(self, fn):
+        """アカウントごとに直列化し、前回のアップロードから min_upload_interval 秒空けて fn(client) を実行"""
+        with self._upload_lock:
+            if self._last_upload is not None:
+                wait = self._last_upload + self.min_upload_interval - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                return fn(self.client)
+            finally:
+                self._last_upload = time.monotonic()
+
+
+class AccountPool:
+    """複数アカウントのセッションと Client を管理し、同じストーリーを並列に投稿する
+
+    従来の session.json はそのまま 1 アカウントとして扱い、追加のアカウントは
+    sessions/<ユーザー名>.json に保存する。
+    """
+
+    def __init__(
+        self,
+        client_factory,
+        directory=Path("sessions"),
+        legacy_session=Path("session.json"),
+        ttl: float = 6 * 3600,
+        min_upload_interval: float = 30.0,
+    ):
+        self.client_factory = client_factory
+        self.directory = Path(directory)
+        self.legacy_session = Path(legacy_session)
+        self.ttl = ttl
+        self.min_upload_interval = min_upload_interval
+        self._accounts: dict[str, Account] = {}
+        self._lock = threading.Lock()
+
+    def _account_for(self, session_path: Path) -> Account:
+        key = str(session_path)
+        with self._lock:
+            account = self._accounts.get(key)
+            if account is None:
+                account = Account(SessionStore(session_path, ttl=self.ttl), self.client_factory, self.min_upload_interval)
+                self._accounts[key] = account
+            return account
+
+    def load(self) -> list[Account]:
+        """保存済みのセッションファイルを探して登録する"""
+        paths = []
+        if self.legacy_session.exists():
+            paths.append(self.legacy_session)
+        if self.directory.is_dir():
+            paths.extend(
+                path for path in sorted(self.directory.glob("*.json"))
+                if not path.name.endswith(".info.json")
+            )
+        for path in paths:
+            self._account_for(path)
+        return self.accounts()
+
+    def accounts(self) -> list[Account]:
+        with self._lock:
+            return list(self._accounts.values())
+
+    def get(self, key: str) -> Account | None:
+        with self._lock:
+            return self._accounts.get(key)
+
+    def find(self, username: str) -> Account | None:
+        for account in self.accounts():
+            if account.username == username:
+                return account
+        return None
+
+    def add(self, client, username: str) -> Account:
+        """ログインに成功した Client を登録（同じユーザーなら既存のセッションファイルを上書き）"""
+        account = self.find(username)
+        if account is None:
+            if not self.accounts():
+                # 最初の 1 アカウントは従来どおり session.json に保存する
+                path = self.legacy_session
+            else:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                path = self.directory / f"{username}.json"
+            account = self._account_for(path)
+        account.adopt(client, username)
+        return account
+
+    def pacing_stats(self) -> dict[str, dict]:
+        """Client を作成済みのアカウントごとの API ペース配分の状態（ユーザー名 -> 種類 -> 統計）"""
+        stats = {}
+        for account in self.accounts():
+            pacer = getattr(account._client, "pacer", None)
+            if pacer is not None:
+                stats[account.username] = pacer.stats()
+        return stats
+
+    def remove(self, key: str):
+        with self._lock:
+            account = self._accounts.pop(key, None)
+        if account is not None:
+            account.store.clear()
+
+    def fan_out(self, keys: list[str], fn, max_workers: int | None = None, *,
+                with_account: bool = False) -> list[FanOutResult]:
+        """fn(client) を選択したアカウントで並列に実行し、アカウントごとの結果を返す
+
+        with_account=True なら fn(client, account) で呼ぶ。
+        """
+        accounts = [account for key in keys if (account := self.get(key)) is not None]
+
+        def run(account: Account) -> FanOutResult:
+            started = time.perf_counter()
+            try:
+                result = account.run_upload(
+                    (lambda client: fn(client, account)) if with_account else fn
+                )
+                return FanOutResult(account.key, account.username, True, time.perf_counter() - started, result=result)
+            except Exception as e:
+                return FanOutResult(account.key, account.username, False, time.perf_counter() - started, error=e)
+
+        if not accounts:
+            return []
+        with ThreadPoolExecutor(max_workers=max_workers or len(accounts)) as pool:
+            return list(pool.map(run, accounts))
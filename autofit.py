@@ -0,0 +1,261 @@
+import logging
+from dataclasses import asdict, dataclass
+
+logger = logging.getLogger(__name__)
+
+# OpenCV / NumPy は合成するときに読み込む（FitPlan と Link の座標変換だけなら不要。GUI の起動を遅らせない）
+
+# 縦横比が合わない素材をストーリーのキャンバスに合わせる方法
+CROP = "crop"  # 拡大して中央を切り抜く（余白なし）
+LETTERBOX = "letterbox"  # 全体が収まるように縮め、余白を単色で埋める
+BLUR = "blur"  # 全体が収まるように縮め、余白を素材をぼかした背景で埋める
+FIT_MODES = (CROP, LETTERBOX, BLUR)
+
+# 縦横比の差がこの割合以内なら合わせ済みとみなす（probe.STORY_ASPECT_TOLERANCE と同じ）
+ASPECT_TOLERANCE = 0.01
+
+# ぼかし背景はキャンバスの 1/8 の解像度で作ってから拡大する（ぼかすので拡大しても見た目は変わらない）
+BLUR_DOWNSCALE = 8
+# 縮小後の解像度でのぼかしの強さ（σ）と、前景を目立たせるための背景の明るさ
+BLUR_SIGMA = 4.0
+BLUR_DIM = 0.7
+
+
+@dataclass(frozen=True)
+class FitPlan:
+    """素材 (src_size) をキャンバス (canvas_size) に合わせるときの大きさと配置
+
+    scaled_size に縮めた（広げた）素材全体の左上が offset に来る（CROP では負になり、はみ出た部分は切り落とす）。
+    Link の位置は素材に対する正規化座標なので、map_geom でキャンバスに対する座標に直す。
+    """
+
+    mode: str
+    src_size: tuple[int, int]
+    canvas_size: tuple[int, int]
+    scaled_size: tuple[int, int]
+    offset: tuple[int, int]
+
+    @classmethod
+    def plan(cls, src_size: tuple[int, int], mode: str = LETTERBOX, canvas_size: tuple[int, int] = (1080, 1920)):
+        if mode not in FIT_MODES:
+            raise ValueError(f"未対応の合わせ方です: {mode}")
+        src_w, src_h = src_size
+        canvas_w, canvas_h = canvas_size
+        if src_w <= 0 or src_h <= 0:
+            raise ValueError(f"素材のサイズが不正です: {src_w}x{src_h}")
+        scales = (canvas_w / src_w, canvas_h / src_h)
+        scale = max(scales) if mode == CROP else min(scales)
+        scaled_w = max(1, round(src_w * scale))
+        scaled_h = max(1, round(src_h * scale))
+        # 丸めで 1px 足りない・はみ出る場合はキャンバスに揃える
+        if abs(scaled_w - canvas_w) <= 1:
+            scaled_w = canvas_w
+        if abs(scaled_h - canvas_h) <= 1:
+            scaled_h = canvas_h
+        offset = ((canvas_w - scaled_w) // 2, (canvas_h - scaled_h) // 2)
+        return cls(mode, (src_w, src_h), (canvas_w, canvas_h), (scaled_w, scaled_h), offset)
+
+    @property
+    def fits(self) -> bool:
+        """素材の縦横比がキャンバスとほぼ同じ（縮めるだけで済み、Link の位置も変わらない）"""
+        src_w, src_h = self.src_size
+        canvas_w, canvas_h = self.canvas_size
+        aspect = canvas_w / canvas_h
+        return abs(src_w / src_h - aspect) <= aspect * ASPECT_TOLERANCE
+
+    @property
+    def canvas_box(self) -> tuple[int, int, int, int]:
+        """素材が見えている範囲（キャンバスのピクセル座標、左・上・右・下）"""
+        scaled_w, scaled_h = self.scaled_size
+        x0, y0 = self.offset
+        canvas_w, canvas_h = self.canvas_size
+        return max(0, x0), max(0, y0), min(canvas_w, x0 + scaled_w), min(canvas_h, y0 + scaled_h)
+
+    @property
+    def source_box(self) -> tuple[int, int, int, int]:
+        """canvas_box に写る素材の範囲（素材のピクセル座標）"""
+        x0, y0, x1, y1 = self.canvas_box
+        scaled_w, scaled_h = self.scaled_size
+        src_w, src_h = self.src_size
+        sx = src_w / scaled_w
+        sy = src_h / scaled_h
+        left = x0 - self.offset[0]
+        top = y0 - self.offset[1]
+        return (
+            max(0, round(left * sx)), max(0, round(top * sy)),
+            min(src_w, round((left + x1 - x0) * sx)), min(src_h, round((top + y1 - y0) * sy)),
+        )
+
+    def map_geom(self, geom) -> tuple[float, float, float, float] | None:
+        """素材に対する正規化座標 (中心x, 中心y, 幅, 高さ) をキャンバスに対する座標に直す
+
+        キャンバスからはみ出した部分は切り詰め、全部はみ出すなら None。
+        """
+        x, y, w, h = (float(v) for v in geom)
+        if self.fits:
+            return x, y, w, h
+        scaled_w, scaled_h = self.scaled_size
+        canvas_w, canvas_h = self.canvas_size
+        left = (self.offset[0] + (x - w / 2) * scaled_w) / canvas_w
+        right = (self.offset[0] + (x + w / 2) * scaled_w) / canvas_w
+        top = (self.offset[1] + (y - h / 2) * scaled_h) / canvas_h
+        bottom = (self.offset[1] + (y + h / 2) * scaled_h) / canvas_h
+        left, right = max(0.0, left), min(1.0, right)
+        top, bottom = max(0.0, top), min(1.0, bottom)
+        if right <= left or bottom <= top:
+            return None
+        return (left + right) / 2, (top + bottom) / 2, right - left, bottom - top
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FitPlan":
+        return cls(data["mode"], tuple(data["src_size"]), tuple(data["canvas_size"]), tuple(data["scaled_size"]),
+                   tuple(data["offset"]))
+
+
+def map_overlays(overlays: list[dict], plan: FitPlan | None) -> tuple[list[dict], list[dict]]:
+    """合成用の {icon_path, geom} の位置をキャンバスに対する座標に直す
+
+    (直したもの, キャンバスの外に出て省いたもの) を返す。
+    """
+    if plan is None or plan.fits:
+        return overlays, []
+    mapped, dropped = [], []
+    for item in overlays:
+        geom = plan.map_geom(item["geom"]) if item.get("geom") else None
+        if geom is None:
+            logger.warning(f"Link がキャンバスの外に出るためアイコンを省きます: {item.get('icon_path')}")
+            dropped.append(item)
+            continue
+        mapped.append({**item, "geom": geom})
+    return mapped, dropped
+
+
+def map_links(links: list[dict], plan: FitPlan | None) -> tuple[list[dict], list[dict]]:
+    """Link の指定 {url, x, y, w, h, ...} の位置をキャンバスに対する座標に直す
+
+    (直したもの, キャンバスの外に出て省いたもの) を返す。省いたものは呼び出し側でジョブの結果に出す。
+    """
+    if plan is None or plan.fits:
+        return links, []
+    mapped, dropped = [], []
+    for link in links:
+        geom = plan.map_geom((link["x"], link["y"], link["w"], link["h"]))
+        if geom is None:
+            logger.warning(f"Link がキャンバスの外に出るため省きます: {link.get('url')}")
+            dropped.append(link)
+            continue
+        mapped.append({**link, **dict(zip(("x", "y", "w", "h"), geom))})
+    return mapped, dropped
+
+
+def _resize(src, size: tuple[int, int], dst=None):
+    """cv2.resize。1/2 以下への縮小は 1/2 ずつの面積平均で近づけてから双線形で仕上げる
+
+    INTER_AREA はちょうど 1/2 のときだけ速く、それ以外の倍率では 1080p で 1 フレーム 20ms 近くかかる。
+    1/2 より大きい倍率の双線形はすべての画素を参照するのでモアレは出ない。
+    """
+    import cv2
+
+    height, width = src.shape[:2]
+    while width >= 2 * size[0] and height >= 2 * size[1]:
+        width, height = width // 2, height // 2
+        if (width, height) == tuple(size):
+            return cv2.resize(src, size, dst=dst, interpolation=cv2.INTER_AREA)
+        src = cv2.resize(src, (width, height), interpolation=cv2.INTER_AREA)
+    return cv2.resize(src, size, dst=dst, interpolation=cv2.INTER_LINEAR)
+
+
+def _blurred_background(content, plan: FitPlan, out):
+    """content（キャンバスに収めた素材）からぼかし背景を作って out（キャンバス全体）に書く
+
+    素材の中央をキャンバスの縦横比で切り出し、1/BLUR_DOWNSCALE の解像度でぼかしてから拡大する。
+    """
+    import cv2
+
+    height, width = content.shape[:2]
+    canvas_w, canvas_h = plan.canvas_size
+    aspect = canvas_w / canvas_h
+    if width / height > aspect:
+        crop_w = max(1, round(height * aspect))
+        x0 = (width - crop_w) // 2
+        region = content[:, x0:x0 + crop_w]
+    else:
+        crop_h = max(1, round(width / aspect))
+        y0 = (height - crop_h) // 2
+        region = content[y0:y0 + crop_h]
+    small_size = (max(1, canvas_w // BLUR_DOWNSCALE), max(1, canvas_h // BLUR_DOWNSCALE))
+    small = _resize(region, small_size)
+    small = cv2.GaussianBlur(small, (0, 0), BLUR_SIGMA)
+    if BLUR_DIM != 1.0:
+        small = cv2.convertScaleAbs(small, alpha=BLUR_DIM)
+    cv2.resize(small, plan.canvas_size, dst=out, interpolation=cv2.INTER_LINEAR)
+
+
+def _place(canvas, content, plan: FitPlan, background):
+    """見えている範囲の素材を置き、余白を埋める。content は canvas_box の大きさ"""
+    x0, y0, x1, y1 = plan.canvas_box
+    if plan.mode == BLUR and content.shape[:2] != canvas.shape[:2]:
+        _blurred_background(content, plan, canvas)
+    elif plan.mode == LETTERBOX and background is not None:
+        canvas[...] = background
+    canvas[y0:y1, x0:x1] = content
+    return canvas
+
+
+def compose(scaled, plan: FitPlan, background=(0, 0, 0), out=None):
+    """plan.scaled_size に縮めた素材全体（H×W×3 の ndarray）をキャンバスに配置する（写真用）"""
+    import numpy as np
+
+    canvas_w, canvas_h = plan.canvas_size
+    if out is None:
+        out = np.empty((canvas_h, canvas_w, scaled.shape[2]), dtype=scaled.dtype)
+    x0, y0, x1, y1 = plan.canvas_box
+    left, top = x0 - plan.offset[0], y0 - plan.offset[1]
+    return _place(out, scaled[top:top + y1 - y0, left:left + x1 - x0], plan, background)
+
+
+class FrameFitter:
+    """動画のフレームを 1 枚ずつキャンバスに合わせる
+
+    見える範囲だけを切り出して縮めるので、CROP でも素材全体を拡大しない。出力のバッファは使い回すので、
+    返したフレームは次の呼び出しまでに使い終えること。呼び出し側がその場でアイコンをブレンドしても
+    前のフレームの結果が残らないように、LETTERBOX の余白も毎回塗り直す（余白の帯だけなので安い）。
+    """
+
+    def __init__(self, plan: FitPlan, background=(0, 0, 0)):
+        self.plan = plan
+        self.background = background
+        self._canvas = None
+        self._blank = None
+        self._content = None
+
+    def __call__(self, frame):
+        import numpy as np
+
+        plan = self.plan
+        if self._canvas is None:
+            canvas_w, canvas_h = plan.canvas_size
+            self._canvas = np.empty((canvas_h, canvas_w, frame.shape[2]), dtype=frame.dtype)
+            # 色のタプルを毎回ブロードキャストすると遅いので、塗った 1 枚からコピーする
+            self._blank = np.empty_like(self._canvas)
+            self._blank[...] = self.background
+        x0, y0, x1, y1 = plan.canvas_box
+        if plan.mode != BLUR:
+            canvas, blank = self._canvas, self._blank
+            canvas[:y0] = blank[:y0]
+            canvas[y1:] = blank[y1:]
+            canvas[y0:y1, :x0] = blank[y0:y1, :x0]
+            canvas[y0:y1, x1:] = blank[y0:y1, x1:]
+        sx0, sy0, sx1, sy1 = plan.source_box
+        size = (x1 - x0, y1 - y0)
+        region = frame[sy0:sy1, sx0:sx1]
+        if region.shape[1::-1] == size:
+            content = region
+        else:
+            if self._content is None:
+                self._content = np.empty((size[1], size[0], frame.shape[2]), dtype=frame.dtype)
+            content = _resize(region, size, dst=self._content)
+        return _place(self._canvas, content, plan, None)
@@ -0,0 +1,273 @@
+"""rupload（Instagram の写真・動画アップロード）とストーリー投稿 API の代わりになるローカル HTTP サーバー
+
+接続断・遅延・帯域を再現して、再開可能なアップロードの動作を確かめる。
+
+    python benchmarks/mock_rupload.py video.mp4                       # 途中で 3 回切断
+    python benchmarks/mock_rupload.py video.mp4 --drops 5 --latency-ms 20 --errors 2
+
+GET /rupload_igvideo/<name> は受信済みのバイト数を {"offset": N} で返し（get_errors 回までは 503）、
+POST は Offset ヘッダーの位置から 1 チャンクを受け取る。drops 回までは drop_from 以降のチャンクを drop_after
+バイト受け取った時点で切断し、その POST で受け取った分は捨てる（応答していないチャンクは確定しない）。
+/api/v1/ 以下（configure_to_story 等）は投稿できたものとして応答するので、mock_client() の Client で
+instagrapi の投稿処理を最後まで通せる（benchmarks/pipeline.py が使う）。
+"""
+
+import argparse
+import hashlib
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+class RuploadState:
+    def __init__(self, drops: int = 0, drop_after: int = 256 * 1024, errors: int = 0, latency_ms: float = 0.0,
+                 bandwidth: float = 0.0, api_latency_ms: float = 0.0, drop_from: int = 0, get_errors: int = 0):
+        self.drops = drops
+        self.drop_after = drop_after
+        self.drop_from = drop_from
+        # オフセットの問い合わせ（GET）に 503 を返す回数
+        self.get_errors = get_errors
+        # 5xx を返す回数（POST の受信前）
+        self.errors = errors
+        self.latency = latency_ms / 1000
+        # 上り帯域（バイト/秒。0 で無制限）と API 呼び出しごとの応答遅延
+        self.bandwidth = bandwidth
+        self.api_latency = api_latency_ms / 1000
+        self.received: dict[str, bytearray] = {}
+        self.completed: dict[str, int] = {}
+        self.requests = {"GET": 0, "POST": 0}
+        # POST ごとの (Offset, Content-Length)
+        self.posts: list[tuple[int, int]] = []
+        self.api_calls: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def pace(self, nbytes: int):
+        """64KiB ごとの遅延と帯域の分だけ待つ"""
+        delay = self.latency + (nbytes / self.bandwidth if self.bandwidth else 0.0)
+        if delay:
+            time.sleep(delay)
+
+
+def _story_media(video: bool) -> dict:
+    """configure_to_story の応答の media（instagrapi の Story に変換できる最小限の項目）"""
+    media = {
+        "pk": "3000000000000000001",
+        "id": "3000000000000000001_1",
+        "code": "Cmock",
+        "taken_at": int(time.time()),
+        "media_type": 2 if video else 1,
+        "product_type": "story",
+        "user": {"pk": "1", "username": "mock", "full_name": "", "profile_pic_url": "https://example.com/p.jpg"},
+        "image_versions2": {"candidates": [
+            {"url": "https://example.com/a.jpg", "width": 1080, "height": 1920, "scans_profile": "e35"}
+        ]},
+        "caption": None,
+        "like_count": 0,
+    }
+    if video:
+        media["video_versions"] = [{"url": "https://example.com/v.mp4", "width": 1080, "height": 1920, "type": 101}]
+        media["video_duration"] = 1.0
+    return media
+
+
+class RuploadHandler(BaseHTTPRequestHandler):
+    server: "RuploadServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _name(self) -> str:
+        return self.path.rstrip("/").rsplit("/", 1)[-1]
+
+    def _reply(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _api(self):
+        """/api/v1/<endpoint> への応答（本文は読み捨てる）"""
+        state = self.server.state
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        endpoint = self.path.split("/api/v1/", 1)[1].split("?", 1)[0].rstrip("/")
+        with state.lock:
+            state.api_calls[endpoint] = state.api_calls.get(endpoint, 0) + 1
+        time.sleep(state.api_latency)
+        payload = {"status": "ok"}
+        if endpoint == "media/configure_to_story":
+            payload["media"] = _story_media("video=1" in self.path)
+        self._reply(200, payload)
+
+    def do_GET(self):
+        if self.path.startswith("/api/v1/"):
+            self._api()
+            return
+        state = self.server.state
+        with state.lock:
+            state.requests["GET"] += 1
+            offset = len(state.received.get(self._name(), b""))
+            fail = state.get_errors > 0
+            if fail:
+                state.get_errors -= 1
+        time.sleep(state.latency)
+        if fail:
+            self._reply(503, {"status": "fail", "message": "try again"})
+            return
+        self._reply(200, {"offset": offset})
+
+    def do_POST(self):
+        if self.path.startswith("/api/v1/"):
+            self._api()
+            return
+        state = self.server.state
+        name = self._name()
+        length = int(self.headers.get("Content-Length", 0))
+        offset = int(self.headers.get("Offset", 0))
+        total = int(self.headers.get("X-Entity-Length", offset + length))
+        with state.lock:
+            state.requests["POST"] += 1
+            state.posts.append((offset, length))
+            buffer = state.received.setdefault(name, bytearray())
+            fail = state.errors > 0
+            if fail:
+                state.errors -= 1
+            drop = not fail and state.drops > 0 and offset >= state.drop_from and length > state.drop_after
+            if drop:
+                state.drops -= 1
+        if fail:
+            self.close_connection = True
+            self._reply(503, {"status": "fail", "message": "try again"})
+            return
+        if offset != len(buffer):
+            self.close_connection = True
+            self._reply(400, {"status": "fail", "message": f"offset mismatch {offset} != {len(buffer)}"})
+            return
+
+        remaining = length
+        limit = state.drop_after if drop else length
+        while remaining and length - remaining < limit:
+            chunk = self.rfile.read(min(64 * 1024, remaining, limit - (length - remaining)))
+            if not chunk:
+                return
+            with state.lock:
+                buffer.extend(chunk)
+            remaining -= len(chunk)
+            state.pace(len(chunk))
+        if drop:
+            # 途中で切断（このチャンクで受け取った分は確定しない）
+            with state.lock:
+                del buffer[offset:]
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+        if len(buffer) >= total:
+            with state.lock:
+                state.completed[name] = len(buffer)
+        self._reply(200, {"status": "ok", "upload_id": name.split("_")[0], "xsharing_nonces": {}})
+
+
+class RuploadServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, state: RuploadState, address=("127.0.0.1", 0)):
+        super().__init__(address, RuploadHandler)
+        self.state = state
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_server(state: RuploadState) -> RuploadServer:
+    server = RuploadServer(state)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def route_to(session, base_url: str):
+    """requests.Session の https:// 宛ての通信をすべて base_url のサーバーに向ける"""
+    from urllib.parse import urlsplit
+
+    from requests.adapters import HTTPAdapter
+
+    local = urlsplit(base_url)
+
+    class LocalAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            url = urlsplit(request.url)
+            request.url = url._replace(scheme=local.scheme, netloc=local.netloc).geturl()
+            return super().send(request, **kwargs)
+
+    session.mount("https://", LocalAdapter())
+
+
+def mock_client(server: RuploadServer, user_id: int = 1):
+    """アプリと同じ設定の Client を、ログイン済みの状態で server に向けて作る"""
+    from ig_client import new_client
+
+    client = new_client()
+    client.authorization_data = {"ds_user_id": str(user_id), "sessionid": f"{user_id}%3Amock%3A1"}
+    route_to(client.private, server.base_url)
+    route_to(client.public, server.base_url)
+    return client
+
+
+def main(argv=None) -> int:
+    import requests
+
+    from resumable_upload import ResumableUploader
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("file", help="アップロードするファイル")
+    parser.add_argument("--drops", type=int, default=3, help="途中で切断する回数")
+    parser.add_argument("--drop-after", type=int, default=128 * 1024,
+                        help="切断する POST で切断までに受け取るバイト数（--chunk-size より小さくする）")
+    parser.add_argument("--errors", type=int, default=0, help="503 を返す回数")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="64KiB ごとの遅延")
+    parser.add_argument("--chunk-size", type=int, default=256 * 1024)
+    args = parser.parse_args(argv)
+
+    path = Path(args.file)
+    state = RuploadState(args.drops, args.drop_after, args.errors, args.latency_ms)
+    server = start_server(state)
+    name = f"{int(time.time() * 1000)}_0_1234567890"
+    url = f"{server.base_url}/rupload_igvideo/{name}"
+
+    def on_progress(event):
+        print(f"  attempt {event.attempt}: {event.sent}/{event.total} ({event.fraction:.0%})", file=sys.stderr)
+
+    started = time.perf_counter()
+    uploader = ResumableUploader(
+        requests.Session(), url, path, chunk_size=args.chunk_size, on_progress=on_progress,
+        backoff_base=0.05, progress_interval=0.0,
+    )
+    uploader.upload()
+    elapsed = time.perf_counter() - started
+    received = bytes(state.received[name])
+    ok = hashlib.sha256(received).digest() == hashlib.sha256(path.read_bytes()).digest()
+    print(json.dumps({
+        "bytes": uploader.total,
+        "attempts": uploader.attempt,
+        "retries": uploader.retries,
+        "requests": state.requests,
+        "elapsed_s": round(elapsed, 3),
+        "intact": ok,
+    }))
+    server.shutdown()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
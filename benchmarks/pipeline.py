@@ -0,0 +1,368 @@
+"""加工とアップロードのベンチマーク（プレビュー・写真の生成・動画の焼き込み・縦横比の合わせ・モックへの投稿）
+
+    python benchmarks/pipeline.py                                   # 既定のサイズ一式
+    python benchmarks/pipeline.py --quick                           # 小さいサイズだけ（CI 向け）
+    python benchmarks/pipeline.py --image-mp 1 12 50 --links 0 4 8  # 条件を指定
+    python benchmarks/pipeline.py --json bench.json                 # 結果を保存
+    python benchmarks/pipeline.py --baseline bench.json             # 保存済みの結果より遅くなったら終了コード 1
+
+素材（ノイズ入りの写真・testsrc2 の動画・アイコン）は --data-dir に一度だけ生成して使い回すので、
+コミット間で同じ入力を比べられる。投稿は mock_rupload.py のローカルサーバーに、アプリと同じ設定の
+Client で行う（instagrapi の処理はそのまま通る。--latency-ms / --bandwidth-mbps で回線を再現）。
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from mock_rupload import RuploadState, mock_client, start_server  # noqa: E402
+
+# (秒, 幅, 高さ)
+DEFAULT_VIDEOS = [(5, 720, 1280), (15, 1080, 1920), (30, 1920, 1080)]
+QUICK_VIDEOS = [(3, 540, 960)]
+ICON_COUNT = 8
+
+
+def generate_image(path: Path, megapixels: float, seed: int = 0):
+    """縦長 3:4 のテスト写真（グラデーションとノイズで、実写に近い圧縮コストにする）"""
+    import numpy as np
+    from PIL import Image
+
+    width = int(math.sqrt(megapixels * 1e6 * 3 / 4))
+    height = int(width * 4 / 3)
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    for channel, (a, b) in enumerate(((0.7, 0.3), (0.3, 0.7), (0.5, 0.5))):
+        plane = a * y + b * x + rng.normal(0, 12, (height, width)).astype(np.float32)
+        pixels[..., channel] = np.clip(plane, 0, 255)
+    Image.fromarray(pixels).save(path, "JPEG", quality=90)
+
+
+def generate_video(path: Path, seconds: float, width: int, height: int):
+    from probe import ffmpeg_exe
+
+    subprocess.run(
+        [ffmpeg_exe(), "-y", "-loglevel", "error",
+         "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate=30",
+         "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100",
+         "-t", str(seconds), "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+         "-c:a", "aac", "-shortest", str(path)],
+        check=True,
+    )
+
+
+def generate_icons(directory: Path) -> list[Path]:
+    from PIL import Image, ImageDraw
+
+    paths = []
+    for index in range(ICON_COUNT):
+        path = directory / f"icon{index}.png"
+        if not path.exists():
+            icon = Image.new("RGBA", (512, 512), (0, 0, 0, 0))
+            draw = ImageDraw.Draw(icon)
+            hue = index * 255 // ICON_COUNT
+            draw.rounded_rectangle((16, 16, 496, 496), radius=96, fill=(hue, 255 - hue, 160, 230))
+            draw.text((200, 230), f"Link {index + 1}", fill=(255, 255, 255, 255))
+            icon.save(path)
+        paths.append(path)
+    return paths
+
+
+def ensure_media(data_dir: Path, image_mp: list[float], videos: list[tuple]) -> dict:
+    data_dir.mkdir(parents=True, exist_ok=True)
+    images = {}
+    for megapixels in image_mp:
+        path = data_dir / f"photo_{megapixels:g}mp.jpg"
+        if not path.exists():
+            print(f"generating {path.name}", file=sys.stderr)
+            generate_image(path, megapixels)
+        images[f"{megapixels:g}mp"] = path
+    video_paths = {}
+    for seconds, width, height in videos:
+        path = data_dir / f"video_{width}x{height}_{seconds:g}s.mp4"
+        if not path.exists():
+            print(f"generating {path.name}", file=sys.stderr)
+            generate_video(path, seconds, width, height)
+        video_paths[f"{width}x{height}_{seconds:g}s"] = path
+    return {"images": images, "videos": video_paths, "icons": generate_icons(data_dir)}
+
+
+def make_links(count: int, icons: list[Path]) -> list[dict]:
+    """縦に並べた count 個の Link（UI と同じ形式）"""
+    links = []
+    for index in range(count):
+        links.append({
+            "url": f"https://example.com/{index}",
+            "x": 0.3 + 0.4 * (index % 2),
+            "y": (index // 2 + 0.5) / max(1, math.ceil(count / 2)),
+            "w": 0.35,
+            "h": 0.1,
+            "icon_path": str(icons[index % len(icons)]),
+        })
+    return links
+
+
+def timed(fn, runs: int, warmup: int = 0) -> dict:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return {"median_s": statistics.median(samples), "samples_s": [round(s, 4) for s in samples]}
+
+
+def bench_preview(media: dict, links_counts: list[int], runs: int) -> dict:
+    """プレビューの表示まで（縮小デコード + アイコン）と動画の最初のフレームまで"""
+    from icon_cache import IconCache
+    from preview import ThumbnailCache, VideoFrameSource
+    from story_pipeline import default_resample
+
+    resample = default_resample()
+    max_size = (320, 220)
+    results = {}
+    for name, path in media["images"].items():
+        for count in links_counts:
+            links = make_links(count, media["icons"])
+
+            def render():
+                # 新しいキャッシュで毎回コールドに測る
+                thumb = ThumbnailCache(max_size, resample).get(path)
+                icons = IconCache()
+                for link in links:
+                    icons.get(link["icon_path"], (link["w"] * thumb.width, link["h"] * thumb.height), resample)
+
+            results[f"preview/photo/{name}/links{count}"] = timed(render, runs, warmup=1)
+    for name, path in media["videos"].items():
+        def first_frame():
+            done = threading.Event()
+            source = VideoFrameSource(path, max_size, lambda _ts, _image: done.set())
+            source.request(0.0)
+            if not done.wait(30):
+                raise RuntimeError(f"no frame from {path.name}")
+            source.close()
+
+        # 1 回目は cv2 の import を含むので捨てる
+        results[f"preview/video/{name}"] = timed(first_frame, runs, warmup=1)
+    return results
+
+
+def bench_prepare(media: dict, links_counts: list[int], runs: int, encode_workers: int, work_dir: Path) -> dict:
+    """写真ストーリーの生成と動画への焼き込み（キャッシュなし）"""
+    import compositor  # noqa: F401  初回の import を測定に含めない
+    import probe  # noqa: F401
+    from photo_story import JpegSettings
+    from story_pipeline import StoryOptions, default_resample, link_overlays, prepare_story
+
+    options = StoryOptions(resample=default_resample(), photo_mode="direct",
+                           photo_jpeg=JpegSettings(max_bytes=1_000_000, min_quality=70),
+                           encode_workers=encode_workers)
+    results = {}
+
+    def prepare(path, links):
+        prepared = prepare_story(path, link_overlays(links), options, work_dir)
+        prepared.cleanup()
+
+    for name, path in media["images"].items():
+        for count in links_counts:
+            links = make_links(count, media["icons"])
+            results[f"photo/{name}/links{count}"] = timed(lambda: prepare(path, links), runs)
+    for name, path in media["videos"].items():
+        # アイコンが無ければ焼き込みは行われないので 1 個以上で測る
+        for count in sorted({max(1, count) for count in links_counts}):
+            links = make_links(count, media["icons"])
+            results[f"video/{name}/links{count}"] = timed(lambda: prepare(path, links), runs)
+    return results
+
+
+def bench_fit(media: dict, runs: int, frames: int = 60) -> dict:
+    """縦横比を合わせる処理だけ（動画はデコード済みのフレームを 1 スレッドで。fps が元の fps 以上なら実時間以上）"""
+    import cv2
+    from PIL import Image
+
+    from autofit import FIT_MODES, FitPlan, FrameFitter
+    from photo_story import fit_to_story
+    from story_pipeline import default_resample
+
+    resample = default_resample()
+    threads = cv2.getNumThreads()
+    cv2.setNumThreads(1)
+    results = {}
+    try:
+        for name, path in media["videos"].items():
+            capture = cv2.VideoCapture(str(path))
+            fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+            decoded = []
+            while len(decoded) < frames:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                decoded.append(frame)
+            capture.release()
+            plan_size = decoded[0].shape[1::-1]
+            if FitPlan.plan(plan_size).fits:
+                continue
+            for mode in FIT_MODES:
+                fitter = FrameFitter(FitPlan.plan(plan_size, mode))
+                result = timed(lambda: [fitter(frame) for frame in decoded], runs, warmup=1)
+                result["fps"] = round(len(decoded) / result["median_s"], 1)
+                result["realtime"] = round(result["fps"] / fps, 2)
+                results[f"fit/video/{name}/{mode}"] = result
+        for name, path in media["images"].items():
+            for mode in FIT_MODES:
+                def fit():
+                    with Image.open(path) as image:
+                        fit_to_story(image, resample, mode=mode)
+
+                results[f"fit/photo/{name}/{mode}"] = timed(fit, runs)
+    finally:
+        cv2.setNumThreads(threads)
+    return results
+
+
+def bench_upload(media: dict, runs: int, latency_ms: float, bandwidth_mbps: float, work_dir: Path) -> dict:
+    """加工済みの素材をモックのサーバーへ投稿（rupload・configure_to_story まで instagrapi の処理を通す）
+
+    instagrapi が configure_to_story の前に入れる固定の 3 秒の待ちも含む。
+    """
+    from photo_story import JpegSettings
+    from story_pipeline import (
+        StoryOptions, build_story_links, default_resample, link_overlays, prepare_story, upload_prepared,
+    )
+
+    state = RuploadState(latency_ms=0.0, bandwidth=bandwidth_mbps * 1e6 / 8, api_latency_ms=latency_ms)
+    server = start_server(state)
+    client = mock_client(server)
+    options = StoryOptions(resample=default_resample(), photo_jpeg=JpegSettings(max_bytes=1_000_000, min_quality=70))
+    links = make_links(1, media["icons"])
+    story_links = build_story_links(links)
+    results = {}
+    targets = [("photo", *next(iter(media["images"].items())))] + [("video", *item) for item in media["videos"].items()]
+    try:
+        for kind, name, path in targets:
+            prepared = prepare_story(path, link_overlays(links), options, work_dir)
+            try:
+                # 加工済みのファイルは cleanup で消えるので、大きさは投稿の前に取っておく
+                size = prepared.path.stat().st_size
+                result = timed(lambda: upload_prepared(client, prepared, story_links), runs)
+            finally:
+                prepared.cleanup()
+            result["bytes"] = size
+            results[f"upload/{kind}/{name}"] = result
+    finally:
+        server.shutdown()
+    results["upload/api_calls"] = dict(state.api_calls)
+    return results
+
+
+def compare(current: dict, baseline: dict, max_regression: float) -> list[str]:
+    failures = []
+    for name, data in current.get("results", {}).items():
+        before = baseline.get("results", {}).get(name, {})
+        if not isinstance(data, dict) or "median_s" not in data or not before.get("median_s"):
+            continue
+        if data["median_s"] > before["median_s"] * (1 + max_regression):
+            failures.append(f"{name}: {before['median_s']:.3f}s -> {data['median_s']:.3f}s")
+    return failures
+
+
+def git_revision() -> str | None:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="小さい素材だけで測る")
+    parser.add_argument("--image-mp", type=float, nargs="+", help="写真のサイズ（メガピクセル、既定 1 12 50）")
+    parser.add_argument("--video", nargs="+", metavar="SECxWxH",
+                        help="動画の長さと解像度（例: 5x720x1280。既定 5x720x1280 15x1080x1920 30x1920x1080）")
+    parser.add_argument("--links", type=int, nargs="+", help="Link の数（0〜8、既定 0 1 4 8）")
+    parser.add_argument("--only", nargs="+", choices=("preview", "prepare", "fit", "upload"), help="実行する項目")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--encode-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="モックの API 応答の遅延")
+    parser.add_argument("--bandwidth-mbps", type=float, default=20.0, help="モックへの上り帯域 (Mbps、0 で無制限)")
+    parser.add_argument("--data-dir", default=str(Path(tempfile.gettempdir()) / "story-uploader-bench"),
+                        help="生成した素材の置き場所（使い回す）")
+    parser.add_argument("--json", help="結果の保存先")
+    parser.add_argument("--baseline", help="比較対象の結果 JSON")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="許容する悪化率（0.2 = 20%%）")
+    args = parser.parse_args(argv)
+
+    image_mp = args.image_mp or ([1, 4] if args.quick else [1, 12, 50])
+    videos = [tuple(int(v) for v in spec.split("x")) for spec in args.video] if args.video else (
+        QUICK_VIDEOS if args.quick else DEFAULT_VIDEOS
+    )
+    links_counts = [min(ICON_COUNT, max(0, n)) for n in (args.links or ([0, 4] if args.quick else [0, 1, 4, 8]))]
+    only = set(args.only or ("preview", "prepare", "fit", "upload"))
+
+    media = ensure_media(Path(args.data_dir), image_mp, videos)
+    result: dict = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "runs": args.runs,
+            "image_mp": image_mp,
+            "videos": [list(video) for video in videos],
+            "links": links_counts,
+            "encode_workers": args.encode_workers,
+            "latency_ms": args.latency_ms,
+            "bandwidth_mbps": args.bandwidth_mbps,
+        },
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        if "preview" in only:
+            result["results"].update(bench_preview(media, links_counts, args.runs))
+        if "prepare" in only:
+            result["results"].update(bench_prepare(media, links_counts, args.runs, args.encode_workers, Path(work_dir)))
+        if "fit" in only:
+            result["results"].update(bench_fit(media, args.runs))
+        if "upload" in only:
+            result["results"].update(
+                bench_upload(media, args.runs, args.latency_ms, args.bandwidth_mbps, Path(work_dir))
+            )
+
+    for name, data in result["results"].items():
+        if "median_s" in data:
+            line = f"{name:<44} {data['median_s'] * 1000:10.1f} ms"
+            if "fps" in data:
+                line += f"  {data['fps']:.0f} fps ({data['realtime']:.1f}x 実時間)"
+            print(line)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        if baseline.get("config") != result["config"]:
+            print("warning: baseline was measured with a different configuration", file=sys.stderr)
+        failures = compare(result, baseline, args.max_regression)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""起動時間のベンチマーク（最初のウィンドウ描画までの時間とモジュールごとの import コスト）
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --exe dist/main            # PyInstaller 版を測定
+    python benchmarks/startup.py --json startup.json        # 結果を保存
+    python benchmarks/startup.py --baseline startup.json    # 保存済みの結果より遅くなったら終了コード 1
+
+描画時間の測定には表示環境（DISPLAY 等）が必要。無い場合は import コストだけを測る。
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# 起動時に読み込まれるもの / 初回利用まで遅延しているもの
+MODULES = [
+    "main",
+    "PIL.Image",
+    "PIL.ImageTk",
+    "cv2",
+    "numpy",
+    "pydantic",
+    "instagrapi",
+    "moviepy.editor",
+]
+
+_IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def measure_first_paint(command: list[str], runs: int, timeout: float) -> list[float]:
+    """プロセス起動から最初の描画完了までの秒数"""
+    env = {**os.environ, "STORY_UPLOADER_STARTUP_BENCH": "1"}
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        proc = subprocess.Popen(
+            command, cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+        painted = None
+        assert proc.stdout is not None
+        for line in proc.stdout:
+            if line.strip() == "first-paint":
+                painted = time.perf_counter() - started
+                break
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        if painted is None:
+            raise RuntimeError("ウィンドウが描画されませんでした（表示環境を確認してください）")
+        samples.append(painted)
+    return samples
+
+
+def measure_import(module: str, runs: int) -> dict:
+    """新しいプロセスで import したときの累積時間と、その内訳の上位"""
+    cumulative = []
+    children: dict[str, list[int]] = {}
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=ROOT, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed"}
+        total = 0
+        for match in _IMPORTTIME.finditer(result.stderr):
+            _self_us, cumulative_us, indent, name = match.groups()
+            if name == module and len(indent) == 1:
+                total = int(cumulative_us)
+            # 直下の依存だけ内訳として残す
+            if len(indent) == 3:
+                children.setdefault(name, []).append(int(cumulative_us))
+        cumulative.append(total)
+    top = sorted(((statistics.median(v), k) for k, v in children.items()), reverse=True)[:8]
+    return {
+        "cumulative_ms": statistics.median(cumulative) / 1000,
+        "top_children_ms": {name: us / 1000 for us, name in top},
+    }
+
+
+def compare(current: dict, baseline: dict, max_regression: float) -> list[str]:
+    failures = []
+    pairs = [("first_paint_s", current.get("first_paint_s"), baseline.get("first_paint_s"))]
+    for module, data in current.get("imports", {}).items():
+        base = baseline.get("imports", {}).get(module, {})
+        pairs.append((f"import {module} (ms)", data.get("cumulative_ms"), base.get("cumulative_ms")))
+    for label, now, before in pairs:
+        if now is None or not before:
+            continue
+        if now > before * (1 + max_regression):
+            failures.append(f"{label}: {before:.3f} -> {now:.3f}")
+    return failures
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--exe", help="PyInstaller でビルドした実行ファイル（省略時は main.py を実行）")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--no-paint", action="store_true", help="描画時間を測らない（表示環境が無い CI 向け）")
+    parser.add_argument("--json", help="結果の保存先")
+    parser.add_argument("--baseline", help="比較対象の結果 JSON")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="許容する悪化率（0.2 = 20%%）")
+    args = parser.parse_args(argv)
+
+    result: dict = {"python": sys.version.split()[0], "runs": args.runs}
+    if not args.no_paint:
+        command = [args.exe] if args.exe else [sys.executable, str(ROOT / "main.py")]
+        try:
+            samples = measure_first_paint(command, args.runs, args.timeout)
+            result["first_paint_s"] = statistics.median(samples)
+            result["first_paint_samples_s"] = samples
+            print(f"first paint: {result['first_paint_s']:.3f}s (median of {len(samples)})")
+        except RuntimeError as e:
+            print(f"first paint: skipped ({e})")
+
+    result["imports"] = {}
+    for module in MODULES:
+        data = measure_import(module, args.runs)
+        result["imports"][module] = data
+        if "error" in data:
+            print(f"import {module:<16} error: {data['error']}")
+            continue
+        print(f"import {module:<16} {data['cumulative_ms']:8.1f} ms")
+        if module == "main":
+            for name, ms in data["top_children_ms"].items():
+                print(f"    {name:<28} {ms:8.1f} ms")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        failures = compare(result, baseline, args.max_regression)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
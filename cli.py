@@ -0,0 +1,512 @@
+"""GUI を使わずにストーリーを投稿するコマンドライン版（tkinter を読み込まないので表示環境の無いサーバーでも動く）
+
+    python cli.py login USERNAME                 # パスワードは IG_PASSWORD か入力プロンプト
+    python cli.py accounts                       # 保存済みのアカウント一覧
+    python cli.py run manifest.json              # マニフェスト（JSON / CSV）を一括投稿
+    python cli.py run manifest.csv --account alice --account bob --concurrency 4 --results results.jsonl
+    python cli.py watch exports/ --account alice  # フォルダーに置かれた素材を投稿し続ける（サイドカー a.jpg.json で Link 指定）
+
+結果は 1 件ごとに JSON 1 行（JSON Lines）で出力する。1 件でも失敗したら終了コード 1。
+"""
+
+import argparse
+import csv
+import getpass
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+from accounts import AccountPool
+from autofit import FIT_MODES, LETTERBOX
+from icon_cache import icon_cache
+from media_cache import PreparedMediaCache
+from perf_log import PerfLog
+from ig_client import new_client
+from photo_story import JpegSettings, decode_budget
+from story_pipeline import (
+    DEFAULT_LINK_GEOM,
+    PreparedStory,
+    StoryOptions,
+    default_encode_workers,
+    default_resample,
+    link_overlays,
+    prepare_story_cached,
+    upload_to_accounts,
+)
+from upload_queue import DONE, FAILED, JobStore, UploadQueue
+
+
+class ManifestError(ValueError):
+    pass
+
+
+def _parse_link(raw: dict, base_dir: Path, where: str) -> dict | None:
+    url = str(raw.get("url") or "").strip()
+    if not url or url == "https://":
+        return None
+    link = {"url": url}
+    for key in ("x", "y", "w", "h"):
+        value = raw.get(key)
+        try:
+            link[key] = float(value) if value not in (None, "") else DEFAULT_LINK_GEOM[key]
+        except (TypeError, ValueError):
+            raise ManifestError(f"{where}: {key} は数値で指定してください: {value!r}") from None
+    icon = str(raw.get("icon") or raw.get("icon_path") or "").strip()
+    link["icon_path"] = str((base_dir / icon).resolve()) if icon else ""
+    return link
+
+
+def _split_accounts(value) -> list[str]:
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [name.strip() for name in value.split(";") if name.strip()]
+    return [str(name) for name in value]
+
+
+def load_manifest(path) -> list[dict]:
+    """マニフェストを読み、{"file_path", "links", "accounts"} のリストにする
+
+    JSON: [{"file": "a.jpg", "links": [{"url": ..., "x": ..., "y": ..., "w": ..., "h": ..., "icon": ...}],
+            "accounts": ["alice"]}, ...]（{"items": [...]} でも可。Link が 1 つなら url / icon 等を直接書いてよい）
+    CSV: file,url,x,y,w,h,icon,accounts の列。同じ file が続く行は 1 件にまとめて Link を複数付ける。
+    accounts はユーザー名（CSV では ; 区切り）。パスはマニフェストのあるディレクトリからの相対パス。
+    """
+    path = Path(path)
+    base_dir = path.resolve().parent
+    if path.suffix.lower() == ".csv":
+        with path.open(newline="", encoding="utf-8-sig") as fp:
+            rows = list(csv.DictReader(fp))
+        raw_items: list[dict] = []
+        for row in rows:
+            if raw_items and row.get("file") == raw_items[-1]["file"]:
+                raw_items[-1]["links"].append(row)
+            else:
+                raw_items.append({"file": row.get("file"), "links": [row], "accounts": row.get("accounts")})
+    else:
+        data = json.loads(path.read_text(encoding="utf-8"))
+        raw_items = data.get("items", []) if isinstance(data, dict) else data
+        if not isinstance(raw_items, list):
+            raise ManifestError("JSON マニフェストは配列か {\"items\": [...]} にしてください")
+
+    items = []
+    for index, raw in enumerate(raw_items, start=1):
+        where = f"{path.name} #{index}"
+        if not isinstance(raw, dict):
+            raise ManifestError(f"{where}: オブジェクトではありません")
+        file_name = str(raw.get("file") or raw.get("file_path") or "").strip()
+        if not file_name:
+            raise ManifestError(f"{where}: file がありません")
+        file_path = (base_dir / file_name).resolve()
+        if not file_path.exists():
+            raise ManifestError(f"{where}: ファイルが見つかりません: {file_path}")
+        raw_links = raw.get("links")
+        if raw_links is None:
+            raw_links = [raw]
+        links = [link for raw_link in raw_links if (link := _parse_link(raw_link, base_dir, where))]
+        items.append({"file_path": str(file_path), "links": links, "accounts": _split_accounts(raw.get("accounts"))})
+    return items
+
+
+def _account_pool(args) -> AccountPool:
+    pool = AccountPool(
+        new_client,
+        directory=Path(args.sessions_dir),
+        legacy_session=Path(args.session),
+        min_upload_interval=args.min_upload_interval,
+    )
+    pool.load()
+    return pool
+
+
+def _resolve_accounts(pool: AccountPool, usernames: list[str]) -> list[str]:
+    keys = []
+    for username in usernames:
+        account = pool.find(username)
+        if account is None:
+            raise ManifestError(f"ログインしていないアカウントです: {username}")
+        keys.append(account.key)
+    return keys
+
+
+def cmd_login(args) -> int:
+    from instagrapi.exceptions import TwoFactorRequired
+
+    pool = _account_pool(args)
+    password = os.environ.get("IG_PASSWORD") or getpass.getpass("パスワード: ")
+    client = new_client()
+    try:
+        client.login(args.username, password)
+    except TwoFactorRequired:
+        code = args.code or input("認証コード: ").strip()
+        client.login(args.username, password, verification_code=code)
+    user_info = client.account_info()
+    account = pool.add(client, user_info.username)
+    print(json.dumps({"username": user_info.username, "session": account.key}, ensure_ascii=False))
+    return 0
+
+
+def cmd_accounts(args) -> int:
+    pool = _account_pool(args)
+    for account in pool.accounts():
+        info = account.store.load_info() or {}
+        print(json.dumps({
+            "username": account.username,
+            "session": account.key,
+            "validated_at": info.get("validated_at"),
+        }, ensure_ascii=False))
+    return 0
+
+
+def _story_options(args) -> StoryOptions:
+    decode_budget.limit_bytes = args.memory_limit_mb * 1024 ** 2 if args.memory_limit_mb else None
+    return StoryOptions(
+        resample=default_resample(),
+        photo_mode=args.photo_mode,
+        photo_jpeg=JpegSettings(max_bytes=args.jpeg_max_bytes, min_quality=70),
+        encode_workers=args.encode_workers,
+        fit_mode=args.fit,
+    )
+
+
+def _story_jobs(args, pool: AccountPool, cache: PreparedMediaCache | None, timings: dict):
+    """UploadQueue に渡す prepare / upload（run と watch で共通）。timings[spec["item"]] に所要時間を残す"""
+    options = _story_options(args)
+    work_dir = Path(args.work_dir) if args.work_dir else None
+    if work_dir:
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+    def prepare(spec: dict) -> dict:
+        started = time.perf_counter()
+        try:
+            prepared = prepare_story_cached(spec["file_path"], link_overlays(spec["links"]), options,
+                                            cache=cache, work_dir=work_dir)
+            timings.setdefault(spec["item"], {})["cache_hit"] = prepared.cache_hit
+            return prepared.to_dict()
+        finally:
+            timings.setdefault(spec["item"], {})["prepare_s"] = round(time.perf_counter() - started, 3)
+
+    def upload(spec: dict, prepared: dict) -> dict:
+        if args.dry_run:
+            return {}
+        started = time.perf_counter()
+        try:
+            errors, results, dropped = upload_to_accounts(
+                pool, spec["links"], spec["accounts"], PreparedStory.from_dict(prepared),
+                on_progress=(lambda username, event: report_progress(spec["item"], username, event))
+                if args.progress else None,
+            )
+        finally:
+            timings.setdefault(spec["item"], {})["upload_s"] = round(time.perf_counter() - started, 3)
+        if dropped:
+            # 縦横比を合わせた結果キャンバスの外に出て投稿しなかった Link
+            timings[spec["item"]]["dropped_links"] = [link.get("url") for link in dropped]
+        timings[spec["item"]]["accounts"] = [
+            {"username": r.account, "ok": r.ok, "elapsed_s": round(r.elapsed, 3), "error": str(r.error) if r.error else None}
+            for r in results
+        ]
+        return errors
+
+    def report_progress(item, username: str, event):
+        record = {
+            "event": "progress",
+            "item": item,
+            "account": username,
+            "sent": event.sent,
+            "total": event.total,
+            "attempt": event.attempt,
+            "done": event.done,
+        }
+        print(json.dumps(record, ensure_ascii=False), file=sys.stderr, flush=True)
+
+    return prepare, upload
+
+
+def _media_cache(args) -> PreparedMediaCache | None:
+    return None if args.no_cache else PreparedMediaCache(Path(args.cache_dir), max_bytes=args.cache_max_mb * 1024 ** 2)
+
+
+def _result_record(job, timings: dict, perf: PerfLog) -> dict:
+    """終わったジョブの結果行。timings の分は取り出して消す（watch では動かし続けるので溜めない）"""
+    item = job.spec.get("item")
+    record = {
+        "item": item,
+        "job": job.id,
+        "file": job.spec.get("file_path"),
+        "status": job.status,
+        "error": job.error,
+        **timings.pop(item, {}),
+    }
+    run = perf.get(job.id)
+    if run is not None:
+        record["stages"] = run.summary()
+    return record
+
+
+def _print_summary(summary: str, args, pool: AccountPool, cache: PreparedMediaCache | None):
+    icons = icon_cache.stats()
+    if icons["hits"] + icons["misses"]:
+        summary += f" (icon cache: {icons['hit_rate']:.0%} hit rate)"
+    if cache is not None:
+        stats = cache.stats()
+        summary += f" (cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions)"
+    memory = decode_budget.stats()
+    if memory["peak_bytes"]:
+        summary += f" (decode memory peak: {memory['peak_bytes'] / 2 ** 20:.0f}MB estimated"
+        summary += f", {memory['waits']} waits)" if memory["waits"] else ")"
+    print(summary, file=sys.stderr)
+    if args.verbose:
+        for username, classes in pool.pacing_stats().items():
+            print(json.dumps({"event": "pacing", "account": username, **classes}, ensure_ascii=False), file=sys.stderr)
+
+
+def _default_accounts(args, pool: AccountPool) -> list[str]:
+    return _resolve_accounts(pool, args.account) if args.account else [
+        account.key for account in pool.accounts()[:1]
+    ]
+
+
+def cmd_run(args) -> int:
+    items = load_manifest(args.manifest)
+    pool = _account_pool(args)
+    default_accounts = _default_accounts(args, pool)
+    specs = []
+    for index, item in enumerate(items, start=1):
+        accounts = _resolve_accounts(pool, item["accounts"]) if item["accounts"] else default_accounts
+        if not accounts and not args.dry_run:
+            raise ManifestError("投稿先のアカウントがありません（先に cli.py login を実行してください）")
+        specs.append({"item": index, "file_path": item["file_path"], "links": item["links"], "accounts": accounts})
+
+    cache = _media_cache(args)
+    timings: dict = {}
+    prepare, upload = _story_jobs(args, pool, cache, timings)
+    perf = PerfLog(Path(args.perf_log) if args.perf_log else None, profile=args.profile, trace_memory=args.trace_memory)
+
+    out = open(args.results, "w", encoding="utf-8") if args.results else sys.stdout
+    out_lock = threading.Lock()
+    counts = {DONE: 0, FAILED: 0}
+
+    def on_change(job):
+        if job is None or job.status not in (DONE, FAILED):
+            return
+        record = _result_record(job, timings, perf)
+        with out_lock:
+            counts[job.status] += 1
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+    store = JobStore(Path(args.queue) if args.queue else ":memory:")
+    queue = UploadQueue(store, prepare, upload, prepare_workers=args.concurrency, on_change=on_change, perf=perf)
+    # --queue で再開したときは、マニフェストの同じ件（番号 + ファイル）のジョブを投稿し直さない
+    existing = {(job.spec.get("item"), job.spec.get("file_path")): job for job in store.jobs()}
+    started = time.perf_counter()
+    queue.start()
+    try:
+        for spec in specs:
+            job = existing.get((spec["item"], spec["file_path"]))
+            if job is None:
+                queue.submit(spec)
+            elif job.status == FAILED and args.retry_failed:
+                queue.retry(job.id)
+            elif job.status in (DONE, FAILED):
+                # 前回終わったものは結果だけ出す（待機・処理中のものはキューがそのまま続ける）
+                with out_lock:
+                    counts[job.status] += 1
+                    out.write(json.dumps({**_result_record(job, timings, perf), "resumed": True},
+                                         ensure_ascii=False) + "\n")
+        queue.wait_idle()
+    finally:
+        queue.stop(timeout=5)
+        perf.close()
+        if out is not sys.stdout:
+            out.close()
+    _print_summary(f"{counts[DONE]} done, {counts[FAILED]} failed in {time.perf_counter() - started:.1f}s",
+                   args, pool, cache)
+    return 1 if counts[FAILED] else 0
+
+
+def load_sidecar(path) -> dict:
+    """監視フォルダーの素材に添えるサイドカー JSON を読み、{"links", "accounts"} にする
+
+    {"links": [{"url": ..., "x": ..., "icon": ...}], "accounts": ["alice"]}。Link が 1 つなら url / icon 等を
+    直接書いてよい（マニフェストの 1 件と同じ書き方で file は不要）。パスはサイドカーのあるディレクトリからの相対パス。
+    """
+    path = Path(path)
+    where = path.name
+    try:
+        raw = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError) as e:
+        raise ManifestError(f"{where}: 読み込めません: {e}") from None
+    if not isinstance(raw, dict):
+        raise ManifestError(f"{where}: オブジェクトではありません")
+    base_dir = path.resolve().parent
+    raw_links = raw.get("links")
+    if raw_links is None:
+        raw_links = [raw]
+    links = [link for raw_link in raw_links if (link := _parse_link(raw_link, base_dir, where))]
+    return {"links": links, "accounts": _split_accounts(raw.get("accounts"))}
+
+
+def cmd_watch(args) -> int:
+    from hot_folder import FileLedger, HotFolder
+
+    directory = Path(args.folder)
+    if not directory.is_dir():
+        raise ManifestError(f"フォルダーが見つかりません: {directory}")
+    pool = _account_pool(args)
+    default_accounts = _default_accounts(args, pool)
+    if not default_accounts and not args.dry_run:
+        raise ManifestError("投稿先のアカウントがありません（先に cli.py login を実行してください）")
+
+    cache = _media_cache(args)
+    timings: dict = {}
+    prepare, upload = _story_jobs(args, pool, cache, timings)
+    perf = PerfLog(Path(args.perf_log) if args.perf_log else None, profile=args.profile, trace_memory=args.trace_memory)
+    out = open(args.results, "a", encoding="utf-8") if args.results else sys.stdout
+    out_lock = threading.Lock()
+    counts = {DONE: 0, FAILED: 0}
+    hot: HotFolder | None = None
+
+    def on_change(job):
+        if job is None or job.status not in (DONE, FAILED):
+            return
+        if hot is not None:
+            hot.finished(job.id, job.status, job.error)
+        record = _result_record(job, timings, perf)
+        with out_lock:
+            counts[job.status] += 1
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+    store = JobStore(Path(args.queue))
+    queue = UploadQueue(store, prepare, upload, prepare_workers=args.concurrency, on_change=on_change, perf=perf)
+
+    def submit(path: Path, sidecar: Path | None) -> int:
+        extra = load_sidecar(sidecar) if sidecar is not None else {"links": [], "accounts": []}
+        accounts = _resolve_accounts(pool, extra["accounts"]) if extra["accounts"] else default_accounts
+        return queue.submit({"item": path.name, "file_path": str(path), "links": extra["links"], "accounts": accounts})
+
+    def job_status(job_id: int) -> str | None:
+        job = store.get(job_id)
+        return job.status if job is not None else None
+
+    hot = HotFolder(
+        directory, FileLedger(Path(args.ledger)), submit,
+        settle_seconds=args.settle, poll_interval=args.poll_interval, rescan_interval=args.rescan_interval,
+        use_inotify=not args.poll, max_pending=args.max_pending, process_existing=args.process_existing,
+        job_status=job_status,
+    )
+    # 前回アップロード中だったものを失敗にしてから台帳と突き合わせ、その後でワーカーを動かす
+    store.recover()
+    hot.start()
+    store.clear_done()
+    stop = threading.Event()
+    started = time.perf_counter()
+    queue.start()
+    print(json.dumps({"event": "watching", "folder": str(hot.directory), **hot.stats()}, ensure_ascii=False),
+          file=sys.stderr, flush=True)
+    try:
+        hot.run(stop)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        queue.stop(timeout=5)
+        print(json.dumps({"event": "stopped", **hot.stats(), "ledger": hot.ledger.counts()}, ensure_ascii=False),
+              file=sys.stderr)
+        hot.ledger.close()
+        perf.close()
+        if out is not sys.stdout:
+            out.close()
+    _print_summary(f"{counts[DONE]} done, {counts[FAILED]} failed in {time.perf_counter() - started:.1f}s",
+                   args, pool, cache)
+    return 0
+
+
+def _add_story_arguments(parser: argparse.ArgumentParser):
+    """run と watch で共通の、前処理と投稿の設定"""
+    parser.add_argument("--account", action="append", default=[],
+                        help="投稿先のユーザー名（複数指定可。省略時は最初のアカウント。マニフェスト・サイドカーの accounts が優先）")
+    parser.add_argument("--concurrency", type=int, default=2, help="前処理を並列に行う件数")
+    parser.add_argument("--encode-workers", type=int, default=default_encode_workers(),
+                        help="動画焼き込みのセグメント並列エンコードのプロセス数")
+    parser.add_argument("--photo-mode", choices=("direct", "builder"), default="direct")
+    parser.add_argument("--fit", choices=FIT_MODES, default=LETTERBOX,
+                        help="縦横比が 9:16 でない素材の合わせ方（切り抜き / 黒い余白 / ぼかした背景）")
+    parser.add_argument("--jpeg-max-bytes", type=int, default=1_000_000, help="写真ストーリーの JPEG の上限バイト数")
+    parser.add_argument("--memory-limit-mb", type=int, default=768,
+                        help="並行する写真のデコードに使うメモリの上限（見積もり、MB。0 で無制限）")
+    parser.add_argument("--work-dir", help="加工済みファイルの置き場所（省略時は一時ディレクトリ）")
+    parser.add_argument("--cache-dir", default="media_cache", help="加工済み素材のキャッシュ（GUI と共通）")
+    parser.add_argument("--cache-max-mb", type=int, default=2048, help="キャッシュの上限サイズ (MB)")
+    parser.add_argument("--no-cache", action="store_true", help="加工済み素材のキャッシュを使わない")
+    parser.add_argument("--results", help="結果の出力先（省略時は標準出力）")
+    parser.add_argument("--progress", action="store_true", help="動画の送信バイト数を JSON 行で標準エラーに出す")
+    parser.add_argument("--dry-run", action="store_true", help="加工だけ行い投稿しない")
+    parser.add_argument("--perf-log", default="logs/perf.jsonl", help="段ごとの計測を書く JSON Lines（GUI と共通）")
+    parser.add_argument("--profile", action="store_true", help="前処理と投稿の cProfile を --perf-log の隣の profiles/ に保存")
+    parser.add_argument("--trace-memory", action="store_true", help="段ごとの Python のメモリ確保のピークを tracemalloc で記録")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--session", default="session.json", help="従来のセッションファイル")
+    parser.add_argument("--sessions-dir", default="sessions", help="追加アカウントのセッションを置くディレクトリ")
+    parser.add_argument("--min-upload-interval", type=float, default=30.0,
+                        help="同じアカウントへの連続投稿の間隔（秒）")
+    parser.add_argument("-v", "--verbose", action="store_true", help="処理の詳細を標準エラーに出す")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    login = sub.add_parser("login", help="ログインしてセッションを保存")
+    login.add_argument("username")
+    login.add_argument("--code", help="2要素認証のコード（省略時は必要になったら入力）")
+    login.set_defaults(func=cmd_login)
+
+    accounts = sub.add_parser("accounts", help="保存済みのアカウント一覧")
+    accounts.set_defaults(func=cmd_accounts)
+
+    run = sub.add_parser("run", help="マニフェストのストーリーを一括投稿")
+    run.add_argument("manifest", help="JSON / CSV のマニフェスト")
+    _add_story_arguments(run)
+    run.add_argument("--queue", help="ジョブを保存する SQLite ファイル（指定すると中断後に続きから再開できる）")
+    run.add_argument("--retry-failed", action="store_true",
+                     help="--queue で再開するとき、前回失敗した件もやり直す（省略時は失敗のまま結果に出す）")
+    run.set_defaults(func=cmd_run)
+
+    watch = sub.add_parser("watch", help="フォルダーを監視し、置かれた素材を加工して投稿し続ける（Ctrl+C で終了）")
+    watch.add_argument("folder", help="監視するフォルダー（直下のファイルだけ。サブフォルダーは見ない）")
+    _add_story_arguments(watch)
+    watch.add_argument("--queue", default="hot_folder_queue.sqlite3", help="ジョブを保存する SQLite ファイル")
+    watch.add_argument("--ledger", default="hot_folder.sqlite3", help="処理済み・失敗したファイルを記録する SQLite ファイル")
+    watch.add_argument("--settle", type=float, default=2.0,
+                       help="サイズと更新時刻がこの秒数変わらなければ書き込みが終わったとみなす")
+    watch.add_argument("--poll", action="store_true", help="inotify を使わず走査する（ネットワークドライブ等）")
+    watch.add_argument("--poll-interval", type=float, default=2.0, help="--poll のときの走査の間隔（秒）")
+    watch.add_argument("--rescan-interval", type=float, default=300.0,
+                       help="inotify の取りこぼしを補う全体の走査の間隔（秒）")
+    watch.add_argument("--max-pending", type=int, default=8, help="キューに入れておく件数の上限（超えた分は見つけた順に待つ）")
+    watch.add_argument("--process-existing", action="store_true",
+                       help="初回起動時に既にあるファイルも投稿する（省略時は記録だけして投稿しない）")
+    watch.set_defaults(func=cmd_watch)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr)
+    try:
+        return args.func(args)
+    except ManifestError as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    import multiprocessing
+
+    # PyInstaller 版でもセグメント並列エンコードのワーカープロセスを起動できるようにする
+    multiprocessing.freeze_support()
+    sys.exit(main())
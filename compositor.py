@@ -0,0 +1,354 @@
+import logging
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from autofit import FitPlan, FrameFitter
+from icon_cache import icon_cache
+from probe import ffmpeg_exe
+
+logger = logging.getLogger(__name__)
+
+
+# セグメント並列エンコードはコアがこれより多いときだけ使う
+PARALLEL_MIN_CORES = 2
+# 1 セグメントの最短の長さ（一般的な書き出しの GOP 約 2 秒 × 2）。短い動画は分割しない
+SEGMENT_MIN_SECONDS = 4.0
+
+
+def icon_box(geom, canvas_size: tuple[int, int]) -> tuple[int, int, int, int]:
+    """正規化座標 (中心x, 中心y, 幅, 高さ) をピクセルの (左, 上, 幅, 高さ) に変換"""
+    base_w, base_h = canvas_size
+    link_x, link_y, link_w, link_h = (float(v) for v in geom)
+    target_w = max(1, int(link_w * base_w))
+    target_h = max(1, int(link_h * base_h))
+    paste_x = int(link_x * base_w - target_w / 2)
+    paste_y = int(link_y * base_h - target_h / 2)
+    return paste_x, paste_y, target_w, target_h
+
+
+def paste_clipped(canvas: Image.Image, icon: Image.Image, x: int, y: int):
+    """キャンバス外にはみ出す部分を切り落としてから alpha_composite する"""
+    left = max(0, -x)
+    top = max(0, -y)
+    right = min(icon.width, canvas.width - x)
+    bottom = min(icon.height, canvas.height - y)
+    if right <= left or bottom <= top:
+        return None
+    if (left, top, right, bottom) != (0, 0, icon.width, icon.height):
+        icon = icon.crop((left, top, right, bottom))
+    canvas.alpha_composite(icon, (x + left, y + top))
+    return (x + left, y + top, x + right, y + bottom)
+
+
+def _merge_boxes(boxes: list[tuple[int, int, int, int]]) -> list[tuple[int, int, int, int]]:
+    """重なる矩形を外接矩形にまとめ、同じ画素を二重にブレンドしないようにする"""
+    merged = list(boxes)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    merged[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+class OverlayLayer:
+    """全アイコンを 1 枚の premultiplied BGRA レイヤーにまとめ、アイコン矩形だけをブレンドする"""
+
+    def __init__(self, size: tuple[int, int], regions):
+        self.size = size
+        # (x0, y0, x1, y1, BGR*alpha (uint16), 255-alpha (uint16))
+        self.regions = regions
+
+    @classmethod
+    def build(cls, overlays, size: tuple[int, int], resample):
+        """collect_links_with_icons の overlays から合成レイヤーを作る。合成対象が無ければ None"""
+        layer = Image.new("RGBA", size, (0, 0, 0, 0))
+        boxes = []
+        for item in overlays:
+            icon_path = item.get("icon_path")
+            if not icon_path or not item.get("geom"):
+                continue
+            paste_x, paste_y, target_w, target_h = icon_box(item["geom"], size)
+            try:
+                icon_resized = icon_cache.get(icon_path, (target_w, target_h), resample)
+            except Exception as e:
+                logger.warning(f"動画アイコン合成に失敗: {e}")
+                continue
+            box = paste_clipped(layer, icon_resized, paste_x, paste_y)
+            if box:
+                boxes.append(box)
+        if not boxes:
+            return None
+
+        pixels = np.asarray(layer)
+        regions = []
+        for x0, y0, x1, y1 in _merge_boxes(boxes):
+            rgba = pixels[y0:y1, x0:x1]
+            alpha = rgba[..., 3:4].astype(np.uint16)
+            if not alpha.any():
+                continue
+            premultiplied = rgba[..., 2::-1].astype(np.uint16) * alpha
+            regions.append((x0, y0, x1, y1, premultiplied, 255 - alpha))
+        return cls(size, regions) if regions else None
+
+    def blend(self, frame: np.ndarray, scratch: dict | None = None):
+        """BGR フレームにその場でブレンドする（アイコン矩形の外は触らない）"""
+        for index, (x0, y0, x1, y1, premultiplied, inv_alpha) in enumerate(self.regions):
+            region = frame[y0:y1, x0:x1]
+            if scratch is None:
+                tmp = np.empty(region.shape, dtype=np.uint16)
+            else:
+                tmp = scratch.get(index)
+                if tmp is None:
+                    tmp = scratch[index] = np.empty(region.shape, dtype=np.uint16)
+            # out = (src * a + dst * (255 - a) + 127) // 255  ※最大 65152 なので uint16 に収まる
+            np.multiply(region, inv_alpha, out=tmp)
+            tmp += premultiplied
+            tmp += 127
+            tmp //= 255
+            np.copyto(region, tmp, casting="unsafe")
+        return frame
+
+
+def _read_frames(capture, first_frame, frames: queue.Queue, stop: threading.Event):
+    frames.put(first_frame)
+    while not stop.is_set():
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.put(frame)
+    frames.put(None)
+
+
+def _stream_composite(capture, first_frame, layer: OverlayLayer | None, dst_path, fps: float, *,
+                      audio_src=None, crf: int, preset: str, prefetch: int, fit: FitPlan | None = None,
+                      threads: int | None = None):
+    # fit があればフレームごとにキャンバスに合わせてからブレンドする（出力はキャンバスの大きさ）
+    fitter = FrameFitter(fit) if fit is not None else None
+    width, height = fit.canvas_size if fit is not None else first_frame.shape[1::-1]
+    command = [
+        ffmpeg_exe(), "-loglevel", "error", "-y",
+        "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", repr(fps), "-i", "-",
+    ]
+    if audio_src is not None:
+        command += ["-i", str(audio_src), "-map", "0:v:0", "-map", "1:a:0?", "-c:a", "aac", "-shortest"]
+    command += [
+        "-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p",
+    ]
+    if threads:
+        # セグメント並列のときはコアをワーカーで分け合う（libx264 の既定はコア数ぶんのスレッド）
+        command += ["-threads", str(threads)]
+    command += ["-movflags", "+faststart", str(dst_path)]
+    encoder = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # デコードは別スレッドで先読みし、ブレンドとエンコードに重ねる
+    frames: queue.Queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_frames, args=(capture, first_frame, frames, stop), daemon=True)
+    reader.start()
+    scratch: dict = {}
+    try:
+        while True:
+            frame = frames.get()
+            if frame is None:
+                break
+            if fitter is not None:
+                frame = fitter(frame)
+            if layer is not None:
+                layer.blend(frame, scratch)
+            encoder.stdin.write(memoryview(frame))
+    except BrokenPipeError:
+        pass
+    finally:
+        stop.set()
+        # 読み込みスレッドが put で止まっていれば解放する
+        while reader.is_alive():
+            try:
+                frames.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        encoder.stdin.close()
+        stderr = encoder.stderr.read()
+        returncode = encoder.wait()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg が失敗しました: {stderr.decode(errors='replace')[-500:]}")
+
+
+def _open_video(src_path):
+    capture = cv2.VideoCapture(str(src_path))
+    if not capture.isOpened():
+        raise ValueError(f"動画を開けません: {src_path}")
+    ok, first_frame = capture.read()
+    if not ok:
+        capture.release()
+        raise ValueError(f"動画のフレームを読み込めません: {src_path}")
+    return capture, first_frame
+
+
+def video_frame_size(src_path) -> tuple[int, int]:
+    """デコードしたフレームの (幅, 高さ)。回転メタデータがあれば回転後の大きさ"""
+    capture, first_frame = _open_video(src_path)
+    capture.release()
+    return first_frame.shape[1], first_frame.shape[0]
+
+
+def _fit_for_frame(fit: FitPlan | None, first_frame) -> FitPlan | None:
+    """デコードしたフレームの大きさで plan を作り直す（回転メタデータ等でメタデータの大きさと違う場合）"""
+    if fit is None:
+        return None
+    size = first_frame.shape[1::-1]
+    if tuple(fit.src_size) == size:
+        return fit
+    return FitPlan.plan(size, fit.mode, fit.canvas_size)
+
+
+def composite_video(
+    src_path,
+    dst_path,
+    overlays,
+    resample,
+    *,
+    fit: FitPlan | None = None,
+    crf: int = 20,
+    preset: str = "veryfast",
+    audio: bool = True,
+    prefetch: int = 8,
+) -> bool:
+    """フレームを逐次デコードしてアイコンをブレンドし、パイプで ffmpeg に流して MP4 を書き出す
+
+    メモリ使用量は先読みフレーム数で決まり、動画の長さに依存しない。fit を渡すとフレームをキャンバスに
+    合わせてから（overlays の位置はキャンバスに対する座標）ブレンドする。
+    合成するアイコンが無く fit も無い場合は何も書かずに False を返す。
+    """
+    capture, first_frame = _open_video(src_path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        fit = _fit_for_frame(fit, first_frame)
+        size = fit.canvas_size if fit is not None else first_frame.shape[1::-1]
+        layer = OverlayLayer.build(overlays, size, resample)
+        if layer is None and fit is None:
+            return False
+        _stream_composite(
+            capture, first_frame, layer, dst_path, fps,
+            audio_src=src_path if audio else None, crf=crf, preset=preset, prefetch=prefetch, fit=fit,
+        )
+        return True
+    finally:
+        capture.release()
+
+
+def _composite_segment(src_path, dst_path, layer: OverlayLayer | None, fps: float, crf: int, preset: str,
+                       prefetch: int, fit: FitPlan | None = None, threads: int | None = None):
+    """ProcessPoolExecutor のワーカー: 音声なしで 1 セグメントを合成・エンコード"""
+    capture, first_frame = _open_video(src_path)
+    try:
+        _stream_composite(capture, first_frame, layer, dst_path, fps, crf=crf, preset=preset, prefetch=prefetch,
+                          fit=fit, threads=threads)
+    finally:
+        capture.release()
+    return str(dst_path)
+
+
+def _run_ffmpeg(args: list[str]):
+    result = subprocess.run([ffmpeg_exe(), "-loglevel", "error", "-y", *args], capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg が失敗しました: {result.stderr.decode(errors='replace')[-500:]}")
+
+
+def composite_video_parallel(
+    src_path,
+    dst_path,
+    overlays,
+    resample,
+    *,
+    workers: int | None = None,
+    fit: FitPlan | None = None,
+    crf: int = 20,
+    preset: str = "veryfast",
+    prefetch: int = 8,
+) -> bool:
+    """キーフレーム位置で映像を分割し、セグメントごとに別プロセスで合成・エンコードする
+
+    分割はストリームコピーなので全フレームがちょうど 1 つのセグメントに入り、
+    各セグメントを元と同じフレームレートでエンコードしてから無劣化で連結する。
+    音声は最後に元ファイルから 1 回だけ多重化する。fit は composite_video と同じ。
+    コアが PARALLEL_MIN_CORES 以下か、セグメントが SEGMENT_MIN_SECONDS より短くなる場合は分割しない
+    （libx264 自体がマルチスレッドなので、少ないコアを奪い合うとかえって遅い）。
+    """
+    cores = os.cpu_count() or 1
+    workers = workers or cores
+    if cores <= PARALLEL_MIN_CORES:
+        workers = 1
+    capture, first_frame = _open_video(src_path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        fit = _fit_for_frame(fit, first_frame)
+        size = fit.canvas_size if fit is not None else first_frame.shape[1::-1]
+        layer = OverlayLayer.build(overlays, size, resample)
+        if layer is None and fit is None:
+            return False
+        duration = frame_count / fps if frame_count else 0.0
+        workers = min(workers, int(duration // SEGMENT_MIN_SECONDS))
+        if workers <= 1:
+            _stream_composite(capture, first_frame, layer, dst_path, fps,
+                              audio_src=src_path, crf=crf, preset=preset, prefetch=prefetch, fit=fit)
+            return True
+    finally:
+        capture.release()
+
+    with tempfile.TemporaryDirectory(prefix="story_segments_") as tmpdir:
+        work = Path(tmpdir)
+        split_times = ",".join(f"{duration * i / workers:.3f}" for i in range(1, workers))
+        _run_ffmpeg([
+            "-i", str(src_path), "-map", "0:v:0", "-c", "copy",
+            "-f", "segment", "-segment_times", split_times, "-reset_timestamps", "1",
+            str(work / "src_%03d.mp4"),
+        ])
+        segments = sorted(work.glob("src_*.mp4"))
+        if len(segments) <= 1:
+            # キーフレームが足りず分割できない場合は単一プロセスで処理
+            capture, first_frame = _open_video(src_path)
+            try:
+                _stream_composite(capture, first_frame, layer, dst_path, fps,
+                                  audio_src=src_path, crf=crf, preset=preset, prefetch=prefetch, fit=fit)
+            finally:
+                capture.release()
+            return True
+
+        outputs = [work / f"out_{i:03d}.mp4" for i in range(len(segments))]
+        processes = min(workers, len(segments))
+        threads = max(1, cores // processes)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [
+                pool.submit(_composite_segment, str(seg), str(out), layer, fps, crf, preset, prefetch, fit, threads)
+                for seg, out in zip(segments, outputs)
+            ]
+            for future in futures:
+                future.result()
+
+        concat_list = work / "concat.txt"
+        concat_list.write_text("".join(f"file '{out.as_posix()}'\n" for out in outputs), encoding="utf-8")
+        _run_ffmpeg([
+            "-f", "concat", "-safe", "0", "-i", str(concat_list), "-i", str(src_path),
+            "-map", "0:v:0", "-map", "1:a:0?", "-c:v", "copy", "-c:a", "aac", "-shortest",
+            "-movflags", "+faststart", str(dst_path),
+        ])
+    return True
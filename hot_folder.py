@@ -0,0 +1,431 @@
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import select
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+from story_pipeline import PHOTO_EXTENSIONS, VIDEO_EXTENSIONS
+from upload_queue import DONE, FAILED, QUEUED
+
+logger = logging.getLogger(__name__)
+
+MEDIA_EXTENSIONS = PHOTO_EXTENSIONS + VIDEO_EXTENSIONS
+
+# 台帳の状態（QUEUED / DONE / FAILED は upload_queue と同じ）
+SKIPPED = "skipped"  # 初回起動時に既にあったファイル（process_existing=False のとき）
+DUPLICATE = "duplicate"  # 同じ内容（素材 + サイドカー）を投稿済み・投稿待ち
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT,
+    status TEXT NOT NULL,
+    job_id INTEGER,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_digest ON files (digest);
+CREATE INDEX IF NOT EXISTS files_job ON files (job_id);
+"""
+
+
+class FileLedger:
+    """監視フォルダーで見つけたファイルの処理結果を SQLite に残す（再起動しても同じファイルを再投稿しない）"""
+
+    def __init__(self, path=Path("hot_folder.sqlite3")):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def known(self) -> dict[str, tuple[int, int]]:
+        """パス -> (サイズ, 更新時刻)。起動時に 1 回だけ読み、以後はメモリ上で比べる"""
+        with self._lock:
+            rows = self._conn.execute("SELECT path, size, mtime_ns FROM files").fetchall()
+        return {path: (size, mtime_ns) for path, size, mtime_ns in rows}
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+    def find_digest(self, digest: str) -> tuple[str, str] | None:
+        """同じ内容で投稿済み・投稿待ちのもの (パス, 状態)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path, status FROM files WHERE digest = ? AND status IN (?, ?) LIMIT 1",
+                (digest, QUEUED, DONE),
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def record(self, path: str, size: int, mtime_ns: int, status: str, *, digest: str | None = None,
+               job_id: int | None = None, error: str | None = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, digest, status, job_id, error, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, digest, status, job_id, error, time.time()),
+            )
+
+    def record_many(self, rows: list[tuple[str, int, int]], status: str):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, status, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(path, size, mtime_ns, status, now) for path, size, mtime_ns in rows],
+            )
+
+    def touch(self, path: str, size: int, mtime_ns: int):
+        """内容の変わっていない（更新時刻だけ変わった）ファイルのサイズと更新時刻だけを直す"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET size = ?, mtime_ns = ?, updated_at = ? WHERE path = ?",
+                (size, mtime_ns, time.time(), path),
+            )
+
+    def finish_job(self, job_id: int, status: str, error: str | None = None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET status = ?, error = ?, updated_at = ? WHERE job_id = ? AND status = ?",
+                (status, error, time.time(), job_id, QUEUED),
+            )
+
+    def queued(self) -> list[tuple[str, int]]:
+        """投稿待ちのまま残っているもの (パス, ジョブ ID)"""
+        with self._lock:
+            return self._conn.execute("SELECT path, job_id FROM files WHERE status = ?", (QUEUED,)).fetchall()
+
+    def forget(self, path: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def counts(self) -> dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM files GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Inotify:
+    """Linux の inotify を ctypes で使う（追加の依存なし）。使えない環境では OSError"""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, directory):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify は Linux でのみ使えます")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1: {os.strerror(errno)}")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch: {os.strerror(errno)}")
+
+    def read(self, timeout: float) -> set[str] | None:
+        """timeout 秒までに変化のあったファイル名。イベントが溢れた（取りこぼした）ら None"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        names: set[str] = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + self._EVENT.size <= len(data):
+                _wd, mask, _cookie, length = self._EVENT.unpack_from(data, offset)
+                offset += self._EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                elif name:
+                    names.add(os.fsdecode(name))
+        return None if overflow else names
+
+    def close(self):
+        os.close(self.fd)
+
+
+@dataclass
+class _Candidate:
+    """書き込み中かもしれないファイル。signature が settle 秒変わらなければ書き終わったとみなす"""
+
+    signature: tuple
+    since: float
+
+
+def sidecar_for(media_path: Path) -> Path | None:
+    """素材のサイドカー JSON（a.jpg.json か a.json）"""
+    for candidate in (media_path.with_name(media_path.name + ".json"), media_path.with_suffix(".json")):
+        if candidate.is_file():
+            return candidate
+    return None
+
+
+def content_digest(media_path: Path, sidecar_path: Path | None) -> str:
+    """素材とサイドカーの内容のハッシュ（別名でコピーされた同じ素材を重複として見分ける）"""
+    digest = hashlib.sha256()
+    with media_path.open("rb") as fp:
+        digest.update(hashlib.file_digest(fp, "sha256").digest())
+    if sidecar_path is not None:
+        digest.update(sidecar_path.read_bytes())
+    return digest.hexdigest()
+
+
+class HotFolder:
+    """フォルダーに置かれた素材を見つけ、書き込みが終わったものを submit に渡す
+
+    submit(素材のパス, サイドカーのパス or None) -> ジョブ ID。投稿が終わったら finished(ジョブ ID, 状態, エラー)
+    を呼んでもらう。投稿待ちは max_pending 件までにし、それ以上は見つけた順に待たせる。
+    変化の検知は inotify（Linux）、使えないか use_inotify=False なら poll_interval ごとの走査。inotify でも
+    ネットワーク越しの書き込みは通知されないことがあるので rescan_interval ごとに走査する。走査は
+    ファイル名・サイズ・更新時刻を台帳（起動時に読んだもの）と比べるだけで、中身を読むのは新しいファイルだけ。
+    台帳が空の初回起動では、process_existing=False なら既にあるファイルを投稿せずに台帳に載せる。
+    """
+
+    def __init__(self, directory, ledger: FileLedger, submit, *, settle_seconds: float = 2.0,
+                 poll_interval: float = 2.0, rescan_interval: float = 300.0, use_inotify: bool = True,
+                 max_pending: int = 8, process_existing: bool = False, job_status=None, clock=time.monotonic):
+        self.directory = Path(directory).resolve()
+        self.ledger = ledger
+        self.submit = submit
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.use_inotify = use_inotify
+        self.max_pending = max(1, max_pending)
+        self.process_existing = process_existing
+        # job_status(ジョブ ID) -> 状態 or None。前回の投稿待ちが終わったかを起動時に確かめる
+        self.job_status = job_status
+        self.clock = clock
+        self.inotify: Inotify | None = None
+        self.watcher = "polling"
+        self.scans = 0
+        self.submitted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self._known: dict[str, tuple[int, int]] = {}
+        self._candidates: dict[str, _Candidate] = {}
+        self._ready: OrderedDict[str, None] = OrderedDict()
+        self._pending: set[int] = set()
+        self._lock = threading.Lock()
+
+    def _media_name(self, name: str) -> str | None:
+        """変化のあったファイル名から素材のファイル名を返す（サイドカーなら対応する素材）"""
+        if name.startswith("."):
+            return None
+        lower = name.lower()
+        if lower.endswith(MEDIA_EXTENSIONS):
+            return name
+        if lower.endswith(".json"):
+            stem = name[:-5]
+            if stem.lower().endswith(MEDIA_EXTENSIONS):
+                return stem
+            for ext in MEDIA_EXTENSIONS:
+                if (self.directory / (stem + ext)).exists():
+                    return stem + ext
+        return None
+
+    def _signature(self, path: Path, stat: os.stat_result) -> tuple:
+        sidecar = sidecar_for(path)
+        sidecar_stat = sidecar.stat() if sidecar is not None else None
+        return (stat.st_size, stat.st_mtime_ns,
+                (sidecar_stat.st_size, sidecar_stat.st_mtime_ns) if sidecar_stat else None)
+
+    def _observe(self, name: str, now: float, stat: os.stat_result | None = None):
+        """素材の変化を記録する。台帳と同じ（処理済み）なら何もしない"""
+        path = self.directory / name
+        try:
+            stat = stat or path.stat()
+        except FileNotFoundError:
+            self._candidates.pop(name, None)
+            return
+        key = str(path)
+        if self._known.get(key) == (stat.st_size, stat.st_mtime_ns) or key in self._ready:
+            return
+        signature = self._signature(path, stat)
+        candidate = self._candidates.get(name)
+        if candidate is None or candidate.signature != signature:
+            self._candidates[name] = _Candidate(signature, now)
+
+    def _media_entries(self):
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.startswith(".") and entry.name.lower().endswith(MEDIA_EXTENSIONS) and entry.is_file():
+                    yield entry
+
+    def scan(self, now: float | None = None):
+        """フォルダー全体を走査する（起動時・ポーリング・取りこぼしの補完）"""
+        now = self.clock() if now is None else now
+        self.scans += 1
+        for entry in self._media_entries():
+            self._observe(entry.name, now, entry.stat())
+
+    def _baseline(self):
+        """初回起動: 既にあるファイルを投稿せずに台帳に載せる"""
+        rows = []
+        for entry in self._media_entries():
+            stat = entry.stat()
+            rows.append((str(self.directory / entry.name), stat.st_size, stat.st_mtime_ns))
+        self.ledger.record_many(rows, SKIPPED)
+        logger.info(f"hot folder: {len(rows)} existing files recorded as skipped")
+
+    def _resume(self):
+        """前回投稿待ちだったものを、ジョブの状態に合わせて台帳に反映する（ジョブが無ければ見つけ直す）"""
+        for path, job_id in self.ledger.queued():
+            status = self.job_status(job_id) if self.job_status and job_id is not None else None
+            if status in (DONE, FAILED):
+                self.ledger.finish_job(job_id, status)
+            elif status is None:
+                self.ledger.forget(path)
+            else:
+                self._pending.add(job_id)
+
+    def start(self):
+        if self.ledger.is_empty() and not self.process_existing:
+            self._baseline()
+        self._resume()
+        self._known = self.ledger.known()
+        if self.use_inotify:
+            try:
+                self.inotify = Inotify(self.directory)
+                self.watcher = "inotify"
+            except OSError as e:
+                logger.info(f"hot folder: inotify unavailable, polling every {self.poll_interval:g}s: {e}")
+        self.scan()
+
+    def finished(self, job_id: int, status: str, error: str | None = None):
+        """投稿が終わったジョブを台帳に反映する（キューのワーカースレッドから呼ばれる）"""
+        with self._lock:
+            self._pending.discard(job_id)
+        self.ledger.finish_job(job_id, status, error)
+
+    def _settled(self, now: float):
+        """signature が settle 秒変わっていない候補を投稿待ちの列に移す"""
+        for name, candidate in list(self._candidates.items()):
+            path = self.directory / name
+            try:
+                signature = self._signature(path, path.stat())
+            except FileNotFoundError:
+                del self._candidates[name]
+                continue
+            if signature != candidate.signature:
+                # inotify で拾えない書き込み（ネットワーク越し等）もここで気付く
+                self._candidates[name] = _Candidate(signature, now)
+            elif now - candidate.since >= self.settle_seconds:
+                del self._candidates[name]
+                self._ready[str(path)] = None
+
+    def _dispatch(self):
+        """投稿待ちが max_pending 件に満たない分だけ、見つけた順に submit する"""
+        while self._ready:
+            with self._lock:
+                if len(self._pending) >= self.max_pending:
+                    return
+            key, _ = self._ready.popitem(last=False)
+            path = Path(key)
+            try:
+                stat = path.stat()
+                sidecar = sidecar_for(path)
+                digest = content_digest(path, sidecar)
+            except OSError as e:
+                logger.info(f"hot folder: {path.name} disappeared: {e}")
+                continue
+            self._known[key] = (stat.st_size, stat.st_mtime_ns)
+            duplicate = self.ledger.find_digest(digest)
+            if duplicate is not None:
+                self.duplicates += 1
+                if duplicate[0] == key:
+                    # 上書き保存されたが中身は同じ
+                    self.ledger.touch(key, stat.st_size, stat.st_mtime_ns)
+                    continue
+                logger.info(f"hot folder: {path.name} is a duplicate of {Path(duplicate[0]).name}")
+                self.ledger.record(key, stat.st_size, stat.st_mtime_ns, DUPLICATE, digest=digest,
+                                   error=f"{duplicate[0]} と同じ内容")
+                continue
+            try:
+                # 台帳に載せ終わる前にジョブが終わっても finished が取りこぼさないように、まとめてロックする
+                with self._lock:
+                    job_id = self.submit(path, sidecar)
+                    self._pending.add(job_id)
+                    self.ledger.record(key, stat.st_size, stat.st_mtime_ns, QUEUED, digest=digest, job_id=job_id)
+            except Exception as e:
+                self.failed += 1
+                logger.info(f"hot folder: {path.name} rejected: {e}")
+                self.ledger.record(key, stat.st_size, stat.st_mtime_ns, FAILED, digest=digest, error=str(e))
+                continue
+            self.submitted += 1
+
+    def run(self, stop: threading.Event):
+        """stop がセットされるまで監視する（start のあとで呼ぶ）"""
+        now = self.clock()
+        next_scan = now + (self.rescan_interval if self.inotify else self.poll_interval)
+        try:
+            while not stop.is_set():
+                # 書き込み中の候補があれば settle を細かく確かめる
+                timeout = min(self.poll_interval, self.settle_seconds / 2 if self._candidates else 1.0)
+                if self.inotify is not None:
+                    names = self.inotify.read(timeout)
+                else:
+                    stop.wait(timeout)
+                    names = set()
+                now = self.clock()
+                if names is None or now >= next_scan:
+                    self.scan(now)
+                    next_scan = now + (self.rescan_interval if self.inotify else self.poll_interval)
+                else:
+                    for name in names:
+                        media = self._media_name(name)
+                        if media is not None:
+                            self._observe(media, now)
+                self._settled(now)
+                self._dispatch()
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "watcher": self.watcher,
+            "scans": self.scans,
+            "writing": len(self._candidates),
+            "waiting": len(self._ready),
+            "pending": pending,
+            "submitted": self.submitted,
+            "duplicates": self.duplicates,
+            "rejected": self.failed,
+        }
@@ -0,0 +1,87 @@
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+class IconCache:
+    """Link 用アイコンを RGBA に変換・縮小した結果の LRU キャッシュ（プレビュー・写真・動画の合成で共用）
+
+    キーは (絶対パス, 更新時刻, 出力サイズ, 補間フィルタ)。変換後のフルサイズ画像も持つので、
+    サイズだけ変わった場合はデコードを省ける。返す画像は共有なので呼び出し側で書き換えないこと。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, Image.Image] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cost(image: Image.Image) -> int:
+        return image.width * image.height * len(image.getbands())
+
+    def _lookup(self, key):
+        image = self._entries.get(key)
+        if image is not None:
+            self._entries.move_to_end(key)
+        return image
+
+    def _store(self, key, image: Image.Image):
+        cost = self._cost(image)
+        if cost > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= self._cost(old)
+        self._entries[key] = image
+        self._bytes += cost
+        while self._bytes > self.max_bytes and self._entries:
+            _key, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._cost(evicted)
+
+    def get(self, path, size: tuple[int, int], resample) -> Image.Image:
+        """path のアイコンを RGBA にして size に縮小した画像"""
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        size = (max(1, int(size[0])), max(1, int(size[1])))
+        key = (path, mtime, size, resample)
+        source_key = (path, mtime, None, None)
+        with self._lock:
+            image = self._lookup(key)
+            if image is not None:
+                self.hits += 1
+                return image
+            self.misses += 1
+            source = self._lookup(source_key)
+        if source is None:
+            with Image.open(path) as icon_img:
+                source = icon_img.convert("RGBA")
+        image = source if source.size == size else source.resize(size, resample)
+        with self._lock:
+            self._store(source_key, source)
+            self._store(key, image)
+        return image
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+# プロセス内で共有するキャッシュ（動画の並列エンコードのワーカーはプロセスごとに持つ）
+icon_cache = IconCache()
@@ -0,0 +1,299 @@
+import threading
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from pacing import RequestPacer
+
+# instagrapi (and moviepy through StoryBuilder) and pydantic are imported when the first Client is
+# created, so the GUI and the CLI can start without paying for them.
+_instagrapi_patched = False
+_instagrapi_patch_lock = threading.Lock()
+_orig_photo_upload_to_story = None
+_orig_prepare_image = None
+_orig_video_rupload = None
+_orig_send_private_request = None
+_orig_send_public_request = None
+# Set while a paced request is inside instagrapi's _send_*_request, whose only sleeps are the fixed
+# request_timeout / "1 s since the last response" delays the pacer replaces
+_pacing = threading.local()
+
+
+# Monkey patch: allow StoryBuilder(photo) that outputs MP4 to be routed to video upload
+def _patched_photo_upload_to_story(
+    self,
+    path: Path,
+    caption: str = "",
+    upload_id: str = "",
+    mentions=None,
+    locations=None,
+    links=None,
+    hashtags=None,
+    stickers=None,
+    medias=None,
+    polls=None,
+    extra_data=None,
+):
+    # Normalize optional lists to avoid mutable default pitfalls
+    mentions = mentions or []
+    locations = locations or []
+    links = links or []
+    hashtags = hashtags or []
+    stickers = stickers or []
+    medias = medias or []
+    polls = polls or []
+    extra_data = extra_data or {}
+
+    file_path = Path(path)
+    # If StoryBuilder produced an MP4 (e.g., due to processing), delegate to video upload
+    if file_path.suffix.lower() == ".mp4":
+        return self.video_upload_to_story(
+            file_path,
+            caption=caption,
+            mentions=mentions,
+            locations=locations,
+            links=links,
+            hashtags=hashtags,
+            stickers=stickers,
+            medias=medias,
+            polls=polls,
+            extra_data=extra_data,
+        )
+
+    return _orig_photo_upload_to_story(
+        self,
+        file_path,
+        caption=caption,
+        upload_id=upload_id,
+        mentions=mentions,
+        locations=locations,
+        links=links,
+        hashtags=hashtags,
+        stickers=stickers,
+        medias=medias,
+        polls=polls,
+        extra_data=extra_data,
+    )
+
+
+# Monkey patch: send story-ready JPEGs as-is instead of re-encoding them at Pillow's default quality
+def _patched_prepare_image(img, max_size=(1080, 1350), aspect_ratios=(4.0 / 5.0, 90.0 / 47.0), save_path=None, **kwargs):
+    from instagrapi.image_util import calc_crop, calc_resize, is_remote
+
+    min_size = kwargs.get("min_size", (320, 167))
+    file_path = Path(str(img))
+    if save_path is None and not is_remote(str(img)) and file_path.suffix.lower() in (".jpg", ".jpeg"):
+        with Image.open(file_path) as im:
+            fmt, mode, size = im.format, im.mode, im.size
+        if (
+            fmt == "JPEG"
+            and mode == "RGB"
+            and not calc_crop(aspect_ratios, size)
+            and not calc_resize(max_size, size, min_size=min_size)
+        ):
+            # Already within size/ratio limits: keep our byte-budgeted encoding
+            return file_path.read_bytes(), size
+    return _orig_prepare_image(img, max_size=max_size, aspect_ratios=aspect_ratios, save_path=save_path, **kwargs)
+
+
+# Monkey patch: upload videos in a resumable way (checkpointed offset, retry with backoff, progress events)
+def _patched_video_rupload(self, path: Path, thumbnail: Path = None, to_album: bool = False,
+                           to_story: bool = False, to_direct: bool = False) -> tuple:
+    if not getattr(self, "resumable_upload", False):
+        return _orig_video_rupload(self, path, thumbnail, to_album=to_album, to_story=to_story, to_direct=to_direct)
+
+    import json
+    import random
+    import time
+    from uuid import uuid4
+
+    from instagrapi import config
+    from instagrapi.exceptions import VideoNotUpload
+    from instagrapi.mixins.video import analyze_video
+
+    from resumable_upload import Checkpoint, ResumableUploader, UploadFailed
+
+    assert isinstance(path, Path), f"Path must been Path, now {path} ({type(path)})"
+    checkpoint = None
+    state = {}
+    checkpoint_dir = getattr(self, "upload_checkpoint_dir", None)
+    if checkpoint_dir is not None:
+        # Same file and account as an interrupted upload: reuse its upload name so the server-side offset applies
+        checkpoint = Checkpoint(checkpoint_dir, path, scope=str(self.user_id))
+        state = checkpoint.load() or {}
+    upload_id = state.get("upload_id") or str(int(time.time() * 1000))
+    upload_name = state.get("upload_name") or "{upload_id}_0_{rand}".format(
+        upload_id=upload_id, rand=random.randint(1000000000, 9999999999)
+    )
+    waterfall_id = state.get("waterfall_id") or str(uuid4())
+    width, height, duration, thumbnail = analyze_video(path, thumbnail)
+    rupload_params = {
+        "retry_context": '{"num_step_auto_retry":0,"num_reupload":0,"num_step_manual_retry":0}',
+        "media_type": "2",
+        "xsharing_user_ids": json.dumps([self.user_id]),
+        "upload_id": upload_id,
+        "upload_media_duration_ms": str(int(duration * 1000)),
+        "upload_media_width": str(width),
+        "upload_media_height": str(height),
+    }
+    if to_direct:
+        rupload_params["direct_v2"] = "1"
+    if to_album:
+        rupload_params["is_sidecar"] = "1"
+    if to_story:
+        rupload_params = {
+            "extract_cover_frame": "1",
+            "content_tags": "has-overlay",
+            "for_album": "1",
+            **rupload_params,
+        }
+    headers = {
+        "Accept-Encoding": "gzip, deflate",
+        "X-Instagram-Rupload-Params": json.dumps(rupload_params),
+        "X_FB_VIDEO_WATERFALL_ID": waterfall_id,
+        "X-Entity-Name": upload_name,
+        "X-Entity-Type": "video/mp4",
+    }
+    if to_album:
+        headers = {"Segment-Start-Offset": "0", "Segment-Type": "3", **headers}
+    if checkpoint is not None:
+        checkpoint.save(upload_id=upload_id, upload_name=upload_name, waterfall_id=waterfall_id)
+    uploader = ResumableUploader(
+        self.private,
+        "https://{domain}/rupload_igvideo/{name}".format(domain=config.API_DOMAIN, name=upload_name),
+        path,
+        headers,
+        on_progress=getattr(self, "upload_progress", None),
+        checkpoint=checkpoint,
+    )
+    try:
+        uploader.upload()
+    except UploadFailed as e:
+        raise VideoNotUpload(str(e), response=e.response, **self.last_json) from e
+    finally:
+        if uploader.last_response is not None:
+            self.request_log(uploader.last_response)
+    return upload_id, width, height, duration, Path(thumbnail)
+
+
+def _throttle_signal(error) -> tuple[bool, float | None]:
+    """Whether an instagrapi error means "slow down", and the server's Retry-After if it sent one"""
+    from instagrapi.exceptions import ClientThrottledError, FeedbackRequired, PleaseWaitFewMinutes, RateLimitError
+
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    throttled = isinstance(error, (ClientThrottledError, PleaseWaitFewMinutes, RateLimitError, FeedbackRequired))
+    if not throttled and status != 429:
+        return False, None
+    try:
+        retry_after = float(response.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        retry_after = None
+    return True, retry_after
+
+
+class _PacedTime:
+    """Stand-in for the `time` module inside instagrapi's private/public mixins: sleep() is a no-op while
+    a paced request is being sent. request_timeout itself is left alone because instagrapi also passes it
+    as the requests timeout= for downloads and password resets, where 0 is rejected."""
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        if not getattr(_pacing, "active", False):
+            time.sleep(seconds)
+
+
+def _paced(pacer, endpoint_class: str, send):
+    bucket = pacer.bucket(endpoint_class)
+    bucket.acquire()
+    started = time.monotonic()
+    _pacing.active = True
+    try:
+        result = send()
+    except Exception as e:
+        throttled, retry_after = _throttle_signal(e)
+        if throttled:
+            bucket.on_throttle(retry_after)
+        raise
+    finally:
+        _pacing.active = False
+    bucket.on_success(time.monotonic() - started)
+    return result
+
+
+# Monkey patch: pace every private API call through the client's adaptive token bucket (replaces the fixed
+# delay_range / request_timeout sleeps) and feed latency and throttling back into it
+def _patched_send_private_request(self, endpoint, *args, **kwargs):
+    pacer = getattr(self, "pacer", None)
+    if pacer is None:
+        return _orig_send_private_request(self, endpoint, *args, **kwargs)
+    from pacing import classify_endpoint
+
+    data = kwargs.get("data", args[0] if args else None)
+    login = kwargs.get("login", args[2] if len(args) > 2 else False)
+    return _paced(pacer, classify_endpoint(endpoint, data, login),
+                  lambda: _orig_send_private_request(self, endpoint, *args, **kwargs))
+
+
+# Monkey patch: same pacing for the public (web) API fallbacks, as one "public" class
+def _patched_send_public_request(self, url, *args, **kwargs):
+    pacer = getattr(self, "pacer", None)
+    if pacer is None:
+        return _orig_send_public_request(self, url, *args, **kwargs)
+    return _paced(pacer, "public", lambda: _orig_send_public_request(self, url, *args, **kwargs))
+
+
+def _install_instagrapi_patches():
+    """Apply the monkey patches once, right before the first Client is created"""
+    global _instagrapi_patched, _orig_photo_upload_to_story, _orig_prepare_image, _orig_video_rupload
+    global _orig_send_private_request, _orig_send_public_request
+    with _instagrapi_patch_lock:
+        if _instagrapi_patched:
+            return
+        from instagrapi.mixins import photo as ig_photo
+
+        _orig_photo_upload_to_story = ig_photo.UploadPhotoMixin.photo_upload_to_story
+        ig_photo.UploadPhotoMixin.photo_upload_to_story = _patched_photo_upload_to_story
+        _orig_prepare_image = ig_photo.prepare_image
+        ig_photo.prepare_image = _patched_prepare_image
+        from instagrapi.mixins import video as ig_video
+
+        _orig_video_rupload = ig_video.UploadVideoMixin.video_rupload
+        ig_video.UploadVideoMixin.video_rupload = _patched_video_rupload
+        from instagrapi.mixins import private as ig_private
+        from instagrapi.mixins import public as ig_public
+
+        _orig_send_private_request = ig_private.PrivateRequestMixin._send_private_request
+        ig_private.PrivateRequestMixin._send_private_request = _patched_send_private_request
+        _orig_send_public_request = ig_public.PublicRequestMixin._send_public_request
+        ig_public.PublicRequestMixin._send_public_request = _patched_send_public_request
+        ig_private.time = ig_public.time = _PacedTime()
+        _instagrapi_patched = True
+
+
+def create_client():
+    """instagrapi を読み込み、パッチを当ててから Client を作る"""
+    _install_instagrapi_patches()
+    from instagrapi import Client
+
+    return Client()
+
+
+def new_client(pacer: RequestPacer | None = None):
+    """アプリ共通の設定を済ませた Client
+
+    API 呼び出しの間隔は固定の待ち（delay_range / request_timeout の sleep）ではなく、アカウントごとの
+    RequestPacer が応答時間とスロットリングを見て決める（request_timeout はダウンロード等のタイムアウトにも
+    使われるので値は変えない）。client.pacer.stats() で現在のレートが分かる。
+    """
+    client = create_client()
+    client.delay_range = None
+    client.pacer = pacer or RequestPacer()
+    # 動画は再開可能なアップロードで送る。upload_progress(UploadProgress) を設定すると進捗が届く
+    client.resumable_upload = True
+    client.upload_checkpoint_dir = Path("upload_checkpoints")
+    client.upload_progress = None
+    return client
@@ -1,107 +1,101 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog, ttk
-from instagrapi import Client
-from instagrapi.mixins import photo as ig_photo
-from instagrapi.story import StoryBuilder
-from instagrapi.types import StoryLink
-from PIL import Image, ImageTk, ImageDraw
 import threading
+import multiprocessing
 import os
 from pathlib import Path
-from instagrapi.exceptions import LoginRequired, ChallengeRequired, TwoFactorRequired
 import logging
-from typing import cast
-from pydantic import HttpUrl
-import tempfile
-
-# Monkey patch: allow StoryBuilder(photo) that outputs MP4 to be routed to video upload
-_orig_photo_upload_to_story = ig_photo.UploadPhotoMixin.photo_upload_to_story
-
-
-def _patched_photo_upload_to_story(
-    self,
-    path: Path,
-    caption: str = "",
-    upload_id: str = "",
-    mentions=None,
-    locations=None,
-    links=None,
-    hashtags=None,
-    stickers=None,
-    medias=None,
-    polls=None,
-    extra_data=None,
-):
-    # Normalize optional lists to avoid mutable default pitfalls
-    mentions = mentions or []
-    locations = locations or []
-    links = links or []
-    hashtags = hashtags or []
-    stickers = stickers or []
-    medias = medias or []
-    polls = polls or []
-    extra_data = extra_data or {}
-
-    file_path = Path(path)
-    # If StoryBuilder produced an MP4 (e.g., due to processing), delegate to video upload
-    if file_path.suffix.lower() == ".mp4":
-        return self.video_upload_to_story(
-            file_path,
-            caption=caption,
-            mentions=mentions,
-            locations=locations,
-            links=links,
-            hashtags=hashtags,
-            stickers=stickers,
-            medias=medias,
-            polls=polls,
-            extra_data=extra_data,
-        )
+from preview import RefreshScheduler, ThumbnailCache, VideoFrameSource
+from preview_canvas import PreviewCanvas
+from photo_story import JpegSettings, decode_budget
+from autofit import BLUR, CROP, LETTERBOX
+from accounts import AccountPool
+from icon_cache import icon_cache
+from media_cache import PreparedMediaCache
+from story_pipeline import (
+    DEFAULT_LINK_GEOM,
+    PreparedStory,
+    StoryOptions,
+    default_encode_workers,
+    default_resample,
+    link_overlays,
+    prepare_story_cached,
+    upload_to_accounts,
+)
+from upload_queue import DONE, FAILED, JobStore, UploadQueue
+from ui_events import ERROR, FINISHED, PROGRESS, STARTED, EventBus
+from perf_log import PerfLog
+# instagrapi (and moviepy through StoryBuilder), pydantic and OpenCV are imported on first use
+# (login, upload, preview) so the window can appear without paying for them.
+from ig_client import new_client
+
+QUEUE_STATUS_LABELS = {
+    "queued": "待機中",
+    "preparing": "準備中",
+    "prepared": "準備完了",
+    "uploading": "アップロード中",
+    "done": "完了",
+    "failed": "失敗",
+}
 
-    return _orig_photo_upload_to_story(
-        self,
-        file_path,
-        caption=caption,
-        upload_id=upload_id,
-        mentions=mentions,
-        locations=locations,
-        links=links,
-        hashtags=hashtags,
-        stickers=stickers,
-        medias=medias,
-        polls=polls,
-        extra_data=extra_data,
-    )
-
-
-# Apply monkey patch
-ig_photo.UploadPhotoMixin.photo_upload_to_story = _patched_photo_upload_to_story
 
 class StoryUploader:
     def __init__(self, root):
         self.root = root
         self.root.title("Instagram Story Uploader")
-        self.root.geometry("600x800")
+        self.root.geometry("600x900")
         
-        self.cl = Client()
-        self.cl.delay_range = [1, 4]
+        # session.json と sessions/*.json の各アカウント。ttl 秒以内に確認済みなら起動時の確認を省略し、
+        # Client は初回利用時に生成する（instagrapi の import が重いため）。
+        # 同じアカウントへの連続投稿は min_upload_interval 秒空ける
+        self.accounts = AccountPool(new_client, ttl=6 * 3600, min_upload_interval=30.0)
+        # 投稿先のチェック状態（キーはセッションファイルのパス）
+        self.account_vars: dict[str, tk.BooleanVar] = {}
         self.logged_in = False
+        self._session_generation = 0
         self.selected_file_path = None
         self.status_text = "ログインしてください"
-        self.default_link_geom = {
-            "x": 0.5126011,
-            "y": 0.5168225,
-            "w": 0.50998676,
-            "h": 0.25875,
-        }
+        self.default_link_geom = dict(DEFAULT_LINK_GEOM)
         self.link_rows = []
         self.preview_max_size = (320, 220)
-        resampling = getattr(Image, "Resampling", Image)
-        self.resample_filter = getattr(resampling, "LANCZOS", getattr(resampling, "BICUBIC", getattr(resampling, "NEAREST", 0)))
+        self.resample_filter = default_resample()
+        self.thumbnail_cache = ThumbnailCache(self.preview_max_size, self.resample_filter)
+        # キー入力やスライダー操作の連打を 1 回の描画にまとめる待ち時間 (ms)
+        self.preview_debounce_ms = 50
+        self.preview_scheduler = RefreshScheduler(self.root, self._render_preview, self.preview_debounce_ms)
+        self.video_source = None
+        # 動画焼き込みのセグメント並列エンコードに使うプロセス数（1 で単一プロセス）
+        self.encode_workers = default_encode_workers()
+        # 写真ストーリーの生成方法: "direct"（Pillow で JPEG）/ "builder"（StoryBuilder で MP4 化）
+        self.photo_story_mode = "direct"
+        # 縦横比が 9:16 でない素材の合わせ方（autofit.FIT_MODES）。Link の位置は素材に対する座標のまま直す
+        self.fit_mode = LETTERBOX
+        # 写真ストーリーの JPEG 設定（アップロードごとに変更可。max_bytes=None で上限なし）
+        self.photo_jpeg = JpegSettings(max_bytes=1_000_000, min_quality=70)
+        # アップロードキュー（queue.sqlite3 に保存し、再起動後も続きから処理する）。
+        # 前処理は prepare_workers 並列で先行し、投稿は 1 本のスレッドで追加順に行う
+        self.queue_work_dir = Path("queue_media")
+        # 加工済み素材のキャッシュ（同じ入力の再試行・再投稿では合成とエンコードを省く）
+        self.media_cache = PreparedMediaCache(Path("media_cache"), max_bytes=2 * 1024 ** 3)
+        # ワーカースレッドからの UI 更新はここに送り、メインスレッドで 50ms ごとにまとめて反映する
+        self.events = EventBus(self.root.after, interval_ms=50)
+        # ジョブごとの段別の計測（logs/perf.jsonl にローテーションしながら書く）
+        self.perf = PerfLog(Path("logs/perf.jsonl"))
+        self.upload_queue = UploadQueue(
+            JobStore(Path("queue.sqlite3")), self._prepare_job, self._upload_job,
+            prepare_workers=2, on_change=self._on_queue_changed, perf=self.perf,
+        )
+        self.queue_jobs = []
+        self.queue_display_limit = 50
         
-        # UI 構築後にセッションを読み込み、表示を更新
+        # UI 構築後にセッションを読み込み、表示を更新（ネットワーク確認は裏で行うので待たない）
         self.setup_ui()
+        for kind in (STARTED, PROGRESS, FINISHED, ERROR):
+            self.events.subscribe(kind, self._on_status_event)
+        self.events.start()
         self.load_session()
+        self._refresh_queue_list()
+        self.upload_queue.start()
         if hasattr(self, "status_label"):
             self.status_label.config(
                 text=self.status_text,
@@ -163,8 +157,14 @@ class StoryUploader:
         h_var = tk.DoubleVar(value=self.default_link_geom["h"])
 
         def on_scale_change(var, entry):
-            entry.delete(0, tk.END)
-            entry.insert(0, f"{var.get():.4f}")
+            try:
+                # 入力欄やプレビューから反映された値ならスライダーの刻みで丸め直さない
+                in_sync = abs(float(entry.get()) - var.get()) < 0.005
+            except ValueError:
+                in_sync = False
+            if not in_sync:
+                entry.delete(0, tk.END)
+                entry.insert(0, f"{var.get():.4f}")
             self.refresh_preview()
 
         def bind_entry(entry, var):
@@ -229,41 +229,150 @@ class StoryUploader:
         last["frame"].destroy()
         self.refresh_preview()
 
-    def refresh_preview(self):
+    def refresh_preview(self, _event=None):
+        """プレビュー更新を予約（短時間の連続要求は 1 回にまとめる）"""
+        self.preview_scheduler.debounce_ms = self.preview_debounce_ms
+        self.preview_scheduler.request()
+
+    @property
+    def preview_renders_skipped(self) -> int:
+        return self.preview_scheduler.skipped
+
+    def _render_preview(self):
         if self.selected_file_path:
             self.show_preview(self.selected_file_path)
+
+    def _preview_boxes(self) -> dict[int, tuple[float, float, float, float]]:
+        """URL が入力されている行の当たり判定（正規化座標）"""
+        boxes = {}
+        for index, row in enumerate(self.link_rows):
+            url = row["url"].get().strip()
+            if not url or url == "https://":
+                continue
+            try:
+                boxes[index] = (
+                    float(row["x"].get() or self.default_link_geom["x"]),
+                    float(row["y"].get() or self.default_link_geom["y"]),
+                    float(row["w"].get() or self.default_link_geom["w"]),
+                    float(row["h"].get() or self.default_link_geom["h"]),
+                )
+            except ValueError:
+                continue
+        return boxes
+
+    def _sync_preview_boxes(self):
+        boxes = self._preview_boxes()
+        icons = {
+            index: icon_path for index in boxes
+            if (icon_path := self.link_rows[index]["icon_var"].get().strip())
+        }
+        self.preview_canvas.sync_boxes(boxes, icons)
+
+    def _on_preview_box_changed(self, index: int, geom: tuple[float, float, float, float]):
+        """プレビュー上で枠を動かしたら X/Y/幅/高さ 欄へ反映"""
+        if index >= len(self.link_rows):
+            return
+        row = self.link_rows[index]
+        for key, value in zip(("x", "y", "w", "h"), geom):
+            row[key].delete(0, tk.END)
+            row[key].insert(0, f"{value:.4f}")
+        row["w_var"].set(geom[2])
+        row["h_var"].set(geom[3])
     
     def load_session(self):
-        """保存されたセッションの読み込みを試行"""
+        """保存されたセッションとキャッシュ済みのアカウント情報からすぐに表示
+
+        Client の生成とネットワークでの有効性確認は、TTL を過ぎているアカウントだけバックグラウンドで行う。
+        """
+        generation = self._session_generation
+        for account in self.accounts.load():
+            info = account.store.load_info()
+            if account.store.is_fresh(info):
+                account.valid = True
+                continue
+            threading.Thread(target=self._validate_session, args=(account, generation), daemon=True).start()
+        self._update_account_status()
+        if not self.logged_in and self.accounts.accounts():
+            self.status_text = "セッション確認中..."
+
+    def _validate_session(self, account, generation: int):
+        """セッションが有効か確認（バックグラウンドスレッド）"""
         logger = logging.getLogger()
-        session_path = Path("session.json")
-        self.status_text = "ログインしてください"
-        self.logged_in = False
+        try:
+            from instagrapi.exceptions import LoginRequired
+
+            account.client.get_timeline_feed()
+            user_info = account.client.account_info()
+        except LoginRequired:
+            logger.info(f"Session is invalid, need to login: {account.key}")
+            old_session = account.client.get_settings()
+            account.client.set_settings({})
+            account.client.set_uuids(old_session.get("uuids", {}))
+            account.valid = False
+            self._apply_session_status(generation)
+            return
+        except Exception as e:
+            logger.info(f"Couldn't validate session: {e}")
+            # オフライン等で確認できないだけなら、キャッシュ済みの情報のまま使う（未確認扱い）
+            account.valid = None if account.store.load_info() else False
+            self._apply_session_status(generation)
+            return
+        account.store.save_info(user_info.username)
+        account.valid = True
+        self._apply_session_status(generation)
+
+    def _apply_session_status(self, generation: int):
+        def apply():
+            # 確認中にログイン/ログアウトされていたら結果は捨てる
+            if generation != self._session_generation:
+                return
+            self._update_account_status()
+        self.events.call(apply)
+
+    def _update_account_status(self):
+        """アカウントの状態からステータス表示と投稿先一覧を作り直す"""
+        names = []
+        for account in self.accounts.accounts():
+            if account.valid is False or not account.store.load_info():
+                continue
+            names.append(account.username if account.valid else f"{account.username} (未確認)")
+        self.logged_in = bool(names)
+        if names:
+            self.status_text = f"ログイン済み: {', '.join(names)}"
+        elif any(account.valid is False for account in self.accounts.accounts()):
+            self.status_text = "セッションが無効です。再ログインしてください"
+        else:
+            self.status_text = "ログインしてください"
+        if hasattr(self, "status_label"):
+            self.status_label.config(text=self.status_text, fg="green" if self.logged_in else "blue")
+        self._refresh_account_list()
 
-        if session_path.exists():
-            try:
-                session = self.cl.load_settings(session_path)
-                if session:
-                    self.cl.set_settings(session)
-                    try:
-                        # セッションが有効か確認
-                        self.cl.get_timeline_feed()
-                        user_info = self.cl.account_info()
-                        self.logged_in = True
-                        self.status_text = f"ログイン済み: {user_info.username}"
-                        return
-                    except LoginRequired:
-                        logger.info("Session is invalid, need to login")
-                        old_session = self.cl.get_settings()
-                        self.cl.set_settings({})
-                        self.cl.set_uuids(old_session.get("uuids", {}))
-                        self.status_text = "セッションが無効です。再ログインしてください"
-                        self.logged_in = False
-                        return
-            except Exception as e:
-                logger.info(f"Couldn't login using session: {e}")
-                self.status_text = "セッション復元失敗。ログインしてください"
-                self.logged_in = False
+    def _refresh_account_list(self):
+        if not hasattr(self, "accounts_frame"):
+            return
+        for child in self.accounts_frame.winfo_children():
+            child.destroy()
+        accounts = self.accounts.accounts()
+        for key in list(self.account_vars):
+            if self.accounts.get(key) is None:
+                del self.account_vars[key]
+        for account in accounts:
+            var = self.account_vars.get(account.key)
+            if var is None:
+                # 既定では 1 アカウントだけに投稿する
+                var = tk.BooleanVar(value=not any(v.get() for v in self.account_vars.values()))
+                self.account_vars[account.key] = var
+            label = account.username if account.valid is not False else f"{account.username} (要再ログイン)"
+            tk.Checkbutton(self.accounts_frame, text=label, variable=var,
+                           state=tk.NORMAL if account.valid is not False else tk.DISABLED).pack(side=tk.LEFT)
+        if not accounts:
+            tk.Label(self.accounts_frame, text="(ログインしてください)", fg="gray", font=("Arial", 8)).pack(side=tk.LEFT)
+
+    def _selected_accounts(self) -> list[str]:
+        return [
+            key for key, var in self.account_vars.items()
+            if var.get() and (account := self.accounts.get(key)) is not None and account.valid is not False
+        ]
     
     def setup_ui(self):
         # メニューバー
@@ -272,8 +381,27 @@ class StoryUploader:
         
         account_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="アカウント", menu=account_menu)
-        account_menu.add_command(label="ログイン", command=self.login_popup)
-        account_menu.add_command(label="ログアウト", command=self.logout)
+        account_menu.add_command(label="ログイン（アカウント追加）", command=self.login_popup)
+        account_menu.add_command(label="ログアウト（選択中のアカウント）", command=self.logout)
+
+        fit_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="縦横比", menu=fit_menu)
+        # 次に追加するジョブから有効
+        self.fit_var = tk.StringVar(value=self.fit_mode)
+        for label, mode in (("切り抜いて全面に", CROP), ("黒い余白で収める", LETTERBOX), ("ぼかした背景で収める", BLUR)):
+            fit_menu.add_radiobutton(label=label, value=mode, variable=self.fit_var,
+                                     command=lambda: setattr(self, "fit_mode", self.fit_var.get()))
+
+        help_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="ヘルプ", menu=help_menu)
+        help_menu.add_command(label="診断情報", command=self.show_diagnostics)
+        # 次に処理するジョブから有効（プロファイルは logs/profiles/ に保存）
+        self.profile_var = tk.BooleanVar(value=self.perf.profile)
+        self.trace_memory_var = tk.BooleanVar(value=self.perf.trace_memory)
+        help_menu.add_checkbutton(label="プロファイルを取る (cProfile)", variable=self.profile_var,
+                                  command=lambda: setattr(self.perf, "profile", self.profile_var.get()))
+        help_menu.add_checkbutton(label="メモリ使用を追跡 (tracemalloc)", variable=self.trace_memory_var,
+                                  command=lambda: setattr(self.perf, "trace_memory", self.trace_memory_var.get()))
         
         # メインフレーム
         main_frame = tk.Frame(self.root, padx=20, pady=20)
@@ -282,6 +410,12 @@ class StoryUploader:
         # ステータス表示
         self.status_label = tk.Label(main_frame, text=self.status_text, fg="blue", font=("Arial", 10))
         self.status_label.pack(pady=(0, 0))
+
+        # 投稿先アカウント（チェックしたアカウントへ並列に投稿）
+        accounts_box = tk.LabelFrame(main_frame, text="投稿先アカウント", padx=10, pady=5)
+        accounts_box.pack(fill=tk.X, pady=(0, 10))
+        self.accounts_frame = tk.Frame(accounts_box)
+        self.accounts_frame.pack(fill=tk.X)
         
         # ファイル選択エリア
         file_frame = tk.LabelFrame(main_frame, text="ファイル選択", padx=10, pady=10)
@@ -298,8 +432,17 @@ class StoryUploader:
         preview_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
         preview_frame.pack_propagate(False)
         
-        self.preview_label = tk.Label(preview_frame, text="画像/動画が選択されていません", bg="lightgray")
-        self.preview_label.pack(fill=tk.BOTH, expand=True)
+        self.preview_canvas = PreviewCanvas(
+            preview_frame,
+            on_box_changed=self._on_preview_box_changed,
+            icon_loader=lambda path, size: icon_cache.get(path, size, self.resample_filter),
+        )
+        self.preview_canvas.pack(fill=tk.BOTH, expand=True)
+        self.preview_canvas.show_message("画像/動画が選択されていません")
+
+        # 動画プレビュー用のシークバー（動画選択時のみ表示）
+        self.video_scrub = tk.Scale(preview_frame, from_=0, to=0, orient=tk.HORIZONTAL, resolution=0.01,
+                                    showvalue=True, command=self._on_video_scrub)
         
         # Link Sticker入力
         link_frame = tk.LabelFrame(main_frame, text="Link Sticker (オプション)", padx=10, pady=10)
@@ -325,7 +468,58 @@ class StoryUploader:
                               command=self.upload_story, bg="#0095f6", fg="white",
                               font=("Arial", 12, "bold"), height=2)
         upload_btn.pack(fill=tk.X)
+
+        # アップロードキュー
+        queue_frame = tk.LabelFrame(main_frame, text="アップロードキュー", padx=10, pady=5)
+        queue_frame.pack(fill=tk.X, pady=(10, 0))
+        self.queue_list = tk.Listbox(queue_frame, height=4, font=("Arial", 8))
+        self.queue_list.pack(fill=tk.X)
+        self.queue_list.bind("<<ListboxSelect>>", lambda _event: self._show_job_breakdown())
+        # 選択中のジョブの段ごとの処理時間
+        self.perf_label = tk.Label(queue_frame, text="", font=("Arial", 8), fg="gray", justify=tk.LEFT, anchor=tk.W)
+        self.perf_label.pack(fill=tk.X)
+        queue_controls = tk.Frame(queue_frame)
+        queue_controls.pack(anchor=tk.W, pady=(5, 0))
+        tk.Button(queue_controls, text="再試行", command=self.retry_job).pack(side=tk.LEFT, padx=(0, 5))
+        tk.Button(queue_controls, text="削除", command=self.remove_job).pack(side=tk.LEFT, padx=(0, 5))
+        tk.Button(queue_controls, text="完了を消去", command=self.clear_finished_jobs).pack(side=tk.LEFT)
     
+    def diagnostics(self) -> dict:
+        """キャッシュ等の統計と、アカウントごとの API のペース配分"""
+        thumbnails = self.thumbnail_cache
+        lookups = thumbnails.hits + thumbnails.misses
+        pacing = {
+            f"pacing {username}/{endpoint_class}": stats
+            for username, classes in self.accounts.pacing_stats().items()
+            for endpoint_class, stats in classes.items()
+        }
+        return {
+            "thumbnail_cache": {
+                "hits": thumbnails.hits,
+                "misses": thumbnails.misses,
+                "hit_rate": thumbnails.hits / lookups if lookups else 0.0,
+            },
+            "icon_cache": icon_cache.stats(),
+            # 写真のデコードに使ったメモリの見積もり（上限を超える画像は rejected）
+            "decode_memory": decode_budget.stats(),
+            "media_cache": self.media_cache.stats(),
+            "preview_renders_skipped": self.preview_renders_skipped,
+            "ui_events": self.events.stats(),
+            **pacing,
+        }
+
+    def show_diagnostics(self):
+        lines = []
+        for name, value in self.diagnostics().items():
+            if isinstance(value, dict):
+                detail = ", ".join(
+                    f"{key}={val:.0%}" if key == "hit_rate" else f"{key}={val}" for key, val in value.items()
+                )
+                lines.append(f"{name}: {detail}")
+            else:
+                lines.append(f"{name}: {value}")
+        messagebox.showinfo("診断情報", "\n".join(lines))
+
     def login_popup(self):
         """ログインダイアログを表示"""
         dialog = tk.Toplevel(self.root)
@@ -356,54 +550,65 @@ class StoryUploader:
         tk.Button(dialog, text="ログイン", command=do_login).pack()
     
     def login(self, username, password):
-        """Instagramにログイン"""
+        """Instagramにログイン（ログイン済みのアカウントがあれば追加）"""
         def login_thread():
+            from instagrapi.exceptions import ChallengeRequired, TwoFactorRequired
+
+            client = new_client()
             try:
-                self.status_label.config(text="ログイン中...")
-                self.cl.login(username, password)
-                
-                # セッションを保存
-                self.cl.dump_settings(Path("session.json"))
-                
-                user_info = self.cl.account_info()
-                self.logged_in = True
-                self.status_label.config(text=f"ログイン成功: {user_info.username}", fg="green")
-                messagebox.showinfo("成功", f"{user_info.username}としてログインしました")
+                self.events.started("login", "ログイン中...")
+                self._session_generation += 1
+                client.login(username, password)
+                self._finish_login(client)
                 
             except TwoFactorRequired:
-                self.root.after(0, lambda: self.handle_2fa(username, password))
+                self.events.call(lambda: self.handle_2fa(client, username, password))
             except ChallengeRequired:
-                messagebox.showerror("エラー", "チャレンジが必要です。ブラウザでログインしてください")
-                self.status_label.config(text="ログイン失敗", fg="red")
+                self.events.error("login", "ログイン失敗", notify="チャレンジが必要です。ブラウザでログインしてください")
             except Exception as e:
-                messagebox.showerror("エラー", f"ログイン失敗: {str(e)}")
-                self.status_label.config(text="ログイン失敗", fg="red")
+                self.events.error("login", "ログイン失敗", notify=f"ログイン失敗: {str(e)}")
         
         threading.Thread(target=login_thread, daemon=True).start()
+
+    def _finish_login(self, client):
+        """ログインできた Client のセッションを保存し、投稿先に加える"""
+        user_info = client.account_info()
+        account = self.accounts.add(client, user_info.username)
+
+        def apply():
+            self.account_vars.setdefault(account.key, tk.BooleanVar()).set(True)
+            self._update_account_status()
+        self.events.call(apply)
+        self.events.finished("login", f"ログイン成功: {user_info.username}",
+                             notify=f"{user_info.username}としてログインしました")
     
-    def handle_2fa(self, username, password):
+    def handle_2fa(self, client, username, password):
         """2要素認証の処理"""
         code = simpledialog.askstring("2要素認証", "認証コードを入力してください:")
         if code:
             try:
-                self.cl.login(username, password, verification_code=code)
-                self.cl.dump_settings(Path("session.json"))
-                user_info = self.cl.account_info()
-                self.logged_in = True
-                self.status_label.config(text=f"ログイン成功: {user_info.username}", fg="green")
-                messagebox.showinfo("成功", f"{user_info.username}としてログインしました")
+                self._session_generation += 1
+                client.login(username, password, verification_code=code)
+                self._finish_login(client)
             except Exception as e:
-                messagebox.showerror("エラー", f"2要素認証失敗: {str(e)}")
-                self.status_label.config(text="ログイン失敗", fg="red")
+                self.events.error("login", "ログイン失敗", notify=f"2要素認証失敗: {str(e)}")
     
     def logout(self):
-        """ログアウト"""
-        if messagebox.askyesno("確認", "ログアウトしますか?"):
-            self.cl.logout()
-            self.logged_in = False
-            session_path = Path("session.json")
-            if session_path.exists():
-                session_path.unlink()
+        """チェックしているアカウントからログアウト"""
+        keys = [key for key, var in self.account_vars.items() if var.get()]
+        if not keys:
+            messagebox.showerror("エラー", "ログアウトするアカウントを選択してください")
+            return
+        names = ", ".join(self.accounts.get(key).username for key in keys)
+        if messagebox.askyesno("確認", f"{names} からログアウトしますか?"):
+            self._session_generation += 1
+            for key in keys:
+                try:
+                    self.accounts.get(key).client.logout()
+                except Exception as e:
+                    logging.getLogger().info(f"Couldn't logout: {e}")
+                self.accounts.remove(key)
+            self._update_account_status()
             self.status_label.config(text="ログアウトしました", fg="blue")
             messagebox.showinfo("成功", "ログアウトしました")
     
@@ -425,284 +630,242 @@ class StoryUploader:
             self.file_label.config(text=file_name, fg="black")
             
             # プレビューを表示
-            self.show_preview(file_path)
+            self.preview_scheduler.flush()
     
     def show_preview(self, file_path):
         """選択したファイルのプレビューを表示"""
         ext = os.path.splitext(file_path)[1].lower()
         
+        if ext != '.mp4':
+            self._close_video_preview()
+
         if ext in ['.jpg', '.jpeg', '.png']:
             try:
-                image = Image.open(file_path)
-                orig_w, orig_h = image.size
-                preview = image.copy()
-                preview.thumbnail(self.preview_max_size)
-
-                # 描画: Link Sticker 当たり判定（URLが入力されている行のみ）
-                draw = ImageDraw.Draw(preview)
-                preview_w, preview_h = preview.size
-                for row in self.link_rows:
-                    url = row["url"].get().strip()
-                    if not url or url == "https://":
-                        continue
-                    try:
-                        link_x = float(row["x"].get() or self.default_link_geom["x"])
-                        link_y = float(row["y"].get() or self.default_link_geom["y"])
-                        link_w = float(row["w"].get() or self.default_link_geom["w"])
-                        link_h = float(row["h"].get() or self.default_link_geom["h"])
-                    except ValueError:
-                        continue
-                    px_w = link_w * preview_w
-                    px_h = link_h * preview_h
-                    cx = link_x * preview_w
-                    cy = link_y * preview_h
-                    bbox = [
-                        cx - px_w / 2,
-                        cy - px_h / 2,
-                        cx + px_w / 2,
-                        cy + px_h / 2,
-                    ]
-                    draw.rectangle(bbox, outline="red", width=2)
-
-                photo = ImageTk.PhotoImage(preview)
-                self.preview_label.config(image=photo, text="")
-                self.preview_label.image = photo  # type: ignore
+                # 縮小済みのベース画像は一度だけ Tk に渡し、以降は当たり判定の枠の座標だけ更新する
+                self.preview_canvas.set_image(self.thumbnail_cache.get(file_path))
             except Exception as e:
-                self.preview_label.config(text=f"画像読み込みエラー: {str(e)}")
+                self.preview_canvas.show_message(f"画像読み込みエラー: {str(e)}")
+                return
+            self._sync_preview_boxes()
         elif ext == '.mp4':
-            self.preview_label.config(text=f"動画ファイル\n{os.path.basename(file_path)}")
+            if self.video_source is None or self.video_source.file_path != str(file_path):
+                self._open_video_preview(file_path)
+            self._sync_preview_boxes()
         else:
-            self.preview_label.config(text="未対応のファイル形式")
+            self.preview_canvas.show_message("未対応のファイル形式")
     
+    def _open_video_preview(self, file_path):
+        """動画を開いて先頭フレームを表示し、シークバーを出す"""
+        self._close_video_preview()
+        self.preview_canvas.show_message(f"動画を読み込み中...\n{os.path.basename(file_path)}")
+        try:
+            source = VideoFrameSource(
+                file_path,
+                self.preview_max_size,
+                # 連続して届いたフレームは 1 回の反映で最新の 1 枚だけ描く
+                lambda _ts, image: self.events.call(lambda: self._on_video_frame(source, image), key="video_frame"),
+            )
+        except Exception as e:
+            self.preview_canvas.show_message(f"動画読み込みエラー: {str(e)}")
+            return
+        self.video_source = source
+        self.video_scrub.config(to=max(0.0, source.duration - 1 / source.fps), resolution=round(1 / source.fps, 3) or 0.01)
+        self.video_scrub.set(0)
+        self.video_scrub.pack(fill=tk.X, side=tk.BOTTOM, before=self.preview_canvas)
+        source.request(0.0)
+
+    def _close_video_preview(self):
+        if self.video_source is not None:
+            self.video_source.close()
+            self.video_source = None
+            self.video_scrub.pack_forget()
+
+    def _on_video_scrub(self, value):
+        if self.video_source is not None:
+            self.video_source.request(float(value))
+
+    def _on_video_frame(self, source, image):
+        # 別の動画に切り替わった後に届いた古いフレームは捨てる
+        if source is not self.video_source:
+            return
+        self.preview_canvas.set_image(image)
+        self._sync_preview_boxes()
+
     def upload_story(self):
-        """ストーリーをアップロード"""
+        """ストーリーをアップロードキューに追加（前処理と投稿は裏で進む）"""
         if not self.logged_in:
             messagebox.showerror("エラー", "先にログインしてください")
             return
+        account_keys = self._selected_accounts()
+        if not account_keys:
+            messagebox.showerror("エラー", "投稿先アカウントを選択してください")
+            return
         
         if not self.selected_file_path:
             messagebox.showerror("エラー", "ファイルを選択してください")
             return
-        
-        def collect_links_with_icons():
-            links = []
-            overlays = []
-            for idx, row in enumerate(self.link_rows, start=1):
-                url = row["url"].get().strip()
-                if not url or url == "https://":
-                    continue
-                try:
-                    link_x = float(row["x"].get() or self.default_link_geom["x"])
-                    link_y = float(row["y"].get() or self.default_link_geom["y"])
-                    link_w = float(row["w"].get() or self.default_link_geom["w"])
-                    link_h = float(row["h"].get() or self.default_link_geom["h"])
-                except ValueError:
-                    messagebox.showerror("エラー", f"Link {idx} の位置とサイズは数値で入力してください")
-                    return None
-                links.append(
-                    StoryLink(
-                        webUri=cast(HttpUrl, url),
-                        x=link_x,
-                        y=link_y,
-                        width=link_w,
-                        height=link_h,
-                    )
-                )
-                overlays.append({
-                    "icon_path": row["icon_var"].get().strip(),
-                    "geom": (link_x, link_y, link_w, link_h),
-                })
-            return links, overlays
-        
-        def upload_thread():
+
+        links = []
+        for idx, row in enumerate(self.link_rows, start=1):
+            url = row["url"].get().strip()
+            if not url or url == "https://":
+                continue
             try:
-                self.status_label.config(text="アップロード中...")
-                
-                if not self.selected_file_path:
-                    return
-                
-                file_path = Path(self.selected_file_path)
-                ext = os.path.splitext(str(file_path))[1].lower()
-                
-                link_result = collect_links_with_icons()
-                if link_result is None:
-                    return
-                links, overlays = link_result
-                
-                # StoryBuilderを使用してストーリーを構築
-                temp_upload_path = None
-                if ext in ['.jpg', '.jpeg', '.png', '.webp']:
-                    # 画像に Link 用アイコンを合成（アイコン指定がある行のみ）
-                    composite_needed = any(item.get("icon_path") for item in overlays)
-                    target_path = file_path
-                    if composite_needed:
-                        try:
-                            with Image.open(file_path).convert("RGBA") as base:
-                                base_w, base_h = base.size
-                                canvas = base.copy()
-                                for item in overlays:
-                                    icon_path = item.get("icon_path")
-                                    if not icon_path:
-                                        continue
-                                    geom = item.get("geom") or (
-                                        self.default_link_geom["x"],
-                                        self.default_link_geom["y"],
-                                        self.default_link_geom["w"],
-                                        self.default_link_geom["h"],
-                                    )
-                                    link_x = float(geom[0])
-                                    link_y = float(geom[1])
-                                    link_w = float(geom[2])
-                                    link_h = float(geom[3])
-                                    try:
-                                        with Image.open(icon_path).convert("RGBA") as icon_img:
-                                            target_w = max(1, int(link_w * base_w))
-                                            target_h = max(1, int(link_h * base_h))
-                                            icon_resized = icon_img.resize((target_w, target_h), self.resample_filter)
-                                            cx = link_x * base_w
-                                            cy = link_y * base_h
-                                            paste_x = int(cx - target_w / 2)
-                                            paste_y = int(cy - target_h / 2)
-                                            canvas.alpha_composite(icon_resized, (paste_x, paste_y))
-                                    except Exception as e:
-                                        print(f"アイコン合成に失敗: {e}")
-                                        continue
-
-                                # 形式は元画像に合わせる（JPEGの場合はRGBに変換）
-                                suffix = file_path.suffix.lower()
-                                if suffix in [".jpg", ".jpeg"]:
-                                    canvas = canvas.convert("RGB")
-                                    suffix = ".jpg"
-                                with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-                                    canvas.save(tmp.name)
-                                    target_path = Path(tmp.name)
-                                    temp_upload_path = target_path
-
-                        except Exception as e:
-                            print(f"合成処理に失敗: {e}")
-
-                    story = StoryBuilder(target_path).photo()
-                    self.cl.photo_upload_to_story(
-                        story.path,
-                        links=links
-                    )
-                elif ext == '.mp4':
-                    # 動画ストーリー（必要ならアイコンを焼き込み）
-                    target_video_path = file_path
-                    composite_needed = any(item.get("icon_path") for item in overlays)
-                    if composite_needed:
-                        try:
-                            try:
-                                from moviepy.editor import VideoFileClip, ImageClip, CompositeVideoClip
-                                from moviepy.video.fx.resize import resize as mp_resize
-                            except ImportError:
-                                messagebox.showerror("エラー", "moviepy が必要です。`uv pip install moviepy` を実行してください。")
-                                return
-
-                            base_clip = VideoFileClip(str(file_path))
-                            width, height = base_clip.size
-                            overlay_clips = []
-                            for item in overlays:
-                                icon_path = item.get("icon_path")
-                                if not icon_path:
-                                    continue
-                                geom = item.get("geom") or (
-                                    self.default_link_geom["x"],
-                                    self.default_link_geom["y"],
-                                    self.default_link_geom["w"],
-                                    self.default_link_geom["h"],
-                                )
-                                link_x = float(geom[0])
-                                link_y = float(geom[1])
-                                link_w = float(geom[2])
-                                link_h = float(geom[3])
-                                target_w = max(1, int(link_w * width))
-                                target_h = max(1, int(link_h * height))
-                                pos_x = link_x * width - target_w / 2
-                                pos_y = link_y * height - target_h / 2
-                                try:
-                                    icon_clip = ImageClip(icon_path)
-                                    icon_clip = mp_resize(icon_clip, newsize=(target_w, target_h))
-                                    icon_clip = icon_clip.set_duration(base_clip.duration).set_pos((pos_x, pos_y))
-                                    overlay_clips.append(icon_clip)
-                                except Exception as e:
-                                    print(f"動画アイコン合成に失敗: {e}")
-                                    continue
-
-                            if overlay_clips:
-                                composite = CompositeVideoClip([base_clip, *overlay_clips])
-                                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
-                                    temp_upload_path = Path(tmp.name)
-                                audio_path = temp_upload_path.with_suffix(".m4a")
-                                composite.write_videofile(
-                                    str(temp_upload_path),
-                                    codec="libx264",
-                                    audio_codec="aac",
-                                    temp_audiofile=str(audio_path),
-                                    remove_temp=True,
-                                    verbose=False,
-                                    logger=None,
-                                )
-                                target_video_path = temp_upload_path
-                                composite.close()
-                                base_clip.close()
-                                for clip in overlay_clips:
-                                    try:
-                                        clip.close()
-                                    except Exception:
-                                        pass
-                            else:
-                                base_clip.close()
-                        except Exception as e:
-                            print(f"動画へのアイコン合成に失敗: {e}")
-
-                    story = StoryBuilder(target_video_path).video()
-                    self.cl.video_upload_to_story(
-                        story.path,
-                        links=links
-                    )
-                else:
-                    raise ValueError("未対応のファイル形式です")
-                if temp_upload_path:
-                    try:
-                        temp_upload_path.unlink(missing_ok=True)
-                    except Exception:
-                        pass
-                
-                self.status_label.config(text="アップロード成功!", fg="green")
-                messagebox.showinfo("成功", "ストーリーをアップロードしました!")
-                
-                # フィールドをクリア
-                self.selected_file_path = None
-                self.file_label.config(text="ファイル未選択", fg="gray")
-                self.preview_label.config(image="", text="画像/動画が選択されていません")
-                for row in self.link_rows:
-                    row["url"].delete(0, tk.END)
-                    row["url"].insert(0, "https://")
-                    row["x"].delete(0, tk.END)
-                    row["x"].insert(0, str(self.default_link_geom["x"]))
-                    row["y"].delete(0, tk.END)
-                    row["y"].insert(0, str(self.default_link_geom["y"]))
-                    row["w"].delete(0, tk.END)
-                    row["w"].insert(0, str(self.default_link_geom["w"]))
-                    row["h"].delete(0, tk.END)
-                    row["h"].insert(0, str(self.default_link_geom["h"]))
-                    row["w_var"].set(self.default_link_geom["w"])
-                    row["h_var"].set(self.default_link_geom["h"])
-                    row["icon_var"].set("")
-                    row["icon_label"].config(text="(なし)")
-                
-            except Exception as e:
-                print(e)
-                self.status_label.config(text="アップロード失敗", fg="red")
-                messagebox.showerror("エラー", f"アップロード失敗: {str(e)}")
-        
-        threading.Thread(target=upload_thread, daemon=True).start()
+                link_x = float(row["x"].get() or self.default_link_geom["x"])
+                link_y = float(row["y"].get() or self.default_link_geom["y"])
+                link_w = float(row["w"].get() or self.default_link_geom["w"])
+                link_h = float(row["h"].get() or self.default_link_geom["h"])
+            except ValueError:
+                messagebox.showerror("エラー", f"Link {idx} の位置とサイズは数値で入力してください")
+                return
+            links.append({
+                "url": url,
+                "x": link_x,
+                "y": link_y,
+                "w": link_w,
+                "h": link_h,
+                "icon_path": row["icon_var"].get().strip(),
+            })
+
+        job_id = self.upload_queue.submit({
+            "file_path": str(Path(self.selected_file_path).resolve()),
+            "links": links,
+            "accounts": account_keys,
+        })
+        self.status_label.config(text=f"キューに追加しました (#{job_id})", fg="blue")
+
+        # 次のストーリーをすぐ準備できるようにフィールドをクリア
+        self.selected_file_path = None
+        self.file_label.config(text="ファイル未選択", fg="gray")
+        self._close_video_preview()
+        self.preview_canvas.show_message("画像/動画が選択されていません")
+        for row in self.link_rows:
+            row["url"].delete(0, tk.END)
+            row["url"].insert(0, "https://")
+            row["x"].delete(0, tk.END)
+            row["x"].insert(0, str(self.default_link_geom["x"]))
+            row["y"].delete(0, tk.END)
+            row["y"].insert(0, str(self.default_link_geom["y"]))
+            row["w"].delete(0, tk.END)
+            row["w"].insert(0, str(self.default_link_geom["w"]))
+            row["h"].delete(0, tk.END)
+            row["h"].insert(0, str(self.default_link_geom["h"]))
+            row["w_var"].set(self.default_link_geom["w"])
+            row["h_var"].set(self.default_link_geom["h"])
+            row["icon_var"].set("")
+            row["icon_label"].config(text="(なし)")
+
+    def _story_options(self) -> StoryOptions:
+        return StoryOptions(
+            resample=self.resample_filter,
+            photo_mode=self.photo_story_mode,
+            photo_jpeg=self.photo_jpeg,
+            encode_workers=self.encode_workers,
+            fit_mode=self.fit_mode,
+        )
+
+    def _prepare_job(self, spec: dict) -> dict:
+        """キューの前処理（ワーカースレッド）: 合成・エンコード・StoryBuilder まで"""
+        self.queue_work_dir.mkdir(parents=True, exist_ok=True)
+        self.events.started("prepare", f"準備中 {os.path.basename(spec['file_path'])}")
+        prepared = prepare_story_cached(spec["file_path"], link_overlays(spec["links"]), self._story_options(),
+                                        cache=self.media_cache, work_dir=self.queue_work_dir)
+        return prepared.to_dict()
+
+    def _upload_job(self, spec: dict, prepared: dict) -> dict:
+        """キューの投稿（ワーカースレッド）: 選択されていたアカウントへ並列に投稿し、失敗分を返す"""
+        name = os.path.basename(spec["file_path"])
+
+        def on_progress(username, event):
+            text = (f"アップロード中 {name} → {username}: {event.fraction:.0%} "
+                    f"({event.sent / 1e6:.1f}/{event.total / 1e6:.1f} MB)")
+            if event.attempt > 1:
+                text += f" 再開 {event.attempt - 1} 回目"
+            self.events.progress("upload", text, event.fraction, key=("upload", username))
+
+        errors, _results, dropped = upload_to_accounts(
+            self.accounts, spec["links"], spec["accounts"], PreparedStory.from_dict(prepared), on_progress=on_progress
+        )
+        if dropped:
+            urls = ", ".join(link.get("url", "") for link in dropped)
+            self.events.error("upload", f"{name}: キャンバスの外に出た Link を省きました: {urls}")
+        return errors
+
+    def _on_queue_changed(self, job):
+        """キューの状態が変わったら一覧とステータスを更新（ワーカースレッドから呼ばれる）"""
+        # 一覧の作り直しは 1 回の反映につき 1 度だけ
+        self.events.call(self._refresh_queue_list, key="queue_list")
+        if job is None:
+            return
+        if job.status == DONE:
+            self.events.finished("queue", f"アップロード成功! (#{job.id})")
+        elif job.status == FAILED:
+            self.events.error("queue", f"アップロード失敗 (#{job.id})")
+
+    def _on_status_event(self, event):
+        """ワーカーからのイベントをステータス表示（と必要ならダイアログ）に反映する（メインスレッド）"""
+        color = {FINISHED: "green", ERROR: "red"}.get(event.kind, "blue")
+        self.status_label.config(text=event.message, fg=color)
+        if event.notify:
+            if event.kind == ERROR:
+                messagebox.showerror("エラー", event.notify)
+            else:
+                messagebox.showinfo("成功", event.notify)
+
+    def _refresh_queue_list(self):
+        selected = self._selected_job_id()
+        self.queue_jobs = self.upload_queue.store.jobs()[-self.queue_display_limit:]
+        self.queue_list.delete(0, tk.END)
+        for index, job in enumerate(self.queue_jobs):
+            name = os.path.basename(job.spec.get("file_path", ""))
+            text = f"#{job.id} {QUEUE_STATUS_LABELS.get(job.status, job.status)} {name}"
+            if job.error:
+                text += f" - {job.error.splitlines()[0]}"
+            self.queue_list.insert(tk.END, text)
+            if job.id == selected:
+                self.queue_list.selection_set(index)
+        self._show_job_breakdown()
+
+    def _show_job_breakdown(self):
+        job_id = self._selected_job_id()
+        if job_id is None and self.queue_jobs:
+            job_id = self.queue_jobs[-1].id
+        run = self.perf.get(job_id) if job_id is not None else None
+        self.perf_label.config(text=f"#{job_id} の処理時間\n{run.breakdown()}" if run and run.stages else "")
+
+    def _selected_job_id(self) -> int | None:
+        selection = self.queue_list.curselection() if hasattr(self, "queue_list") else ()
+        if not selection or selection[0] >= len(self.queue_jobs):
+            return None
+        return self.queue_jobs[selection[0]].id
+
+    def retry_job(self):
+        job_id = self._selected_job_id()
+        if job_id is None or not self.upload_queue.retry(job_id):
+            messagebox.showerror("エラー", "失敗したジョブを選択してください")
+
+    def remove_job(self):
+        job_id = self._selected_job_id()
+        if job_id is None or not self.upload_queue.remove(job_id):
+            messagebox.showerror("エラー", "処理中のジョブは削除できません")
+
+    def clear_finished_jobs(self):
+        self.upload_queue.store.clear_done()
+        self._refresh_queue_list()
 
 
 def main():
+    # PyInstaller 版でもセグメント並列エンコードのワーカープロセスを起動できるようにする
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = StoryUploader(root)
+    if os.environ.get("STORY_UPLOADER_STARTUP_BENCH"):
+        # benchmarks/startup.py 用: 最初の描画が終わった時点で知らせて終了する
+        def report_first_paint():
+            root.update()
+            print("first-paint", flush=True)
+            root.destroy()
+        root.after_idle(report_first_paint)
     root.mainloop()
 
 
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 加工処理の中身を変えたら上げる（古いキャッシュを使わないように）
+CACHE_VERSION = 3
+
+
+def _link_or_copy(src: Path, dst: Path):
+    """同じファイルシステムならハードリンク（容量を食わず、キャッシュから消えても残る）、だめならコピー"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class PreparedMediaCache:
+    """加工済みのストーリー素材を、入力の内容から作ったキーでディスクに保存する
+
+    キーは元ファイルとアイコンのバイト列のハッシュ、Link の位置とサイズ、エンコード設定から作るので、
+    同じ素材の再試行や別アカウントへの再投稿では合成・エンコードを飛ばせる。
+    合計サイズが max_bytes を超えたら最後に使ってから最も時間の経ったものから消す（LRU）。
+    素材と一緒に小さなメタデータ（.キー.meta.json。FitPlan 等）を置けるので、ヒット時に元ファイルを開き直さなくてよい。
+    """
+
+    def __init__(self, directory=Path("media_cache"), max_bytes: int = 2 * 1024 ** 3):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # (絶対パス, サイズ, 更新時刻) -> ハッシュ。同じファイルを何度も読まないように
+        self._digests: dict[tuple[str, int, int], str] = {}
+
+    def file_digest(self, path) -> str:
+        path = Path(path)
+        stat = path.stat()
+        memo_key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(memo_key)
+        if digest is None:
+            with path.open("rb") as fp:
+                digest = hashlib.file_digest(fp, "sha256").hexdigest()
+            with self._lock:
+                self._digests[memo_key] = digest
+        return digest
+
+    def key_for(self, src_path, overlays, settings: dict) -> str:
+        """元ファイル・アイコン・Link の位置とサイズ・エンコード設定から素材のキーを作る"""
+        parts = {
+            "version": CACHE_VERSION,
+            "source": self.file_digest(src_path),
+            "suffix": Path(src_path).suffix.lower(),
+            "overlays": [
+                {
+                    "icon": self.file_digest(item["icon_path"]) if item.get("icon_path") else None,
+                    "geom": [float(v) for v in item.get("geom") or ()],
+                }
+                for item in overlays
+            ],
+            "settings": settings,
+        }
+        encoded = json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _entries(self) -> list[Path]:
+        if not self.directory.is_dir():
+            return []
+        return [path for path in self.directory.iterdir() if path.is_file() and not path.name.startswith(".")]
+
+    def _meta_path(self, key: str) -> Path:
+        return self.directory / f".{key}.meta.json"
+
+    def get(self, key: str) -> tuple[str, Path] | None:
+        """(種類, キャッシュ内のパス)。見つかれば最終利用時刻を更新する"""
+        for path in self.directory.glob(f"{key}.*") if self.directory.is_dir() else ():
+            kind = path.name.split(".")[1]
+            try:
+                os.utime(path)
+            except OSError:
+                continue
+            with self._lock:
+                self.hits += 1
+            logger.info(f"media cache hit: {path.name}")
+            return kind, path
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def checkout(self, key: str, work_dir=None) -> tuple[str, Path, dict] | None:
+        """キャッシュの素材を作業用のパスに取り出す（アップロード中に追い出されても消えないように）
+
+        (種類, 取り出したパス, put で一緒に保存したメタデータ) を返す。メタデータが読めなければ外れ扱い。
+        """
+        found = self.get(key)
+        if found is None:
+            return None
+        kind, path = found
+        try:
+            meta = json.loads(self._meta_path(key).read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            logger.info(f"media cache: metadata unreadable: {e}")
+            return None
+        with tempfile.NamedTemporaryFile(delete=False, suffix=path.suffix, dir=work_dir) as tmp:
+            target = Path(tmp.name)
+        target.unlink()
+        try:
+            _link_or_copy(path, target)
+        except OSError as e:
+            logger.info(f"media cache: checkout failed: {e}")
+            return None
+        return kind, target, meta
+
+    def put(self, key: str, kind: str, path, meta: dict | None = None) -> Path | None:
+        path = Path(path)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            target = self.directory / f"{key}.{kind}{path.suffix.lower()}"
+            tmp = self.directory / f".{key}.tmp"
+            # メタデータを先に置く（素材だけがあってメタデータが無い状態を作らない）
+            tmp.write_text(json.dumps(meta or {}), encoding="utf-8")
+            os.replace(tmp, self._meta_path(key))
+            _link_or_copy(path, tmp)
+            os.replace(tmp, target)
+        except OSError as e:
+            logger.info(f"media cache: store failed: {e}")
+            return None
+        self._evict(keep=target)
+        return target
+
+    def _evict(self, keep: Path | None = None):
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            self._meta_path(path.name.split(".")[0]).unlink(missing_ok=True)
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def size_bytes(self) -> int:
+        return sum(path.stat().st_size for path in self._entries())
+
+    def clear(self):
+        for path in self._entries():
+            path.unlink(missing_ok=True)
+            self._meta_path(path.name.split(".")[0]).unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,142 @@
+import threading
+import time
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class PaceLimits:
+    """エンドポイントの種類ごとの送信レート（リクエスト/秒）の初期値・下限・上限とバースト数"""
+
+    rate: float
+    min_rate: float
+    max_rate: float
+    burst: float = 1.0
+
+
+# read: 情報取得 / write: その他の POST / publish: アップロード後の configure 等 / auth: ログイン / public: Web API
+DEFAULT_LIMITS = {
+    "read": PaceLimits(rate=1.0, min_rate=0.1, max_rate=4.0, burst=3),
+    "write": PaceLimits(rate=0.5, min_rate=0.05, max_rate=2.0, burst=2),
+    "publish": PaceLimits(rate=0.5, min_rate=0.02, max_rate=1.0, burst=2),
+    "auth": PaceLimits(rate=0.2, min_rate=0.02, max_rate=0.5, burst=1),
+    "public": PaceLimits(rate=0.5, min_rate=0.05, max_rate=1.0, burst=1),
+}
+
+
+def classify_endpoint(endpoint: str, data=None, login: bool = False) -> str:
+    """instagrapi の private API のエンドポイントを種類に分ける"""
+    if login or "login" in endpoint or "two_factor" in endpoint or "challenge" in endpoint:
+        return "auth"
+    if "configure" in endpoint or "upload" in endpoint:
+        return "publish"
+    return "write" if data else "read"
+
+
+class AdaptiveTokenBucket:
+    """応答時間とスロットリングに合わせて補充レートを変えるトークンバケット
+
+    速い応答が続けばレートを少しずつ上げ（加算）、遅い応答では下げ、429 / "Please wait" 等では半分にして
+    連続回数に応じた指数バックオフの間は送らない（AIMD）。
+    """
+
+    def __init__(self, limits: PaceLimits, *, fast_latency: float = 0.8, slow_latency: float = 3.0,
+                 increase: float = 0.1, backoff_base: float = 5.0, backoff_max: float = 300.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.limits = limits
+        self.rate = limits.rate
+        self.tokens = limits.burst
+        self.fast_latency = fast_latency
+        self.slow_latency = slow_latency
+        self.increase = increase
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        self.sleep = sleep
+        self.backoff_until = 0.0
+        self.consecutive_throttles = 0
+        self.requests = 0
+        self.throttles = 0
+        self.waited = 0.0
+        self.latency_ewma: float | None = None
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.limits.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """1 リクエスト分のトークンが取れるまで待ち、待った秒数を返す"""
+        started = self.clock()
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._refill(now)
+                wait = self.backoff_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.requests += 1
+                        self.waited += now - started
+                        return now - started
+                    wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def on_success(self, latency: float):
+        with self._lock:
+            self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+            self.consecutive_throttles = 0
+            if latency <= self.fast_latency:
+                self.rate = min(self.limits.max_rate, self.rate + self.increase)
+            elif latency >= self.slow_latency:
+                self.rate = max(self.limits.min_rate, self.rate * 0.8)
+
+    def on_throttle(self, retry_after: float | None = None):
+        with self._lock:
+            self.throttles += 1
+            self.consecutive_throttles += 1
+            self.rate = max(self.limits.min_rate, self.rate * 0.5)
+            backoff = min(self.backoff_max, self.backoff_base * 2 ** (self.consecutive_throttles - 1))
+            if retry_after:
+                backoff = max(backoff, retry_after)
+            self.backoff_until = max(self.backoff_until, self.clock() + backoff)
+            self.tokens = 0.0
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            return {
+                "rate": round(self.rate, 3),
+                "tokens": round(self.tokens, 2),
+                "backoff_remaining": round(max(0.0, self.backoff_until - now), 1),
+                "consecutive_throttles": self.consecutive_throttles,
+                "throttles": self.throttles,
+                "requests": self.requests,
+                "waited_s": round(self.waited, 2),
+                "latency_ewma_s": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            }
+
+
+class RequestPacer:
+    """1 アカウント（1 Client）分のペース配分。エンドポイントの種類ごとにバケットを持つ"""
+
+    def __init__(self, limits: dict[str, PaceLimits] | None = None, **bucket_options):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self._bucket_options = bucket_options
+        self._buckets: dict[str, AdaptiveTokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, endpoint_class: str) -> AdaptiveTokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(endpoint_class)
+            if bucket is None:
+                limits = self.limits.get(endpoint_class, self.limits["read"])
+                bucket = AdaptiveTokenBucket(limits, **self._bucket_options)
+                self._buckets[endpoint_class] = bucket
+            return bucket
+
+    def stats(self) -> dict:
+        with self._lock:
+            buckets = dict(self._buckets)
+        return {name: bucket.stats() for name, bucket in buckets.items()}
@@ -0,0 +1,278 @@
+import cProfile
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def _peak_rss() -> tuple[int | None, int | None]:
+    """(このプロセス, 子プロセスの最大) の起動以来の最大常駐メモリ（バイト）。取れない環境では None
+
+    ru_maxrss はプロセス全体の最大なので、段ごとの最大ではない（段の分は _current_rss の増減で見る）。
+    """
+    if resource is None:
+        return None, None
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def _current_rss() -> int | None:
+    """このプロセスの今の常駐メモリ（バイト）。/proc の無い環境では None"""
+    try:
+        with open("/proc/self/statm", "rb") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _children_cpu() -> float:
+    """終了した子プロセス（ffmpeg・エンコードのワーカー）の CPU 時間。段が並行していると他の段の分も入る"""
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class StageTimer:
+    """計測中の段。bytes（扱ったデータ量）と extra は段の中から書き足せる"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.bytes = 0
+        self.extra: dict = {}
+
+
+class RunRecorder:
+    """1 件（キューのジョブ 1 つ）分の段ごとの計測結果
+
+    段はネストでき、親の段の名前を parent に残す。fan-out のワーカーなど別スレッドからも stage() を使える。
+    """
+
+    def __init__(self, perf: "PerfLog", run_id, label: str = "", *, profile: bool = False, trace_memory: bool = False):
+        self.perf = perf
+        self.run_id = run_id
+        self.label = label
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.started = time.time()
+        self.status: str | None = None
+        self.stages: list[dict] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, *, parent: str | None = None, **extra):
+        """name の段を計測する。parent を省略するとこのスレッドで計測中の段が親になる"""
+        stack = getattr(_local, "stages", None)
+        if stack is None:
+            stack = _local.stages = []
+        parent = parent or (stack[-1] if stack else None)
+        timer = StageTimer(name)
+        timer.extra.update(extra)
+        profiler = None
+        if self.profile and parent is None:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # 別のプロファイラーが動いている（3.12 以降は同時に 1 つまで）
+                profiler = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            # 段ごとのピーク。段が並行しているときは重なった分も含む
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        children_cpu = _children_cpu()
+        rss = _current_rss()
+        stack.append(name)
+        error = None
+        try:
+            yield timer
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            record = {
+                "stage": name,
+                "parent": parent,
+                "wall_s": round(time.perf_counter() - wall, 4),
+                "cpu_s": round(time.thread_time() - cpu, 4),
+                "children_cpu_s": round(_children_cpu() - children_cpu, 4),
+                "bytes": timer.bytes,
+            }
+            # 段が並行しているときは他の段の分も入る
+            record["rss_bytes"] = _current_rss()
+            record["rss_delta_bytes"] = record["rss_bytes"] - rss if rss is not None and record["rss_bytes"] else None
+            record["process_peak_rss_bytes"], record["children_peak_rss_bytes"] = _peak_rss()
+            if self.trace_memory and tracemalloc.is_tracing():
+                record["py_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            if profiler is not None:
+                profiler.disable()
+                record["profile"] = self.perf.dump_profile(profiler, self.run_id, name)
+            if error:
+                record["error"] = error
+            record.update(timer.extra)
+            self.add(record)
+
+    def add(self, record: dict):
+        with self._lock:
+            self.stages.append(record)
+        self.perf.write({"event": "stage", "run": self.run_id, "label": self.label, **record})
+
+    def summary(self) -> list[dict]:
+        with self._lock:
+            return [dict(stage) for stage in self.stages]
+
+    def breakdown(self) -> str:
+        """段ごとの内訳（UI 表示用）"""
+        lines = []
+        for stage in self.summary():
+            indent = "  " if stage["parent"] else ""
+            line = f"{indent}{stage['stage']}: {stage['wall_s']:.2f}s (CPU {stage['cpu_s']:.2f}s"
+            if stage["children_cpu_s"]:
+                line += f" + 子 {stage['children_cpu_s']:.2f}s"
+            line += ")"
+            if stage["bytes"]:
+                line += f" {stage['bytes'] / 1e6:.1f}MB"
+            if abs(stage.get("rss_delta_bytes") or 0) >= 1e6:
+                line += f" メモリ {stage['rss_delta_bytes'] / 1e6:+.0f}MB"
+            if stage.get("pacing_wait_s"):
+                line += f" 待ち {stage['pacing_wait_s']:.1f}s"
+            if stage.get("error"):
+                line += " 失敗"
+            lines.append(line)
+        rss = max((stage["process_peak_rss_bytes"] or 0 for stage in self.summary()), default=0)
+        if rss:
+            lines.append(f"プロセスの最大メモリ（起動以来）: {rss / 1e6:.0f}MB")
+        return "\n".join(lines)
+
+
+class PerfLog:
+    """段ごとの計測（経過時間・CPU 時間・常駐メモリの増減・バイト数）を JSON Lines でローテーションするログに書く
+
+    path が None ならファイルには書かず、直近の結果をメモリにだけ持つ。profile / trace_memory は
+    run() ごとに上書きでき、profile ではトップレベルの段ごとの cProfile 結果を profile_dir に保存する。
+    """
+
+    def __init__(self, path=Path("logs/perf.jsonl"), *, max_bytes: int = 5 * 1024 * 1024, backups: int = 3,
+                 profile: bool = False, trace_memory: bool = False, profile_dir=None, keep_runs: int = 200):
+        self.path = Path(path) if path else None
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.profile_dir = Path(profile_dir) if profile_dir else (self.path.parent / "profiles" if self.path else None)
+        self.keep_runs = keep_runs
+        self._runs: OrderedDict[object, RunRecorder] = OrderedDict()
+        self._lock = threading.Lock()
+        self._handler = None
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._handler = logging.handlers.RotatingFileHandler(
+                self.path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True
+            )
+
+    def run(self, run_id, label: str = "", *, profile: bool | None = None, trace_memory: bool | None = None) -> RunRecorder:
+        """run_id の計測を返す（無ければ作る。前処理と投稿で同じものを使う）"""
+        with self._lock:
+            recorder = self._runs.get(run_id)
+            if recorder is None or recorder.status is not None:
+                recorder = RunRecorder(
+                    self, run_id, label,
+                    profile=self.profile if profile is None else profile,
+                    trace_memory=self.trace_memory if trace_memory is None else trace_memory,
+                )
+                self._runs[run_id] = recorder
+                while len(self._runs) > self.keep_runs:
+                    self._runs.popitem(last=False)
+            self._runs.move_to_end(run_id)
+        if recorder.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return recorder
+
+    def get(self, run_id) -> RunRecorder | None:
+        with self._lock:
+            return self._runs.get(run_id)
+
+    def finish(self, run_id, status: str):
+        """run_id の計測を閉じ、段ごとの合計を 1 行書く"""
+        recorder = self.get(run_id)
+        if recorder is None or recorder.status is not None:
+            return
+        recorder.status = status
+        stages = recorder.summary()
+        self.write({
+            "event": "run",
+            "run": run_id,
+            "label": recorder.label,
+            "status": status,
+            "started": recorder.started,
+            "wall_s": round(time.time() - recorder.started, 3),
+            "stages": {stage["stage"]: stage["wall_s"] for stage in stages if not stage["parent"]},
+        })
+        if recorder.trace_memory and tracemalloc.is_tracing():
+            with self._lock:
+                tracing = any(run.trace_memory and run.status is None for run in self._runs.values())
+            if not tracing:
+                tracemalloc.stop()
+
+    def write(self, record: dict):
+        if self._handler is None:
+            return
+        line = json.dumps({"ts": round(time.time(), 3), **record}, ensure_ascii=False, default=str)
+        self._handler.handle(logging.makeLogRecord({"msg": line, "levelno": logging.INFO}))
+
+    def dump_profile(self, profiler: cProfile.Profile, run_id, stage: str) -> str | None:
+        if self.profile_dir is None:
+            return None
+        try:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            path = self.profile_dir / f"run{run_id}-{stage.replace(':', '_')}-{int(time.time())}.prof"
+            profiler.dump_stats(path)
+        except OSError as e:
+            logger.info(f"couldn't save profile: {e}")
+            return None
+        return str(path)
+
+    def close(self):
+        if self._handler is not None:
+            self._handler.close()
+
+
+def current_run() -> RunRecorder | None:
+    return getattr(_local, "run", None)
+
+
+@contextmanager
+def activate(run: RunRecorder | None):
+    """このスレッドで stage() が記録する先を run にする"""
+    previous = current_run()
+    _local.run = run
+    try:
+        yield run
+    finally:
+        _local.run = previous
+
+
+@contextmanager
+def stage(name: str, run: RunRecorder | None = None, *, parent: str | None = None, **extra):
+    """計測中の run（省略時はこのスレッドで activate したもの）に段を記録する。無ければ何もしない"""
+    run = run or current_run()
+    if run is None:
+        yield StageTimer(name)
+        return
+    with run.stage(name, parent=parent, **extra) as timer:
+        yield timer
@@ -0,0 +1,334 @@
+import io
+import logging
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from PIL import ExifTags, Image
+
+import perf_log
+from autofit import LETTERBOX, FitPlan, compose
+
+logger = logging.getLogger(__name__)
+
+# Instagram ストーリーのキャンバスサイズ
+STORY_SIZE = (1080, 1920)
+
+# EXIF Orientation -> 縮小後に適用する変換
+_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# 90° 回転する向き（縦横が入れ替わる）
+_ROTATED = (5, 6, 7, 8)
+
+# 縮小時、まず整数分の 1 に平均で縮めてから補間する（この倍率以上の縮小で効く。3.0 なら見た目の差は出ない）
+REDUCING_GAP = 3.0
+
+
+class ImageTooLarge(ValueError):
+    """デコードに必要なメモリの見積もりが MemoryBudget の上限を超える画像"""
+
+
+class MemoryBudget:
+    """並行してデコードする画像のピクセルバッファの見積もりの合計を limit_bytes 以下に抑える
+
+    reserve() は空きができるまで待ち、1 枚で上限を超える画像は ImageTooLarge にする。
+    peak_bytes は同時に確保していた見積もりの最大（実際の RSS は perf_log の rss_bytes / process_peak_rss_bytes で分かる）。
+    """
+
+    def __init__(self, limit_bytes: int | None):
+        self.limit_bytes = limit_bytes
+        self.in_use = 0
+        self.peak_bytes = 0
+        self.largest_bytes = 0
+        self.waits = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes: int):
+        with self._cond:
+            if self.limit_bytes is not None:
+                if nbytes > self.limit_bytes:
+                    self.rejected += 1
+                    raise ImageTooLarge(
+                        f"画像が大きすぎます（必要なメモリの見積もり {nbytes / 2 ** 20:.0f}MB > "
+                        f"上限 {self.limit_bytes / 2 ** 20:.0f}MB）"
+                    )
+                if self.in_use + nbytes > self.limit_bytes:
+                    self.waits += 1
+                    self._cond.wait_for(lambda: self.in_use + nbytes <= self.limit_bytes)
+            self.in_use += nbytes
+            self.peak_bytes = max(self.peak_bytes, self.in_use)
+            self.largest_bytes = max(self.largest_bytes, nbytes)
+        try:
+            yield nbytes
+        finally:
+            with self._cond:
+                self.in_use -= nbytes
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "limit_bytes": self.limit_bytes,
+                "in_use_bytes": self.in_use,
+                "peak_bytes": self.peak_bytes,
+                "largest_bytes": self.largest_bytes,
+                "waits": self.waits,
+                "rejected": self.rejected,
+            }
+
+
+# プロセス内の写真の加工で共有する上限（前処理のワーカーが同時に大きな画像を開いても超えないように）
+decode_budget = MemoryBudget(768 * 1024 * 1024)
+
+
+def _pixel_bytes(mode: str) -> int:
+    """Pillow が 1 ピクセルに使うバイト数（RGB も内部では 4 バイト）"""
+    if mode in ("1", "L", "P"):
+        return 1
+    if mode.startswith("I;16"):
+        return 2
+    return 4
+
+
+def story_plan(image: Image.Image, mode: str = LETTERBOX) -> tuple[FitPlan, int]:
+    """EXIF の向きを戻した後の大きさでストーリーのキャンバスに合わせる plan と、EXIF の向き"""
+    orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+    size = image.size[::-1] if orientation in _ROTATED else image.size
+    return FitPlan.plan(size, mode, STORY_SIZE), orientation
+
+
+def _unrotated(size: tuple[int, int], orientation: int) -> tuple[int, int]:
+    """向きを戻した後の大きさを、戻す前の（ファイルのままの）縦横に直す"""
+    return size[::-1] if orientation in _ROTATED else size
+
+
+def draft_for_story(image: Image.Image, mode: str = LETTERBOX):
+    """JPEG なら DCT の段階で 1/2〜1/8 に縮めてデコードさせる（読み込み前に呼ぶ。出力は必要な大きさ以上）"""
+    if image.format != "JPEG" or image.mode not in ("RGB", "L"):
+        return
+    plan, orientation = story_plan(image, mode)
+    image.draft(image.mode, _unrotated(plan.scaled_size, orientation))
+
+
+def estimate_decode_bytes(image: Image.Image, mode: str = LETTERBOX) -> int:
+    """ストーリー用に縮めるまでに同時に持つピクセルバッファの見積もり（draft 後のサイズで計算）
+
+    デコード結果・縮小前のモード変換・縮小結果・1080x1920 のキャンバスの合計。
+    """
+    pixels = image.width * image.height
+    total = pixels * _pixel_bytes(image.mode)
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        total += pixels * 4
+    plan, _orientation = story_plan(image, mode)
+    return total + (plan.scaled_size[0] * plan.scaled_size[1] + STORY_SIZE[0] * STORY_SIZE[1]) * 4
+
+
+@dataclass
+class JpegSettings:
+    """写真ストーリーの JPEG エンコード設定
+
+    max_bytes を指定すると min_quality〜max_quality の範囲で収まる最大の画質を二分探索する。
+    progressive が None ならベースライン / プログレッシブの小さい方を選ぶ。
+    """
+
+    max_bytes: int | None = None
+    min_quality: int = 60
+    max_quality: int = 92
+    progressive: bool | None = None
+    subsampling: str = "4:2:0"
+    measure_ssim: bool = True
+
+
+@dataclass
+class PreparedPhoto:
+    """エンコード済みのストーリー画像（メモリ上）"""
+
+    data: bytes
+    size: tuple[int, int]
+    quality: int = 0
+    progressive: bool = False
+    subsampling: str = ""
+    ssim: float | None = None
+
+    def write_to(self, path) -> Path:
+        path = Path(path)
+        path.write_bytes(self.data)
+        return path
+
+
+def fit_to_story(image: Image.Image, resample, background=(0, 0, 0), mode: str = LETTERBOX) -> Image.Image:
+    """ストーリーのキャンバスに合わせる（mode: 切り抜き / 余白を背景色で埋める / ぼかした背景で埋める）
+
+    元画像のフル解像度バッファは縮小の入力としてだけ使い、モード変換や回転は縮小後に行う。
+    読み込み前の JPEG は必要な大きさに近い縮小率でデコードする。余白の処理は縮小後の画像で行う。
+    """
+    plan, orientation = story_plan(image, mode)
+    transpose = _ORIENTATION_TRANSPOSE.get(orientation)
+    draft_for_story(image, mode)
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    target_mode = "RGBA" if has_alpha else "RGB"
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        # パレット等は縮小前に変換しないと最近傍補間になる
+        image = image.convert(target_mode)
+    scaled = _unrotated(plan.scaled_size, orientation)
+    if image.size != scaled:
+        image = image.resize(scaled, resample, reducing_gap=REDUCING_GAP)
+    if transpose is not None:
+        image = image.transpose(transpose)
+    if image.mode != target_mode:
+        image = image.convert(target_mode)
+    if image.size == STORY_SIZE and not has_alpha:
+        return image
+    if has_alpha:
+        # 透明部分は背景色の上に重ねる
+        flat = Image.new("RGB", image.size, background)
+        flat.paste(image, (0, 0), image)
+        image = flat
+    import numpy as np
+
+    return Image.fromarray(compose(np.asarray(image), plan, background))
+
+
+def compose_overlays(canvas: Image.Image, overlays, resample) -> Image.Image:
+    """Link 用アイコンをストーリーキャンバス上の正規化座標にその場で合成する
+
+    不透明な RGB キャンバスへのアルファ付き paste はアルファ合成と同じ結果になるので、
+    RGBA へ変換した複製は作らない。はみ出した部分は paste が切り落とす。
+    """
+    from compositor import icon_box
+    from icon_cache import icon_cache
+
+    for item in overlays:
+        icon_path = item.get("icon_path")
+        if not icon_path or not item.get("geom"):
+            continue
+        paste_x, paste_y, target_w, target_h = icon_box(item["geom"], canvas.size)
+        try:
+            icon_resized = icon_cache.get(icon_path, (target_w, target_h), resample)
+            canvas.paste(icon_resized, (paste_x, paste_y), icon_resized)
+        except Exception as e:
+            logger.warning(f"アイコン合成に失敗: {e}")
+    return canvas
+
+
+def encode_jpeg(image: Image.Image, quality: int = 90, *, progressive: bool = False,
+                subsampling: str = "4:2:0") -> bytes:
+    """メタデータ（EXIF / ICC）を付けずに JPEG にエンコード"""
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality, optimize=True, progressive=progressive, subsampling=subsampling)
+    return buffer.getvalue()
+
+
+def ssim(reference: Image.Image, encoded: bytes, band: int = 256) -> float:
+    """輝度の SSIM（11x11 ガウス窓）。1.0 で完全一致
+
+    float の作業配列がキャンバス全体分にならないよう、窓の半径分だけ重ねた band 行ずつ計算する（結果は同じ）。
+    """
+    import cv2
+    import numpy as np
+
+    with Image.open(io.BytesIO(encoded)) as decoded:
+        y_full = np.asarray(decoded.convert("L"))
+    x_full = np.asarray(reference.convert("L"))
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    radius = 5
+
+    def blur(a):
+        return cv2.GaussianBlur(a, (11, 11), 1.5)
+
+    height = x_full.shape[0]
+    total = 0.0
+    for top in range(0, height, band):
+        low, high = max(0, top - radius), min(height, top + band + radius)
+        x = x_full[low:high].astype(np.float32)
+        y = y_full[low:high].astype(np.float32)
+        mu_x, mu_y = blur(x), blur(y)
+        sigma_x = blur(x * x) - mu_x * mu_x
+        sigma_y = blur(y * y) - mu_y * mu_y
+        sigma_xy = blur(x * y) - mu_x * mu_y
+        ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / (
+            (mu_x * mu_x + mu_y * mu_y + c1) * (sigma_x + sigma_y + c2)
+        )
+        total += float(ssim_map[top - low:top - low + min(band, height - top)].sum(dtype=np.float64))
+    return total / x_full.size
+
+
+def encode_jpeg_budget(image: Image.Image, settings: JpegSettings) -> PreparedPhoto:
+    """バイト数の上限に収まる最大の画質でエンコードする（下限画質でも超える場合は下限で返す）"""
+    progressive_options = [False, True] if settings.progressive is None else [settings.progressive]
+
+    def encode(quality: int) -> tuple[bytes, bool]:
+        candidates = [
+            (encode_jpeg(image, quality, progressive=p, subsampling=settings.subsampling), p)
+            for p in progressive_options
+        ]
+        return min(candidates, key=lambda c: len(c[0]))
+
+    quality = settings.max_quality
+    data, progressive = encode(quality)
+    if settings.max_bytes is not None and len(data) > settings.max_bytes:
+        low, high = settings.min_quality, settings.max_quality - 1
+        best = None
+        while low <= high:
+            mid = (low + high) // 2
+            candidate, candidate_progressive = encode(mid)
+            if len(candidate) <= settings.max_bytes:
+                best = (mid, candidate, candidate_progressive)
+                low = mid + 1
+            else:
+                high = mid - 1
+        if best is None:
+            quality = settings.min_quality
+            data, progressive = encode(quality)
+        else:
+            quality, data, progressive = best
+
+    result = PreparedPhoto(data, image.size, quality, progressive, settings.subsampling)
+    if settings.measure_ssim:
+        result.ssim = ssim(image, data)
+    logger.info(
+        "photo story: %d bytes (budget %s), quality %d, %s, %s, SSIM %s",
+        len(data), settings.max_bytes or "-", quality,
+        "progressive" if progressive else "baseline", settings.subsampling,
+        f"{result.ssim:.4f}" if result.ssim is not None else "-",
+    )
+    return result
+
+
+def prepare_photo_story(src_path, overlays, resample, settings: JpegSettings | None = None,
+                        budget: MemoryBudget | None = None, fit_mode: str = LETTERBOX) -> PreparedPhoto:
+    """StoryBuilder を通さず、アップロード可能な 1080x1920 の JPEG をメモリ上で作る
+
+    デコードから縮小までは budget（省略時は decode_budget）の上限の中で行い、縮小が済んだら元画像の
+    バッファはすぐ手放す。合成とエンコードは 1080x1920 のキャンバスだけで行う。
+    overlays の位置はキャンバスに対する座標（autofit.map_overlays で直したもの）。
+    """
+    budget = budget or decode_budget
+    with Image.open(src_path) as source:
+        with perf_log.stage("decode_resize") as timer:
+            timer.bytes = Path(src_path).stat().st_size
+            draft_for_story(source, fit_mode)
+            estimate = estimate_decode_bytes(source, fit_mode)
+            timer.extra.update(decode_size=list(source.size), mem_estimate_bytes=estimate, fit=fit_mode)
+            with budget.reserve(estimate):
+                canvas = fit_to_story(source, resample, mode=fit_mode)
+                # 元画像がそのままキャンバスになる場合は閉じない（合成とエンコードで使う）
+                if canvas is not source:
+                    source.close()
+        with perf_log.stage("composite"):
+            compose_overlays(canvas, overlays, resample)
+        with perf_log.stage("encode") as timer:
+            prepared = encode_jpeg_budget(canvas, settings or JpegSettings())
+            timer.bytes = len(prepared.data)
+        return prepared
@@ -0,0 +1,222 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+
+class ThumbnailCache:
+    """プレビュー用の縮小画像をファイルごとに一度だけ生成して保持する"""
+
+    def __init__(self, max_size: tuple[int, int], resample, capacity: int = 8):
+        self.max_size = max_size
+        self.resample = resample
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, file_path) -> tuple:
+        stat = os.stat(file_path)
+        return (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size, self.max_size)
+
+    def get(self, file_path) -> Image.Image:
+        """キャッシュ済みの縮小画像を返す（呼び出し側で変更しないこと）"""
+        key = self._key(file_path)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+        thumb = self._decode(file_path)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = thumb
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return thumb
+
+    def _decode(self, file_path) -> Image.Image:
+        with Image.open(file_path) as image:
+            # JPEG は DCT 段階で縮小デコードさせる（1/2〜1/8）
+            image.draft("RGB", self.max_size)
+            if image.width <= self.max_size[0] and image.height <= self.max_size[1]:
+                thumb = image.copy()
+            else:
+                scale = min(self.max_size[0] / image.width, self.max_size[1] / image.height)
+                size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+                # 大きな PNG 等（縮小デコードできない形式）も整数分の 1 に平均してから補間する
+                thumb = image.resize(size, self.resample, reducing_gap=3.0)
+        if thumb.mode not in ("RGB", "RGBA"):
+            thumb = thumb.convert("RGBA" if "A" in thumb.getbands() or "transparency" in thumb.info else "RGB")
+        return thumb
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RefreshScheduler:
+    """連続したプレビュー更新要求を root.after で 1 回の描画にまとめる
+
+    入力が止まってから debounce_ms 後に描画する。スライダーのドラッグや入力が続いても、最初の未描画の要求から
+    max_wait_ms 以内には必ず 1 回描画する（止まるまで何も描かれないのを防ぐ）。
+    """
+
+    def __init__(self, widget, callback, debounce_ms: int = 50, max_wait_ms: int = 150, clock=time.monotonic):
+        self.widget = widget
+        self.callback = callback
+        self.debounce_ms = debounce_ms
+        self.max_wait_ms = max_wait_ms
+        self.clock = clock
+        self.requested = 0
+        self.rendered = 0
+        self.skipped = 0
+        self._after_id = None
+        self._generation = 0
+        # まだ描画していない最初の要求の時刻
+        self._pending_since: float | None = None
+
+    def request(self, *_args):
+        """更新を予約する。未実行の予約があれば破棄して置き換える（max_wait_ms を過ぎる分は縮める）"""
+        self.requested += 1
+        self._generation += 1
+        now = self.clock()
+        if self._pending_since is None:
+            self._pending_since = now
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+            self.skipped += 1
+        remaining_ms = self.max_wait_ms - (now - self._pending_since) * 1000
+        delay = max(0, int(min(self.debounce_ms, remaining_ms)))
+        generation = self._generation
+        self._after_id = self.widget.after(delay, lambda: self._fire(generation))
+
+    def flush(self):
+        """予約を待たずに即座に描画する"""
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+            self._after_id = None
+        self._generation += 1
+        self._fire(self._generation)
+
+    def cancel(self):
+        self._pending_since = None
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+            self._after_id = None
+            self.skipped += 1
+
+    def _fire(self, generation: int):
+        # 予約後により新しい入力があった描画は古いので捨てる
+        if generation != self._generation:
+            self.skipped += 1
+            return
+        self._after_id = None
+        self._pending_since = None
+        self.rendered += 1
+        self.callback()
+
+
+class VideoFrameSource:
+    """動画を一度だけ開き、バックグラウンドスレッドでプレビュー用フレームを取り出す
+
+    フレームはタイムスタンプ (ms) をキーに小さな LRU に保持する。
+    on_frame(timestamp_ms, image) はワーカースレッドから呼ばれる。
+    """
+
+    def __init__(self, file_path, max_size: tuple[int, int], on_frame, cache_size: int = 48):
+        import cv2
+
+        self.file_path = str(file_path)
+        self.max_size = max_size
+        self.on_frame = on_frame
+        self.cache_size = cache_size
+        self._capture = cv2.VideoCapture(self.file_path)
+        if not self._capture.isOpened():
+            raise ValueError(f"動画を開けません: {os.path.basename(self.file_path)}")
+        self.fps = self._capture.get(cv2.CAP_PROP_FPS) or 30.0
+        self.frame_count = int(self._capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        self.duration = self.frame_count / self.fps if self.frame_count else 0.0
+        self._cache: "OrderedDict[int, Image.Image]" = OrderedDict()
+        self._next_index = 0
+        self._pending = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _frame_index(self, seconds: float) -> int:
+        index = int(round(max(0.0, seconds) * self.fps))
+        if self.frame_count:
+            index = min(index, self.frame_count - 1)
+        return index
+
+    def _timestamp_ms(self, index: int) -> int:
+        return int(index * 1000 / self.fps)
+
+    def request(self, seconds: float):
+        """指定時刻のフレームを要求する。未処理の古い要求は最新のもので置き換える"""
+        timestamp = self._timestamp_ms(self._frame_index(seconds))
+        with self._cond:
+            cached = self._cache.get(timestamp)
+            if cached is not None:
+                self._cache.move_to_end(timestamp)
+            else:
+                self._pending = timestamp
+                self._cond.notify()
+        if cached is not None:
+            self.on_frame(timestamp, cached)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while self._pending is None and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                    timestamp = self._pending
+                    self._pending = None
+                image = self._grab(timestamp)
+                if image is None:
+                    continue
+                with self._cond:
+                    self._cache[timestamp] = image
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+                    if self._closed:
+                        return
+                self.on_frame(timestamp, image)
+        finally:
+            self._capture.release()
+
+    def _grab(self, timestamp: int):
+        import cv2
+
+        index = self._frame_index(timestamp / 1000)
+        # 直後のフレームなら順送りで読み、それ以外だけシークする（ファイルは開き直さない）
+        if index != self._next_index:
+            self._capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+        ok, frame = self._capture.read()
+        if not ok:
+            return None
+        self._next_index = index + 1
+        height, width = frame.shape[:2]
+        scale = min(self.max_size[0] / width, self.max_size[1] / height, 1.0)
+        if scale < 1.0:
+            frame = cv2.resize(
+                frame,
+                (max(1, int(width * scale)), max(1, int(height * scale))),
+                interpolation=cv2.INTER_AREA,
+            )
+        return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
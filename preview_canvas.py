@@ -0,0 +1,183 @@
+import tkinter as tk
+
+
+class PreviewCanvas(tk.Canvas):
+    """プレビュー画像を一度だけ載せ、Link Sticker の枠をキャンバス図形として動かす"""
+
+    HANDLE_SIZE = 7
+    MIN_SIZE = 0.02
+
+    def __init__(self, master, on_box_changed=None, icon_loader=None, **kwargs):
+        kwargs.setdefault("bg", "lightgray")
+        kwargs.setdefault("highlightthickness", 0)
+        super().__init__(master, **kwargs)
+        self.on_box_changed = on_box_changed
+        # icon_loader(path, (幅, 高さ)) -> 縮小済みの PIL 画像。枠の中にアイコンを表示する
+        self.icon_loader = icon_loader
+        self._source = None
+        self._photo = None
+        self._image_item = None
+        self._message_item = None
+        self._image_box = (0, 0, 0, 0)  # 画像の左上 x, y, 幅, 高さ（キャンバス座標）
+        self._boxes: dict[int, tuple[float, float, float, float]] = {}
+        self._icons: dict[int, str] = {}
+        self._icon_photos: dict[int, tuple[tuple, object]] = {}
+        self._drag = None
+
+        self.tag_bind("box", "<ButtonPress-1>", self._on_press_box)
+        self.tag_bind("handle", "<ButtonPress-1>", self._on_press_handle)
+        self.tag_bind("icon", "<ButtonPress-1>", self._on_press_icon)
+        self.bind("<B1-Motion>", self._on_motion)
+        self.bind("<ButtonRelease-1>", self._on_release)
+        self.bind("<Configure>", lambda _e: self._layout())
+
+    def show_message(self, text: str):
+        """画像を外してメッセージだけを表示"""
+        self.delete("all")
+        self._source = None
+        self._photo = None
+        self._image_item = None
+        self._boxes.clear()
+        self._icon_photos.clear()
+        self._message_item = self.create_text(
+            self.winfo_width() // 2, self.winfo_height() // 2, text=text, justify=tk.CENTER
+        )
+
+    def set_image(self, image):
+        """PIL 画像を表示。同じ画像オブジェクトなら何もしない"""
+        if image is self._source and self._image_item is not None:
+            return
+        from PIL import ImageTk
+
+        if self._message_item is not None:
+            self.delete(self._message_item)
+            self._message_item = None
+        self._source = image
+        self._photo = ImageTk.PhotoImage(image)
+        if self._image_item is None:
+            self._image_item = self.create_image(0, 0, anchor=tk.NW, image=self._photo)
+        else:
+            self.itemconfig(self._image_item, image=self._photo)
+        self.tag_lower(self._image_item)
+        self._layout()
+
+    def sync_boxes(self, boxes: dict[int, tuple[float, float, float, float]], icons: dict[int, str] | None = None):
+        """正規化座標 (中心x, 中心y, 幅, 高さ) の枠を作成・移動・削除する（icons があれば枠の中に表示）"""
+        self._icons = dict(icons or {})
+        if self._drag is not None:
+            # ドラッグ中の枠は自分が正なので入力欄からの反映で戻さない
+            boxes = {**boxes, self._drag["index"]: self._boxes[self._drag["index"]]}
+        for index in list(self._boxes):
+            if index not in boxes:
+                self.delete(f"box{index}")
+                self.delete(f"handle{index}")
+                self.delete(f"icon{index}")
+                self._icon_photos.pop(index, None)
+                del self._boxes[index]
+        if self._image_item is None:
+            return
+        for index, geom in boxes.items():
+            if index not in self._boxes:
+                self.create_rectangle(0, 0, 0, 0, outline="red", width=2, tags=("box", f"box{index}"))
+                self.create_rectangle(0, 0, 0, 0, outline="red", fill="white", tags=("handle", f"handle{index}"))
+            self._boxes[index] = geom
+            self._place_box(index)
+
+    def _layout(self):
+        if self._image_item is None or self._source is None:
+            if self._message_item is not None:
+                self.coords(self._message_item, self.winfo_width() // 2, self.winfo_height() // 2)
+            return
+        img_w, img_h = self._source.size
+        left = max(0, (self.winfo_width() - img_w) // 2)
+        top = max(0, (self.winfo_height() - img_h) // 2)
+        self._image_box = (left, top, img_w, img_h)
+        self.coords(self._image_item, left, top)
+        for index in self._boxes:
+            self._place_box(index)
+
+    def _place_box(self, index: int):
+        left, top, img_w, img_h = self._image_box
+        x, y, w, h = self._boxes[index]
+        x0 = left + (x - w / 2) * img_w
+        y0 = top + (y - h / 2) * img_h
+        x1 = left + (x + w / 2) * img_w
+        y1 = top + (y + h / 2) * img_h
+        self.coords(f"box{index}", x0, y0, x1, y1)
+        half = self.HANDLE_SIZE / 2
+        self.coords(f"handle{index}", x1 - half, y1 - half, x1 + half, y1 + half)
+        self._place_icon(index, x0, y0, x1, y1)
+        self.tag_raise(f"box{index}")
+        self.tag_raise(f"handle{index}")
+
+    def _place_icon(self, index: int, x0: float, y0: float, x1: float, y1: float):
+        icon_path = self._icons.get(index)
+        size = (max(1, round(x1 - x0)), max(1, round(y1 - y0)))
+        if not icon_path or self.icon_loader is None:
+            self.delete(f"icon{index}")
+            self._icon_photos.pop(index, None)
+            return
+        key = (icon_path, size)
+        cached = self._icon_photos.get(index)
+        if cached is None or cached[0] != key:
+            from PIL import ImageTk
+
+            try:
+                photo = ImageTk.PhotoImage(self.icon_loader(icon_path, size))
+            except Exception:
+                self.delete(f"icon{index}")
+                self._icon_photos.pop(index, None)
+                return
+            self._icon_photos[index] = (key, photo)
+            if self.find_withtag(f"icon{index}"):
+                self.itemconfig(f"icon{index}", image=photo)
+            else:
+                self.create_image(0, 0, anchor=tk.NW, image=photo, tags=("icon", f"icon{index}"))
+        self.coords(f"icon{index}", round(x0), round(y0))
+        self.tag_raise(f"icon{index}")
+
+    def _index_of_current(self, prefix: str):
+        for tag in self.gettags(tk.CURRENT):
+            if tag.startswith(prefix) and tag[len(prefix):].isdigit():
+                return int(tag[len(prefix):])
+        return None
+
+    def _start_drag(self, event, prefix: str, mode: str):
+        index = self._index_of_current(prefix)
+        if index is None or index not in self._boxes:
+            return
+        self._drag = {"index": index, "mode": mode, "start": (event.x, event.y), "geom": self._boxes[index]}
+
+    def _on_press_box(self, event):
+        self._start_drag(event, "box", "move")
+
+    def _on_press_handle(self, event):
+        self._start_drag(event, "handle", "resize")
+
+    def _on_press_icon(self, event):
+        self._start_drag(event, "icon", "move")
+
+    def _on_motion(self, event):
+        if self._drag is None:
+            return
+        _left, _top, img_w, img_h = self._image_box
+        if not img_w or not img_h:
+            return
+        dx = (event.x - self._drag["start"][0]) / img_w
+        dy = (event.y - self._drag["start"][1]) / img_h
+        x, y, w, h = self._drag["geom"]
+        if self._drag["mode"] == "move":
+            geom = (x + dx, y + dy, w, h)
+        else:
+            # 左上を固定して右下のハンドルで拡縮
+            new_w = max(self.MIN_SIZE, w + dx)
+            new_h = max(self.MIN_SIZE, h + dy)
+            geom = (x - w / 2 + new_w / 2, y - h / 2 + new_h / 2, new_w, new_h)
+        index = self._drag["index"]
+        self._boxes[index] = geom
+        self._place_box(index)
+        if self.on_box_changed:
+            self.on_box_changed(index, geom)
+
+    def _on_release(self, _event):
+        self._drag = None
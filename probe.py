@@ -0,0 +1,192 @@
+import logging
+import os
+import re
+import subprocess
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PASSTHROUGH = "passthrough"
+REMUX = "remux"
+TRANSCODE = "transcode"
+
+# そのままストーリーとして受け付けられる動画の条件
+STORY_MAX_DURATION = 60.0
+STORY_MAX_FPS = 60.0
+STORY_MAX_BITRATE = 25_000_000
+STORY_MAX_SIZE = (1080, 1920)
+STORY_MIN_SIZE = (540, 960)
+STORY_ASPECT = 9 / 16
+STORY_ASPECT_TOLERANCE = 0.01
+STORY_BRANDS = {"isom", "iso2", "iso4", "iso5", "iso6", "mp41", "mp42", "avc1", "M4V ", "qt  "}
+
+# StoryBuilder(moviepy) の再エンコード速度の目安（実時間比）。節約時間の推定に使う
+ESTIMATED_TRANSCODE_SPEED = 1.0
+
+
+def ffmpeg_exe() -> str:
+    """moviepy が同梱している ffmpeg を使う（PATH に無い環境でも動く）"""
+    import imageio_ffmpeg
+
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+@dataclass
+class VideoProbe:
+    path: Path
+    size_bytes: int
+    container: str = ""
+    video_codec: str = ""
+    pix_fmt: str = ""
+    audio_codec: str = ""
+    width: int = 0
+    height: int = 0
+    fps: float = 0.0
+    bitrate: int = 0
+    duration: float = 0.0
+    rotation: float = 0.0
+    faststart: bool = False
+
+
+@dataclass
+class VideoPlan:
+    decision: str
+    reasons: list[str] = field(default_factory=list)
+
+
+def _scan_atoms(path: Path) -> tuple[str, bool]:
+    """MP4 のトップレベル atom を読み、ブランドと moov が mdat より前にあるかを返す"""
+    brand = ""
+    seen = []
+    with open(path, "rb") as fp:
+        file_size = os.fstat(fp.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size and len(seen) < 64:
+            fp.seek(offset)
+            header = fp.read(16)
+            size = int.from_bytes(header[0:4], "big")
+            kind = header[4:8].decode("latin-1")
+            if size == 1:
+                size = int.from_bytes(header[8:16], "big")
+            elif size == 0:
+                size = file_size - offset
+            if size < 8:
+                break
+            if kind == "ftyp":
+                brand = header[8:12].decode("latin-1")
+            seen.append(kind)
+            offset += size
+    faststart = "moov" in seen and ("mdat" not in seen or seen.index("moov") < seen.index("mdat"))
+    return brand, faststart
+
+
+def probe_video(path) -> VideoProbe:
+    """ネットワークを使わずにローカルのメタデータだけで動画の情報を読む"""
+    path = Path(path)
+    probe = VideoProbe(path=path, size_bytes=path.stat().st_size)
+    probe.container, probe.faststart = _scan_atoms(path)
+
+    result = subprocess.run([ffmpeg_exe(), "-hide_banner", "-i", str(path)], capture_output=True)
+    parse_ffmpeg_info(result.stderr.decode(errors="replace"), probe)
+    if probe.duration > 0:
+        probe.bitrate = int(probe.size_bytes * 8 / probe.duration)
+    return probe
+
+
+def parse_ffmpeg_info(info: str, probe: VideoProbe) -> VideoProbe:
+    """ffmpeg -i の出力から長さ・映像/音声の形式・回転を読む（読めなかった項目は空文字か 0 のまま）"""
+    if match := re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", info):
+        hours, minutes, seconds = match.groups()
+        probe.duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    # 画素形式には yuv420p(tv, bt709, progressive) のように色の情報が付くことがある
+    if match := re.search(r"Stream #\S+: Video: (\w+)[^,]*, (\w+)(?:\([^)]*\))?, (\d+)x(\d+)", info):
+        probe.video_codec = match.group(1)
+        probe.pix_fmt = match.group(2)
+        probe.width = int(match.group(3))
+        probe.height = int(match.group(4))
+    if match := re.search(r"Video: .*?([\d.]+) fps", info):
+        probe.fps = float(match.group(1))
+    if match := re.search(r"Stream #\S+: Audio: (\w+)", info):
+        probe.audio_codec = match.group(1)
+    if match := re.search(r"rotation of (-?[\d.]+) degrees", info):
+        probe.rotation = float(match.group(1))
+    return probe
+
+
+def plan_video(probe: VideoProbe) -> VideoPlan:
+    """そのままアップロード / 再多重化のみ / 再エンコード のどれで足りるかを決める"""
+    reasons = []
+    if probe.container not in STORY_BRANDS:
+        reasons.append(f"コンテナ {probe.container or '不明'}")
+    if probe.video_codec != "h264":
+        reasons.append(f"映像コーデック {probe.video_codec or '不明'}")
+    if probe.pix_fmt not in ("yuv420p", "yuvj420p"):
+        reasons.append(f"画素形式 {probe.pix_fmt or '不明'}")
+    if probe.rotation % 360:
+        reasons.append(f"回転メタデータ {probe.rotation:g}°")
+    if not probe.width or not probe.height:
+        reasons.append("解像度 不明")
+    elif not (STORY_MIN_SIZE[0] <= probe.width <= STORY_MAX_SIZE[0] and STORY_MIN_SIZE[1] <= probe.height <= STORY_MAX_SIZE[1]):
+        reasons.append(f"解像度 {probe.width}x{probe.height}")
+    elif abs(probe.width / probe.height - STORY_ASPECT) > STORY_ASPECT * STORY_ASPECT_TOLERANCE:
+        reasons.append(f"アスペクト比 {probe.width}:{probe.height}")
+    if not 0 < probe.fps <= STORY_MAX_FPS:
+        reasons.append(f"フレームレート {probe.fps:g}")
+    if not 0 < probe.duration <= STORY_MAX_DURATION:
+        reasons.append(f"長さ {probe.duration:.1f}s")
+    if probe.bitrate > STORY_MAX_BITRATE:
+        reasons.append(f"ビットレート {probe.bitrate // 1000}kbps")
+    if reasons:
+        return VideoPlan(TRANSCODE, reasons)
+
+    if not probe.faststart:
+        reasons.append("moov が末尾")
+    if probe.audio_codec and probe.audio_codec != "aac":
+        reasons.append(f"音声コーデック {probe.audio_codec}")
+    if probe.container == "qt  ":
+        reasons.append("QuickTime コンテナ")
+    if reasons:
+        return VideoPlan(REMUX, reasons)
+    return VideoPlan(PASSTHROUGH)
+
+
+def remux_for_story(src_path, dst_path):
+    """映像はコピーのまま MP4 (faststart) に詰め直す。音声は AAC 以外なら AAC にする"""
+    command = [
+        ffmpeg_exe(), "-loglevel", "error", "-y", "-i", str(src_path),
+        "-map", "0:v:0", "-map", "0:a:0?", "-c:v", "copy", "-c:a", "aac",
+        "-movflags", "+faststart", str(dst_path),
+    ]
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg が失敗しました: {result.stderr.decode(errors='replace')[-500:]}")
+
+
+def prepare_story_video(path, remux_path) -> tuple[Path | None, VideoPlan]:
+    """判定に従って動画を用意する。再エンコードが必要なら (None, plan) を返す"""
+    started = time.perf_counter()
+    probe = probe_video(path)
+    plan = plan_video(probe)
+    if plan.decision == PASSTHROUGH:
+        result = Path(path)
+    elif plan.decision == REMUX:
+        remux_for_story(path, remux_path)
+        result = Path(remux_path)
+    else:
+        result = None
+    elapsed = time.perf_counter() - started
+    if result is None:
+        logger.info(
+            "video %s: %s (%s), probe %.2fs",
+            Path(path).name, plan.decision, ", ".join(plan.reasons), elapsed,
+        )
+    else:
+        saved = max(0.0, probe.duration / ESTIMATED_TRANSCODE_SPEED - elapsed)
+        logger.info(
+            "video %s: %s%s, %.2fs (StoryBuilder 再エンコードを省略, 推定 %.1fs 短縮)",
+            Path(path).name, plan.decision,
+            f" ({', '.join(plan.reasons)})" if plan.reasons else "", elapsed, saved,
+        )
+    return result, plan
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import logging
+import random
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 一時的な失敗とみなして再開する HTTP ステータス
+TRANSIENT_STATUS = (408, 429, 500, 502, 503, 504)
+# 1 チャンクの本体をファイルから読む単位（進捗の通知もこの単位）
+READ_SIZE = 64 * 1024
+
+
+@dataclass
+class UploadProgress:
+    """アップロードの進捗（sent は送信済みバイト数）"""
+
+    sent: int
+    total: int
+    attempt: int = 1
+    done: bool = False
+
+    @property
+    def fraction(self) -> float:
+        return self.sent / self.total if self.total else 1.0
+
+
+class UploadFailed(Exception):
+    def __init__(self, message: str, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+class _Transient(Exception):
+    pass
+
+
+class _ProgressReader:
+    """長さの分かるファイル風オブジェクト。読まれた（＝送信された）バイト数を進捗として通知する
+
+    ジェネレーターを渡すと requests が chunked 転送にしてしまうので、__len__ を持たせて Content-Length で送る。
+    """
+
+    def __init__(self, fp, length: int, start: int, chunk_size: int, emit):
+        self._fp = fp
+        self._remaining = length
+        self._sent = start
+        self._chunk_size = chunk_size
+        self._emit = emit
+
+    def __len__(self) -> int:
+        return self._remaining
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self._chunk_size:
+            size = self._chunk_size
+        data = self._fp.read(min(size, self._remaining))
+        self._remaining -= len(data)
+        self._sent += len(data)
+        if data:
+            self._emit(self._sent)
+        return data
+
+
+class Checkpoint:
+    """再開用の情報（アップロード名と確認済みのオフセット）を JSON で保存する
+
+    同じファイル（パス・サイズ・更新時刻）と scope（アカウント等）の組にだけ使われる。
+    """
+
+    def __init__(self, directory, path: Path, scope: str = ""):
+        self.state: dict = {}
+        stat = path.stat()
+        self.fingerprint = {"path": str(path.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        digest = hashlib.sha256(json.dumps([scope, self.fingerprint], sort_keys=True).encode("utf-8")).hexdigest()
+        self.path = Path(directory) / f"{digest[:32]}.json"
+
+    def load(self) -> dict | None:
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if data.get("file") != self.fingerprint:
+            return None
+        self.state = data.get("state", {})
+        return self.state
+
+    def save(self, **updates):
+        self.state.update(updates)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"file": self.fingerprint, "state": self.state}), encoding="utf-8")
+        tmp.replace(self.path)
+
+    def clear(self):
+        self.state = {}
+        self.path.unlink(missing_ok=True)
+
+
+class ResumableUploader:
+    """rupload 形式（GET で受信済みオフセットを聞き、POST で Offset から送る）の再開可能なアップロード
+
+    本体は chunk_size ずつの POST で送り、サーバーが受け取ったと応答したオフセットを 1 チャンクごとに
+    チェックポイントへ保存する（各 POST は READ_SIZE ずつ読みながら送るのでファイル全体をメモリに載せない）。
+    接続断や 5xx / 429 のときは指数バックオフ（ジッター付き）を挟み、サーバーに問い合わせた（問い合わせも
+    失敗したらチェックポイントの）オフセットから送り直す。進捗の sent は送り直しても減らない。
+    session は requests.Session 互換（get / post）であればよい。
+    """
+
+    def __init__(
+        self,
+        session,
+        url: str,
+        path,
+        headers: dict | None = None,
+        *,
+        chunk_size: int = 1024 * 1024,
+        max_retries: int = 8,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+        timeout: float = 60.0,
+        on_progress=None,
+        checkpoint: Checkpoint | None = None,
+        progress_interval: float = 0.1,
+        sleep=time.sleep,
+    ):
+        self.session = session
+        self.url = url
+        self.path = Path(path)
+        self.headers = dict(headers or {})
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.on_progress = on_progress
+        self.checkpoint = checkpoint
+        self.progress_interval = progress_interval
+        self.sleep = sleep
+        self.total = self.path.stat().st_size
+        self.attempt = 0
+        self.retries = 0
+        self.last_response = None
+        self._last_emit = 0.0
+        self._high_water = 0
+
+    def _emit(self, sent: int, done: bool = False, force: bool = False):
+        if self.on_progress is None:
+            return
+        # 切断されたチャンクの送り直しで進捗が戻って見えないようにする
+        sent = self._high_water = max(self._high_water, sent)
+        now = time.monotonic()
+        if not (done or force) and now - self._last_emit < self.progress_interval:
+            return
+        self._last_emit = now
+        try:
+            self.on_progress(UploadProgress(sent, self.total, self.attempt, done))
+        except Exception as e:
+            logger.info(f"progress callback failed: {e}")
+
+    def _backoff(self):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (self.retries - 1))
+        self.sleep(delay * random.uniform(0.5, 1.0))
+
+    def query_offset(self) -> int:
+        """サーバーが受け取り済みのバイト数"""
+        response = self.session.get(self.url, headers=self.headers, timeout=self.timeout)
+        self.last_response = response
+        if response.status_code in TRANSIENT_STATUS:
+            raise _Transient(f"offset query: HTTP {response.status_code}")
+        if response.status_code != 200:
+            raise UploadFailed(response.text, response=response)
+        try:
+            offset = int(response.json().get("offset") or 0)
+        except (ValueError, AttributeError, TypeError):
+            offset = 0
+        return min(max(0, offset), self.total)
+
+    def _resume_offset(self) -> int:
+        """続きを送るオフセット。問い合わせが一時的に失敗したら、前回確認してチェックポイントに残したものを使う"""
+        try:
+            offset = self.query_offset()
+        except (_Transient, *self._network_errors()) as e:
+            saved = self.checkpoint.state.get("offset") if self.checkpoint is not None else None
+            if saved is None:
+                raise
+            logger.info(f"offset query failed ({e}); resuming from checkpoint offset {saved}")
+            return min(max(0, int(saved)), self.total)
+        if self.checkpoint is not None:
+            self.checkpoint.save(offset=offset)
+        return offset
+
+    @staticmethod
+    def _network_errors() -> tuple:
+        import requests
+
+        return (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError)
+
+    def _post(self, offset: int, end: int):
+        """offset から end までの 1 チャンクを送る"""
+        headers = {
+            **self.headers,
+            "Offset": str(offset),
+            "X-Entity-Length": str(self.total),
+            "Content-Length": str(end - offset),
+            "Content-Type": "application/octet-stream",
+        }
+        with self.path.open("rb") as fp:
+            fp.seek(offset)
+            body = _ProgressReader(fp, end - offset, offset, READ_SIZE, self._emit)
+            response = self.session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+        self.last_response = response
+        if response.status_code in TRANSIENT_STATUS:
+            raise _Transient(f"upload: HTTP {response.status_code}")
+        if response.status_code != 200:
+            raise UploadFailed(response.text, response=response)
+        return response
+
+    def upload(self):
+        """最後まで送り、最後の POST のレスポンスを返す"""
+        transient_errors = (_Transient, *self._network_errors())
+        while True:
+            self.attempt += 1
+            try:
+                offset = self._resume_offset()
+                if self.attempt > 1:
+                    logger.info(f"resuming upload of {self.path.name} at {offset}/{self.total} bytes")
+                self._emit(offset, force=True)
+                while True:
+                    end = min(offset + self.chunk_size, self.total)
+                    response = self._post(offset, end)
+                    offset = end
+                    if offset >= self.total:
+                        break
+                    if self.checkpoint is not None:
+                        self.checkpoint.save(offset=offset)
+            except transient_errors as e:
+                self.retries += 1
+                if self.retries > self.max_retries:
+                    raise UploadFailed(f"{self.path.name}: 再試行の上限に達しました: {e}") from e
+                logger.info(f"upload interrupted ({e}); retry {self.retries}/{self.max_retries}")
+                self._backoff()
+                continue
+            if self.checkpoint is not None:
+                self.checkpoint.clear()
+            self._emit(self.total, done=True)
+            return response
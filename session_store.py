@@ -0,0 +1,38 @@
+import json
+import time
+from pathlib import Path
+
+
+class SessionStore:
+    """session.json と、その横に置くアカウント情報キャッシュ（ユーザー名・最終確認時刻）"""
+
+    def __init__(self, session_path=Path("session.json"), ttl: float = 6 * 3600):
+        self.session_path = Path(session_path)
+        self.info_path = self.session_path.with_name(f"{self.session_path.stem}.info.json")
+        # この秒数以内に確認済みのセッションはネットワーク確認を省略する
+        self.ttl = ttl
+
+    def has_session(self) -> bool:
+        return self.session_path.exists()
+
+    def load_info(self) -> dict | None:
+        try:
+            info = json.loads(self.info_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return info if isinstance(info, dict) and info.get("username") else None
+
+    def save_info(self, username: str, validated_at: float | None = None):
+        info = {"username": username, "validated_at": validated_at or time.time()}
+        self.info_path.write_text(json.dumps(info, ensure_ascii=False), encoding="utf-8")
+
+    def is_fresh(self, info: dict | None) -> bool:
+        if not info:
+            return False
+        age = time.time() - float(info.get("validated_at") or 0)
+        return 0 <= age < self.ttl
+
+    def clear(self):
+        for path in (self.session_path, self.info_path):
+            if path.exists():
+                path.unlink()
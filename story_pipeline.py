@@ -0,0 +1,401 @@
+import logging
+import os
+import tempfile
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import cast
+
+from PIL import Image
+
+import perf_log
+from autofit import LETTERBOX, FitPlan, map_links, map_overlays
+from icon_cache import icon_cache
+from photo_story import JpegSettings
+
+logger = logging.getLogger(__name__)
+
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+VIDEO_EXTENSIONS = (".mp4",)
+
+# Link Sticker の既定の位置とサイズ（正規化座標。X, Y は中心）
+DEFAULT_LINK_GEOM = {
+    "x": 0.5126011,
+    "y": 0.5168225,
+    "w": 0.50998676,
+    "h": 0.25875,
+}
+
+
+def default_resample():
+    """使える中で最も高品質な縮小フィルタ"""
+    resampling = getattr(Image, "Resampling", Image)
+    return getattr(resampling, "LANCZOS", getattr(resampling, "BICUBIC", getattr(resampling, "NEAREST", 0)))
+
+
+def default_encode_workers() -> int:
+    """動画焼き込みのセグメント並列エンコードのプロセス数の既定値（コアが 2 以下なら並列にしない）"""
+    cores = os.cpu_count() or 1
+    return cores if cores > 2 else 1
+
+
+@dataclass
+class StoryOptions:
+    """ストーリー素材の作り方（UI / キューのワーカーから共通で使う）"""
+
+    resample: int
+    # 写真ストーリーの生成方法: "direct"（Pillow で JPEG）/ "builder"（StoryBuilder で MP4 化）
+    photo_mode: str = "direct"
+    photo_jpeg: JpegSettings | None = None
+    # 動画焼き込みのセグメント並列エンコードに使うプロセス数（1 で単一プロセス）
+    encode_workers: int = 1
+    # 縦横比が 9:16 でない素材の合わせ方: "crop" / "letterbox" / "blur"（autofit.FIT_MODES）
+    fit_mode: str = LETTERBOX
+
+
+@dataclass
+class PreparedStory:
+    """アップロード可能な状態まで加工した素材と、後で消す一時ファイル"""
+
+    kind: str  # "photo" / "video"
+    path: Path
+    temp_paths: list[Path] = field(default_factory=list)
+    cache_hit: bool = False
+    # キャンバスに合わせた場合の FitPlan.to_dict()。投稿時に Link の位置を直すのに使う
+    fit: dict | None = None
+    # 合わせる必要があったのに失敗し、元の素材のまま投稿する（キャッシュには残さない）
+    fit_failed: bool = False
+
+    def cleanup(self):
+        for temp_path in self.temp_paths:
+            try:
+                temp_path.unlink(missing_ok=True)
+            except Exception:
+                pass
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "path": str(self.path),
+            "temp_paths": [str(p) for p in self.temp_paths],
+            "cache_hit": self.cache_hit,
+            "fit": self.fit,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PreparedStory":
+        return cls(
+            data["kind"], Path(data["path"]), [Path(p) for p in data.get("temp_paths", [])],
+            data.get("cache_hit", False), data.get("fit"),
+        )
+
+
+def link_overlays(links: list[dict]) -> list[dict]:
+    """Link の指定 {url, x, y, w, h, icon_path} から合成用の {icon_path, geom} を作る"""
+    return [
+        {"icon_path": link.get("icon_path") or "", "geom": (link["x"], link["y"], link["w"], link["h"])}
+        for link in links
+    ]
+
+
+def build_story_links(links: list[dict]) -> list:
+    """Link の指定から instagrapi の StoryLink を作る"""
+    from instagrapi.types import StoryLink
+    from pydantic import HttpUrl
+
+    return [
+        StoryLink(webUri=cast(HttpUrl, link["url"]), x=link["x"], y=link["y"], width=link["w"], height=link["h"])
+        for link in links
+    ]
+
+
+def fit_plan(file_path, fit_mode: str) -> FitPlan | None:
+    """素材をストーリーのキャンバスに合わせる plan（縦横比が合っていれば None）
+
+    写真は EXIF の向きを戻した後、動画はデコードしたフレームの大きさで決める。Link の位置は素材に対する
+    座標なので、合成と投稿の前に plan で直す。
+    """
+    from photo_story import STORY_SIZE, story_plan
+
+    file_path = Path(file_path)
+    ext = file_path.suffix.lower()
+    try:
+        if ext in PHOTO_EXTENSIONS:
+            with Image.open(file_path) as image:
+                plan, _orientation = story_plan(image, fit_mode)
+        elif ext in VIDEO_EXTENSIONS:
+            from compositor import video_frame_size
+
+            plan = FitPlan.plan(video_frame_size(file_path), fit_mode, STORY_SIZE)
+        else:
+            return None
+    except Exception as e:
+        logger.warning(f"素材の大きさを読めません: {e}")
+        return None
+    return None if plan.fits else plan
+
+
+def _temp_path(suffix: str, work_dir=None) -> Path:
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=work_dir) as tmp:
+        return Path(tmp.name)
+
+
+def _downscale_to_story_width(base: Image.Image, resample) -> Image.Image:
+    """幅 1080 を超える画像を幅 1080 まで縮める（JPEG は縮小デコード）。RGB か RGBA にして返す"""
+    from photo_story import REDUCING_GAP, STORY_SIZE, decode_budget, estimate_decode_bytes
+
+    width = STORY_SIZE[0]
+    if base.width > width:
+        target = (width, max(1, round(base.height * width / base.width)))
+        if base.format == "JPEG" and base.mode in ("RGB", "L"):
+            base.draft(base.mode, target)
+    else:
+        target = base.size
+    with decode_budget.reserve(estimate_decode_bytes(base)):
+        has_alpha = base.mode in ("RGBA", "LA", "PA") or "transparency" in base.info
+        mode = "RGBA" if has_alpha else "RGB"
+        canvas = base
+        if canvas.mode not in ("RGB", "RGBA", "L", "LA"):
+            # パレット等は縮小前に変換しないと最近傍補間になる
+            canvas = canvas.convert(mode)
+        if canvas.size != target:
+            canvas = canvas.resize(target, resample, reducing_gap=REDUCING_GAP)
+        if canvas.mode != mode:
+            canvas = canvas.convert(mode)
+    return canvas
+
+
+def _legacy_photo_composite(file_path: Path, overlays, resample, work_dir, temp_paths: list[Path],
+                            fit: FitPlan | None = None) -> Path:
+    """アイコンを合成した画像を作る（StoryBuilder に渡す用）
+
+    StoryBuilder は幅 720 に縮めて使うので、それより十分大きい（幅 1080 超の）元画像は先に幅 1080 まで
+    縮めてから合成する（JPEG は縮小デコード）。アイコンはその範囲だけに貼り、全体の複製は作らない。
+    fit があれば先に 1080x1920 のキャンバスに合わせる（overlays の位置はキャンバスに対する座標）。
+    """
+    from compositor import icon_box, paste_clipped
+    from photo_story import decode_budget, draft_for_story, estimate_decode_bytes, fit_to_story
+
+    try:
+        with Image.open(file_path) as base:
+            if fit is not None:
+                # 縦横比が合わない素材は 1080x1920 のキャンバスに合わせてから合成する
+                draft_for_story(base, fit.mode)
+                with decode_budget.reserve(estimate_decode_bytes(base, fit.mode)):
+                    canvas = fit_to_story(base, resample, mode=fit.mode)
+            else:
+                canvas = _downscale_to_story_width(base, resample)
+            if canvas is not base:
+                # 元の解像度のバッファはここで手放す
+                base.close()
+            for item in overlays:
+                icon_path = item.get("icon_path")
+                if not icon_path or not item.get("geom"):
+                    continue
+                try:
+                    paste_x, paste_y, target_w, target_h = icon_box(item["geom"], canvas.size)
+                    icon_resized = icon_cache.get(icon_path, (target_w, target_h), resample)
+                    if canvas.mode == "RGBA":
+                        paste_clipped(canvas, icon_resized, paste_x, paste_y)
+                    else:
+                        # 不透明なキャンバスにはマスク付き paste でアルファ合成と同じ結果になる
+                        canvas.paste(icon_resized, (paste_x, paste_y), icon_resized)
+                except Exception as e:
+                    logger.warning(f"アイコン合成に失敗: {e}")
+                    continue
+
+            # 形式は元画像に合わせる（JPEGの場合はRGBに変換）
+            suffix = file_path.suffix.lower()
+            if suffix in [".jpg", ".jpeg"]:
+                if canvas.mode != "RGB":
+                    canvas = canvas.convert("RGB")
+                suffix = ".jpg"
+            target_path = _temp_path(suffix, work_dir)
+            temp_paths.append(target_path)
+            canvas.save(target_path)
+            return target_path
+    except Exception as e:
+        logger.warning(f"合成処理に失敗: {e}")
+        return file_path
+
+
+def _prepare_photo(file_path: Path, overlays, options: StoryOptions, work_dir, temp_paths: list[Path],
+                   fit: FitPlan | None = None) -> tuple[Path, bool]:
+    """(投稿するファイル, fit をキャンバスに合わせ済みか) を返す"""
+    from photo_story import prepare_photo_story
+
+    # Pillow で直接 1080x1920 の JPEG を作る。失敗時のみ StoryBuilder(MP4 経由) にフォールバック
+    if options.photo_mode == "direct":
+        try:
+            with perf_log.stage("photo_story"):
+                prepared = prepare_photo_story(file_path, overlays, options.resample, options.photo_jpeg,
+                                               fit_mode=options.fit_mode)
+            # instagrapi はパス指定でしか受け取らないので、エンコード済みのバイト列を 1 回だけ書き出す
+            story_path = _temp_path(".jpg", work_dir)
+            temp_paths.append(story_path)
+            return prepared.write_to(story_path), fit is not None
+        except Exception as e:
+            logger.warning(f"写真ストーリーの生成に失敗（StoryBuilder で再試行）: {e}")
+
+    target_path = file_path
+    if fit is not None or any(item.get("icon_path") for item in overlays):
+        with perf_log.stage("composite"):
+            target_path = _legacy_photo_composite(file_path, overlays, options.resample, work_dir, temp_paths, fit)
+
+    from instagrapi.story import StoryBuilder
+
+    with perf_log.stage("story_builder") as timer:
+        story_path = StoryBuilder(target_path).photo().path
+        timer.bytes = Path(story_path).stat().st_size
+    # 合成に失敗したときは元の画像のまま（キャンバスに合わせていない）
+    return story_path, fit is not None and target_path != file_path
+
+
+def _prepare_video(file_path: Path, overlays, options: StoryOptions, work_dir, temp_paths: list[Path],
+                   fit: FitPlan | None = None) -> tuple[Path, bool]:
+    """(投稿するファイル, fit をキャンバスに合わせ済みか) を返す"""
+    from compositor import composite_video_parallel
+    from probe import prepare_story_video
+
+    # 動画ストーリー（必要ならキャンバスに合わせ、アイコンを焼き込み）
+    target_video_path = file_path
+    if fit is not None or any(item.get("icon_path") for item in overlays):
+        try:
+            # フレーム単位でキャンバスに合わせてアイコンをブレンドしながら ffmpeg にストリーム出力
+            composite_path = _temp_path(".mp4", work_dir)
+            temp_paths.append(composite_path)
+            with perf_log.stage("video_composite", workers=options.encode_workers,
+                                fit=fit.mode if fit else None) as timer:
+                if composite_video_parallel(file_path, composite_path, overlays, options.resample,
+                                            workers=options.encode_workers, fit=fit):
+                    target_video_path = composite_path
+                    timer.bytes = composite_path.stat().st_size
+        except Exception as e:
+            logger.warning(f"動画へのアイコン合成に失敗: {e}")
+
+    # 既にストーリー向けの形式ならそのまま / 再多重化だけで送り、StoryBuilder の再エンコードを避ける
+    remux_path = _temp_path(".mp4", work_dir)
+    temp_paths.append(remux_path)
+    try:
+        with perf_log.stage("video_probe"):
+            upload_path, _plan = prepare_story_video(target_video_path, remux_path)
+    except Exception as e:
+        logger.warning(f"動画の事前判定に失敗: {e}")
+        upload_path = None
+    if upload_path is None:
+        from instagrapi.story import StoryBuilder
+
+        with perf_log.stage("story_builder") as timer:
+            upload_path = StoryBuilder(target_video_path).video().path
+            timer.bytes = Path(upload_path).stat().st_size
+    # 焼き込みに失敗したときは元の動画のまま（キャンバスに合わせていない）
+    return Path(upload_path), fit is not None and target_video_path != file_path
+
+
+def prepare_story(file_path, overlays, options: StoryOptions, work_dir=None) -> PreparedStory:
+    """ファイルをアップロードできる形に加工する（合成・エンコード・StoryBuilder）
+
+    work_dir を指定すると一時ファイルをそこに作る。失敗したら作りかけの一時ファイルは消す。
+    縦横比が 9:16 でなければ options.fit_mode でキャンバスに合わせ、overlays の位置もキャンバスに対する
+    座標に直す（投稿時の Link は PreparedStory.fit で直す）。合わせるのに失敗して元の素材のまま投稿するときは
+    fit を付けない（Link を素材に対する位置のまま使う）。
+    """
+    file_path = Path(file_path)
+    ext = os.path.splitext(str(file_path))[1].lower()
+    temp_paths: list[Path] = []
+    fit = fit_plan(file_path, options.fit_mode)
+    # 省いたアイコンの Link は投稿時に map_links でも省かれ、そちらで結果に出す
+    overlays, _dropped = map_overlays(overlays, fit)
+    try:
+        if ext in PHOTO_EXTENSIONS:
+            path, fitted = _prepare_photo(file_path, overlays, options, work_dir, temp_paths, fit)
+            return PreparedStory("photo", path, temp_paths, fit=fit.to_dict() if fitted else None,
+                                 fit_failed=fit is not None and not fitted)
+        if ext in VIDEO_EXTENSIONS:
+            path, fitted = _prepare_video(file_path, overlays, options, work_dir, temp_paths, fit)
+            return PreparedStory("video", path, temp_paths, fit=fit.to_dict() if fitted else None,
+                                 fit_failed=fit is not None and not fitted)
+        raise ValueError("未対応のファイル形式です")
+    except Exception:
+        PreparedStory("", file_path, temp_paths).cleanup()
+        raise
+
+
+def cache_settings(options: StoryOptions) -> dict:
+    """出力に影響するエンコード設定（並列数は結果を変えないので含めない）"""
+    return {
+        "resample": int(options.resample),
+        "photo_mode": options.photo_mode,
+        "photo_jpeg": asdict(options.photo_jpeg) if options.photo_jpeg else None,
+        "fit_mode": options.fit_mode,
+    }
+
+
+def prepare_story_cached(file_path, overlays, options: StoryOptions, cache=None, work_dir=None) -> PreparedStory:
+    """PreparedMediaCache に同じ入力の加工結果があればそれを使い、無ければ加工して保存する"""
+    if cache is None:
+        return prepare_story(file_path, overlays, options, work_dir)
+    with perf_log.stage("cache_lookup") as timer:
+        try:
+            key = cache.key_for(file_path, overlays, cache_settings(options))
+        except OSError as e:
+            logger.warning(f"加工済みキャッシュのキー作成に失敗: {e}")
+            key = None
+        found = cache.checkout(key, work_dir) if key is not None else None
+        timer.extra["hit"] = found is not None
+    if key is None:
+        return prepare_story(file_path, overlays, options, work_dir)
+    if found is not None:
+        kind, path, meta = found
+        # Link を直すための plan は素材と一緒に保存してある（元ファイルを開き直さない）
+        return PreparedStory(kind, path, [path], cache_hit=True, fit=meta.get("fit"))
+    prepared = prepare_story(file_path, overlays, options, work_dir)
+    if prepared.fit_failed:
+        # キャンバスに合わせられなかった結果は残さない（次は合わせられるかもしれない）
+        return prepared
+    with perf_log.stage("cache_store"):
+        cache.put(key, prepared.kind, prepared.path, {"fit": prepared.fit})
+    return prepared
+
+
+def upload_prepared(client, prepared: PreparedStory, story_links: list):
+    """加工済みの素材を 1 アカウントに投稿する"""
+    if prepared.kind == "photo":
+        return client.photo_upload_to_story(prepared.path, links=story_links)
+    return client.video_upload_to_story(prepared.path, links=story_links)
+
+
+def _pacing_wait(pacer) -> float:
+    return sum(stats["waited_s"] for stats in pacer.stats().values()) if pacer is not None else 0.0
+
+
+def upload_to_accounts(pool, links: list[dict], account_keys: list[str], prepared: PreparedStory, on_progress=None):
+    """加工済みの素材を AccountPool の複数アカウントへ並列に投稿する
+
+    (アカウントのキー -> エラー文, アカウントごとの FanOutResult, キャンバスの外に出て省いた Link) を返す。
+    エラーが空なら全件成功。
+    on_progress(ユーザー名, UploadProgress) には動画の送信バイト数が届く（ワーカースレッドから呼ばれる）。
+    """
+    # 素材に対する Link の位置を、キャンバスに合わせた後の位置に直す
+    mapped, dropped = map_links(links, FitPlan.from_dict(prepared.fit) if prepared.fit else None)
+    story_links = build_story_links(mapped)
+    # fan-out のワーカースレッドからも呼び出し元の計測に記録する
+    run = perf_log.current_run()
+
+    def upload(client, account):
+        pacer = getattr(client, "pacer", None)
+        waited = _pacing_wait(pacer)
+        with perf_log.stage(f"upload:{account.username}", run=run, parent="upload") as timer:
+            timer.bytes = prepared.path.stat().st_size
+            if on_progress is not None:
+                client.upload_progress = lambda event: on_progress(account.username, event)
+            try:
+                return upload_prepared(client, prepared, story_links)
+            finally:
+                client.upload_progress = None
+                # 固定の delay_range の代わりに入ったペース配分の待ち時間
+                timer.extra["pacing_wait_s"] = round(_pacing_wait(pacer) - waited, 3)
+
+    errors = {key: "アカウントが見つかりません" for key in account_keys if pool.get(key) is None}
+    results = pool.fan_out(account_keys, upload, with_account=True)
+    errors.update({result.key: f"{result.account}: {result.error}" for result in results if not result.ok})
+    return errors, results, dropped
@@ -0,0 +1,123 @@
+import os
+
+import pytest
+
+from hot_folder import DUPLICATE, SKIPPED, FileLedger, HotFolder
+from upload_queue import DONE, QUEUED
+
+SETTLE = 2.0
+
+
+class FakeSubmit:
+    """submit の代わり。渡されたパスを記録して連番のジョブ ID を返す"""
+
+    def __init__(self):
+        self.paths = []
+
+    def __call__(self, path, sidecar):
+        self.paths.append(path.name)
+        return len(self.paths)
+
+
+@pytest.fixture
+def folder(tmp_path):
+    directory = tmp_path / "exports"
+    directory.mkdir()
+    return directory
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = FileLedger(tmp_path / "hot_folder.sqlite3")
+    yield ledger
+    ledger.close()
+
+
+def _hot_folder(folder, ledger, submit, **options) -> HotFolder:
+    hot = HotFolder(folder, ledger, submit, settle_seconds=SETTLE, use_inotify=False, clock=lambda: 0.0, **options)
+    hot.start()
+    assert hot.watcher == "polling"
+    return hot
+
+
+def _poll(hot: HotFolder, now: float):
+    """ポーリングでの run の 1 回分（走査 → 書き終わりの判定 → submit）"""
+    hot.scan(now)
+    hot._settled(now)
+    hot._dispatch()
+
+
+def _statuses(ledger: FileLedger, folder) -> dict[str, str]:
+    rows = ledger._conn.execute("SELECT path, status FROM files").fetchall()
+    return {os.path.basename(path): status for path, status in rows if path.startswith(str(folder))}
+
+
+def test_file_being_written_is_not_submitted_until_settled(folder, ledger):
+    submit = FakeSubmit()
+    hot = _hot_folder(folder, ledger, submit, process_existing=True)
+    story = folder / "story.jpg"
+    story.write_bytes(b"a" * 1000)
+    _poll(hot, 1.0)
+    # 書き込みが続いている間は settle 秒たっても投稿しない
+    with story.open("ab") as fp:
+        fp.write(b"b" * 1000)
+    _poll(hot, 2.5)
+    _poll(hot, 4.0)
+    assert submit.paths == []
+    assert hot.stats()["writing"] == 1
+
+    _poll(hot, 4.5)
+    assert submit.paths == ["story.jpg"]
+    assert _statuses(ledger, folder) == {"story.jpg": QUEUED}
+
+
+def test_renamed_copy_is_skipped_by_digest(folder, ledger):
+    submit = FakeSubmit()
+    hot = _hot_folder(folder, ledger, submit, process_existing=True)
+    (folder / "story.jpg").write_bytes(b"same content")
+    _poll(hot, 1.0)
+    _poll(hot, 3.0)
+    assert submit.paths == ["story.jpg"]
+    hot.finished(1, DONE)
+
+    (folder / "story.jpg").rename(folder / "story (1).jpg")
+    _poll(hot, 4.0)
+    _poll(hot, 6.0)
+    assert submit.paths == ["story.jpg"]
+    assert hot.duplicates == 1
+    assert _statuses(ledger, folder) == {"story.jpg": DONE, "story (1).jpg": DUPLICATE}
+
+    # サイドカーが違えば別の投稿として扱う
+    (folder / "other.jpg").write_bytes(b"same content")
+    (folder / "other.jpg.json").write_text('{"links": [{"url": "https://example.com"}]}', encoding="utf-8")
+    _poll(hot, 7.0)
+    _poll(hot, 9.0)
+    assert submit.paths == ["story.jpg", "other.jpg"]
+
+
+def test_existing_files_are_skipped_on_first_run(folder, ledger):
+    (folder / "old.jpg").write_bytes(b"old")
+    submit = FakeSubmit()
+    hot = _hot_folder(folder, ledger, submit)
+    assert _statuses(ledger, folder) == {"old.jpg": SKIPPED}
+    _poll(hot, 1.0)
+    _poll(hot, 3.0)
+    assert submit.paths == []
+
+    # 初回でなければ、新しく置かれたものだけを投稿する
+    (folder / "new.jpg").write_bytes(b"new")
+    hot = _hot_folder(folder, ledger, submit)
+    _poll(hot, 1.0)
+    _poll(hot, 3.0)
+    assert submit.paths == ["new.jpg"]
+
+
+def test_existing_files_are_submitted_with_process_existing(folder, ledger):
+    (folder / "old.jpg").write_bytes(b"old")
+    (folder / "notes.txt").write_text("not media", encoding="utf-8")
+    submit = FakeSubmit()
+    hot = _hot_folder(folder, ledger, submit, process_existing=True)
+    assert _statuses(ledger, folder) == {}
+    _poll(hot, 1.0)
+    _poll(hot, 3.0)
+    assert submit.paths == ["old.jpg"]
@@ -0,0 +1,166 @@
+import time
+
+import pytest
+
+import ig_client
+from pacing import AdaptiveTokenBucket, PaceLimits, RequestPacer
+
+
+class FakeClock:
+    """sleep() で進む時計（実際には待たない）"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+LIMITS = PaceLimits(rate=1.0, min_rate=0.1, max_rate=2.0, burst=1)
+
+
+def _bucket(clock: FakeClock) -> AdaptiveTokenBucket:
+    return AdaptiveTokenBucket(LIMITS, increase=0.5, backoff_base=5.0, backoff_max=40.0,
+                               clock=clock, sleep=clock.sleep)
+
+
+def test_throttle_halves_rate_and_backs_off_exponentially():
+    clock = FakeClock()
+    bucket = _bucket(clock)
+    assert bucket.acquire() == 0.0
+
+    bucket.on_throttle()
+    assert bucket.rate == 0.5
+    # バックオフの 5 秒が明けるまで送らない
+    assert bucket.acquire() == pytest.approx(5.0)
+
+    # 連続したスロットリングでは待ちが倍になり、レートは下限で止まる
+    for expected in (10.0, 20.0, 40.0, 40.0):
+        bucket.on_throttle()
+        started = clock.now
+        bucket.acquire()
+        assert clock.now - started == pytest.approx(expected)
+    assert bucket.rate == LIMITS.min_rate
+    assert bucket.consecutive_throttles == 5
+
+
+def test_retry_after_extends_backoff():
+    clock = FakeClock()
+    bucket = _bucket(clock)
+    bucket.acquire()
+    bucket.on_throttle(retry_after=30.0)
+    assert bucket.acquire() == pytest.approx(30.0)
+
+
+def test_fast_responses_recover_rate_additively():
+    clock = FakeClock()
+    bucket = _bucket(clock)
+    bucket.on_throttle()
+    bucket.on_throttle()
+    assert bucket.rate == 0.25
+    clock.sleep(10.0)
+
+    bucket.on_success(0.2)
+    assert bucket.consecutive_throttles == 0
+    assert bucket.rate == pytest.approx(0.75)
+    # 次のスロットリングのバックオフは最初の長さに戻る
+    bucket.on_throttle()
+    clock.sleep(4.9)
+    assert bucket.backoff_until - clock.now == pytest.approx(0.1)
+
+    for _ in range(10):
+        bucket.on_success(0.2)
+    assert bucket.rate == LIMITS.max_rate
+    # 遅い応答では下げ、その間の応答では変えない
+    bucket.on_success(5.0)
+    assert bucket.rate == pytest.approx(1.6)
+    bucket.on_success(1.5)
+    assert bucket.rate == pytest.approx(1.6)
+
+
+def test_acquire_waits_for_refill_at_current_rate():
+    clock = FakeClock()
+    bucket = _bucket(clock)
+    bucket.acquire()
+    assert bucket.acquire() == pytest.approx(1.0)
+    bucket.on_throttle()
+    clock.sleep(5.0)
+    bucket.acquire()
+    # レートが 0.5 になったので 1 トークンに 2 秒かかる
+    assert bucket.acquire() == pytest.approx(2.0)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """実際の time.sleep を呼ばずに秒数を記録する"""
+    recorded: list[float] = []
+    monkeypatch.setattr(time, "sleep", recorded.append)
+    return recorded
+
+
+@pytest.fixture
+def private_calls(monkeypatch):
+    """instagrapi 本来の _send_private_request の代わり（本物と同じく request_timeout だけ待つ）"""
+    from instagrapi.mixins import private as ig_private
+
+    calls = []
+
+    def send(self, endpoint, **kwargs):
+        calls.append(endpoint)
+        ig_private.time.sleep(self.request_timeout)
+        self.last_json = {"status": "ok"}
+        return self.last_json
+
+    ig_client.create_client()
+    monkeypatch.setattr(ig_client, "_orig_send_private_request", send)
+    return calls
+
+
+def test_paced_time_skips_sleep_only_while_sending(sleeps):
+    from instagrapi.mixins import private as ig_private
+    from instagrapi.mixins import public as ig_public
+
+    ig_client.create_client()
+    assert isinstance(ig_private.time, ig_client._PacedTime)
+    assert ig_public.time is ig_private.time
+    # time のほかの関数はそのまま使える
+    assert ig_private.time.monotonic is time.monotonic
+
+    clock = FakeClock()
+    pacer = RequestPacer(clock=clock, sleep=clock.sleep)
+    ig_client._paced(pacer, "read", lambda: ig_private.time.sleep(1))
+    assert sleeps == []
+    ig_private.time.sleep(1)
+    assert sleeps == [1]
+
+
+def test_paced_client_replaces_fixed_delays(sleeps, private_calls):
+    clock = FakeClock()
+    client = ig_client.new_client(RequestPacer(clock=clock, sleep=clock.sleep))
+    client.request_timeout = 1
+    client.private_request("feed/timeline/")
+    client.private_request("feed/timeline/")
+
+    assert private_calls == ["feed/timeline/", "feed/timeline/"]
+    assert sleeps == []
+    # 待ちも応答時間もバケットに通っている
+    bucket = client.pacer.bucket("read")
+    assert bucket.requests == 2
+    assert bucket.latency_ewma is not None
+
+
+def test_client_without_pacer_keeps_delay_range(sleeps, private_calls):
+    client = ig_client.new_client()
+    client.pacer = None
+    client.delay_range = [2, 3]
+    client.request_timeout = 1
+    client.private_request("feed/timeline/")
+
+    assert private_calls == ["feed/timeline/"]
+    # delay_range の待ちと、送信前の request_timeout の待ちがどちらも残る
+    assert len(sleeps) == 2
+    assert 2 <= sleeps[0] <= 3
+    assert sleeps[1] == 1
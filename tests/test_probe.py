@@ -0,0 +1,37 @@
+from pathlib import Path
+
+from probe import PASSTHROUGH, TRANSCODE, VideoProbe, parse_ffmpeg_info, plan_video
+
+# スマホ・編集ソフトの書き出しに多い、画素形式に色の情報が付いた ffmpeg -i の出力
+PHONE_INFO = """\
+Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'story.mp4':
+  Duration: 00:00:12.34, start: 0.000000, bitrate: 8012 kb/s
+  Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p(tv, bt709, progressive), 1080x1920 [SAR 1:1 DAR 9:16], 7800 kb/s, 30 fps, 30 tbr, 15360 tbn (default)
+  Stream #0:1[0x2](und): Audio: aac (LC) (mp4a / 0x6134706D), 44100 Hz, stereo, fltp, 128 kb/s (default)
+"""
+
+
+def _probe(**fields) -> VideoProbe:
+    return VideoProbe(path=Path("story.mp4"), size_bytes=12_000_000, container="isom", faststart=True, **fields)
+
+
+def test_parse_colour_tagged_pix_fmt():
+    probe = parse_ffmpeg_info(PHONE_INFO, _probe())
+    assert (probe.video_codec, probe.pix_fmt, probe.width, probe.height) == ("h264", "yuv420p", 1080, 1920)
+    assert probe.fps == 30.0
+    assert probe.audio_codec == "aac"
+    assert probe.duration == 12.34
+
+
+def test_colour_tagged_story_passes_through():
+    probe = parse_ffmpeg_info(PHONE_INFO, _probe())
+    probe.bitrate = int(probe.size_bytes * 8 / probe.duration)
+    assert plan_video(probe).decision == PASSTHROUGH
+
+
+def test_unparsed_resolution_is_unknown():
+    probe = parse_ffmpeg_info("  Duration: 00:00:05.00, start: 0.000000\n", _probe())
+    plan = plan_video(probe)
+    assert plan.decision == TRANSCODE
+    assert "解像度 不明" in plan.reasons
+    assert "映像コーデック 不明" in plan.reasons
@@ -0,0 +1,77 @@
+import os
+
+import requests
+
+from benchmarks.mock_rupload import RuploadState, start_server
+from resumable_upload import Checkpoint, ResumableUploader
+
+CHUNK = 256 * 1024
+
+
+class RecordingCheckpoint(Checkpoint):
+    """保存したオフセットを順に残す（成功時に clear されても確かめられるように）"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.saved: list[int] = []
+
+    def save(self, **updates):
+        super().save(**updates)
+        if "offset" in updates:
+            self.saved.append(updates["offset"])
+
+
+def _upload_with_drop(tmp_path, on_event=None):
+    """4 チャンクと端数のファイルを、3 チャンク目（2 * CHUNK から）の途中で 1 回切断するサーバーへ送る"""
+    data = os.urandom(4 * CHUNK + 12345)
+    path = tmp_path / "story.mp4"
+    path.write_bytes(data)
+    state = RuploadState(drops=1, drop_from=2 * CHUNK, drop_after=100 * 1024)
+    server = start_server(state)
+    events = []
+
+    def on_progress(event):
+        events.append(event)
+        if on_event is not None:
+            on_event(state, event)
+
+    try:
+        checkpoint = RecordingCheckpoint(tmp_path / "checkpoints", path, scope="test")
+        uploader = ResumableUploader(
+            requests.Session(), f"{server.base_url}/rupload_igvideo/story", path, chunk_size=CHUNK,
+            on_progress=on_progress, checkpoint=checkpoint, progress_interval=0.0, sleep=lambda s: None,
+        )
+        uploader.upload()
+    finally:
+        server.shutdown()
+    return data, state, checkpoint, uploader, events
+
+
+def _assert_resumed(data, state, checkpoint, uploader, events):
+    assert uploader.retries == 1
+    # 切断前に確認できたのは 2 チャンク分で、2 回目の最初の POST はそのオフセットから送っている
+    assert checkpoint.saved[:3] == [0, CHUNK, 2 * CHUNK]
+    assert state.posts[:4] == [(0, CHUNK), (CHUNK, CHUNK), (2 * CHUNK, CHUNK), (2 * CHUNK, CHUNK)]
+    assert any(e.attempt == 2 for e in events)
+    assert all(length <= CHUNK for _, length in state.posts)
+    # サーバーに残った内容はファイルと同じで、進捗は戻らない
+    assert bytes(state.received["story"]) == data
+    sent = [e.sent for e in events]
+    assert sent == sorted(sent)
+    assert events[-1].done and events[-1].sent == len(data)
+    assert not checkpoint.path.exists()
+
+
+def test_resumes_from_checkpoint_after_mid_body_drop(tmp_path):
+    _assert_resumed(*_upload_with_drop(tmp_path))
+
+
+def test_resumes_from_checkpoint_when_offset_query_fails(tmp_path):
+    def fail_next_query(state, event):
+        # 1 回目の問い合わせは済んでいるので、切断後の問い合わせだけが 503 になる
+        if event.attempt == 1:
+            state.get_errors = 1
+
+    data, state, checkpoint, uploader, events = _upload_with_drop(tmp_path, fail_next_query)
+    assert state.requests["GET"] == 2
+    _assert_resumed(data, state, checkpoint, uploader, events)
@@ -0,0 +1,115 @@
+import logging
+import queue
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+STARTED = "started"
+PROGRESS = "progress"
+FINISHED = "finished"
+ERROR = "error"
+CALL = "call"
+
+
+@dataclass
+class UIEvent:
+    """ワーカーから UI へ送るイベント
+
+    stage は処理の種類（"login" / "prepare" / "upload" / "queue" 等）。key が同じイベントが 1 回の取り出しに
+    複数あれば最後の 1 件だけを届ける（進捗やプレビューのフレームなど、最新だけ分かればよいもの）。
+    notify を入れると UI 側でダイアログも出す。
+    """
+
+    kind: str
+    stage: str = ""
+    message: str = ""
+    fraction: float | None = None
+    key: object = None
+    notify: str | None = None
+    callback: object = None
+
+
+class EventBus:
+    """ワーカースレッドからの UI 更新を受け付け、メインスレッドで interval_ms ごとにまとめて処理する
+
+    post はどのスレッドからでも呼べる。Tk の after を受け取るだけなので tkinter には依存しない。
+    ハンドラーは kind ごとに subscribe し、CALL イベントは callback をメインスレッドで実行する。
+    """
+
+    def __init__(self, after, interval_ms: int = 50, max_batch: int = 500):
+        self.after = after
+        self.interval_ms = interval_ms
+        self.max_batch = max_batch
+        self.received = 0
+        self.delivered = 0
+        self._queue: queue.SimpleQueue[UIEvent] = queue.SimpleQueue()
+        self._handlers: dict[str, list] = {}
+        self._running = False
+
+    def subscribe(self, kind: str, handler):
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def post(self, event: UIEvent):
+        self._queue.put(event)
+
+    def started(self, stage: str, message: str, key=None):
+        self.post(UIEvent(STARTED, stage, message, key=key))
+
+    def progress(self, stage: str, message: str, fraction: float | None = None, key=None):
+        self.post(UIEvent(PROGRESS, stage, message, fraction, key=key if key is not None else (PROGRESS, stage)))
+
+    def finished(self, stage: str, message: str, notify: str | None = None):
+        self.post(UIEvent(FINISHED, stage, message, notify=notify))
+
+    def error(self, stage: str, message: str, notify: str | None = None):
+        self.post(UIEvent(ERROR, stage, message, notify=notify))
+
+    def call(self, callback, key=None):
+        """callback() をメインスレッドで実行する（root.after(0, ...) の代わり）"""
+        self.post(UIEvent(CALL, key=key, callback=callback))
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self.after(self.interval_ms, self._tick)
+
+    def stop(self):
+        self._running = False
+
+    def _tick(self):
+        if not self._running:
+            return
+        try:
+            self.drain()
+        finally:
+            self.after(self.interval_ms, self._tick)
+
+    def drain(self) -> int:
+        """溜まっているイベントを最大 max_batch 件取り出して処理し、処理した件数を返す"""
+        batch = []
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        # 同じ key のものは最後の 1 件だけ（位置も最後のもの）を残す
+        last = {event.key: index for index, event in enumerate(batch) if event.key is not None}
+        events = [event for index, event in enumerate(batch) if event.key is None or last[event.key] == index]
+        for event in events:
+            self._dispatch(event)
+        self.received += len(batch)
+        self.delivered += len(events)
+        return len(events)
+
+    def _dispatch(self, event: UIEvent):
+        try:
+            if event.kind == CALL:
+                event.callback()
+                return
+            for handler in self._handlers.get(event.kind, ()):
+                handler(event)
+        except Exception:
+            logger.exception(f"UI event handler failed: {event.kind} {event.stage}")
+
+    def stats(self) -> dict:
+        return {"received": self.received, "delivered": self.delivered, "coalesced": self.received - self.delivered}
@@ -0,0 +1,328 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import perf_log
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+PREPARING = "preparing"
+PREPARED = "prepared"
+UPLOADING = "uploading"
+DONE = "done"
+FAILED = "failed"
+
+# 投稿順を決める（まだ投稿されていない）状態
+PENDING = (QUEUED, PREPARING, PREPARED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    prepared TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+
+@dataclass
+class Job:
+    id: int
+    status: str
+    spec: dict
+    prepared: dict | None = None
+    error: str | None = None
+    attempts: int = 0
+    created_at: float = 0.0
+    updated_at: float = 0.0
+
+
+def _discard(prepared: dict | None):
+    """prepare が返した temp_paths の一時ファイルを消す"""
+    for path in (prepared or {}).get("temp_paths", []):
+        try:
+            Path(path).unlink(missing_ok=True)
+        except Exception:
+            pass
+
+
+def _prepared_exists(prepared: dict | None) -> bool:
+    return bool(prepared) and Path(prepared["path"]).exists()
+
+
+class JobStore:
+    """ジョブを SQLite に保存する（再起動しても残る）"""
+
+    def __init__(self, path=Path("queue.sqlite3")):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def _row(self, row) -> Job:
+        id_, status, spec, prepared, error, attempts, created_at, updated_at = row
+        return Job(
+            id_, status, json.loads(spec), json.loads(prepared) if prepared else None,
+            error, attempts, created_at, updated_at,
+        )
+
+    def _select(self, where: str = "", params=(), limit: int | None = None) -> list[Job]:
+        rows = self._conn.execute(
+            "SELECT id, status, spec, prepared, error, attempts, created_at, updated_at FROM jobs "
+            f"{where} ORDER BY id" + (f" LIMIT {int(limit)}" if limit else ""), params,
+        ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def _update(self, job_id: int, **fields):
+        if "prepared" in fields:
+            fields["prepared"] = json.dumps(fields["prepared"], ensure_ascii=False) if fields["prepared"] else None
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self._conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def add(self, spec: dict) -> int:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (status, spec, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (QUEUED, json.dumps(spec, ensure_ascii=False), now, now),
+            )
+            return int(cursor.lastrowid or 0)
+
+    def get(self, job_id: int) -> Job | None:
+        with self._lock:
+            jobs = self._select("WHERE id = ?", (job_id,))
+        return jobs[0] if jobs else None
+
+    def jobs(self) -> list[Job]:
+        with self._lock:
+            return self._select()
+
+    def update(self, job_id: int, **fields):
+        with self._lock:
+            self._update(job_id, **fields)
+
+    def claim_prepare(self, max_ahead: int) -> Job | None:
+        """最も古い待機中のジョブを準備中にする（準備済みで投稿待ちが max_ahead 件あれば None）"""
+        with self._lock:
+            ahead = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (PREPARING, PREPARED)
+            ).fetchone()[0]
+            if ahead >= max_ahead:
+                return None
+            jobs = self._select("WHERE status = ?", (QUEUED,), limit=1)
+            if not jobs:
+                return None
+            job = jobs[0]
+            self._update(job.id, status=PREPARING, attempts=job.attempts + 1)
+            job.status = PREPARING
+            return job
+
+    def claim_upload(self) -> Job | None:
+        """投稿順で先頭のジョブが準備済みならアップロード中にする（先頭が準備中なら待つので None）"""
+        with self._lock:
+            jobs = self._select(f"WHERE status IN ({', '.join('?' * len(PENDING))})", PENDING, limit=1)
+            if not jobs or jobs[0].status != PREPARED:
+                return None
+            job = jobs[0]
+            self._update(job.id, status=UPLOADING)
+            job.status = UPLOADING
+            return job
+
+    def recover(self):
+        """前回の終了時に処理途中だったジョブを戻す
+
+        準備中は待機に戻す。アップロード中だったものは投稿済みかどうか分からないので、
+        重複投稿を避けるため自動では再送せず失敗扱いにする。
+        """
+        with self._lock:
+            for job in self._select("WHERE status IN (?, ?, ?)", (PREPARING, PREPARED, UPLOADING)):
+                if job.status == UPLOADING:
+                    self._update(job.id, status=FAILED, error="アップロード中に終了しました（投稿済みか確認してから再試行してください）")
+                elif job.status == PREPARING or not _prepared_exists(job.prepared):
+                    _discard(job.prepared)
+                    self._update(job.id, status=QUEUED, prepared=None)
+
+    def retry(self, job_id: int) -> bool:
+        """失敗したジョブをやり直す（準備済みの素材が残っていれば再利用）"""
+        with self._lock:
+            jobs = self._select("WHERE id = ? AND status = ?", (job_id, FAILED))
+            if not jobs:
+                return False
+            job = jobs[0]
+            if _prepared_exists(job.prepared):
+                self._update(job.id, status=PREPARED, error=None)
+            else:
+                _discard(job.prepared)
+                self._update(job.id, status=QUEUED, prepared=None, error=None)
+            return True
+
+    def remove(self, job_id: int) -> bool:
+        """処理中でないジョブを削除する"""
+        with self._lock:
+            jobs = self._select("WHERE id = ? AND status NOT IN (?, ?)", (job_id, PREPARING, UPLOADING))
+            if not jobs:
+                return False
+            _discard(jobs[0].prepared)
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            return True
+
+    def clear_done(self) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM jobs WHERE status = ?", (DONE,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class UploadQueue:
+    """前処理とアップロードを別々のスレッドで流すジョブキュー
+
+    prepare(spec) -> dict は合成・エンコード等を行い、{"path", "temp_paths", ...} を返す（JSON に保存される）。
+    upload(spec, prepared) -> dict はアカウントのキーごとのエラーを返す（空なら成功）。
+    前処理は prepare_workers 並列で先行し、アップロードは 1 本のスレッドで投稿順に行うので、
+    複数件を積んだときの所要時間は全段の合計ではなく最も遅い段にほぼ揃う。
+    """
+
+    def __init__(self, store: JobStore, prepare, upload, *, prepare_workers: int = 2,
+                 max_ahead: int | None = None, on_change=None, perf=None):
+        self.store = store
+        self.prepare = prepare
+        self.upload = upload
+        self.prepare_workers = max(1, prepare_workers)
+        # 準備済みで投稿待ちにしておく上限（一時ファイルが溜まりすぎないように）
+        self.max_ahead = max_ahead or self.prepare_workers * 2
+        # on_change(job) はワーカースレッドから呼ばれる
+        self.on_change = on_change
+        # perf（PerfLog）があればジョブごとに前処理・投稿の各段を計測する
+        self.perf = perf
+        self._wake = threading.Condition()
+        self._stopping = False
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        self.store.recover()
+        for index in range(self.prepare_workers):
+            self._spawn(self._prepare_loop, f"queue-prepare-{index}")
+        self._spawn(self._upload_loop, "queue-upload")
+
+    def _spawn(self, target, name: str):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, timeout: float | None = None):
+        with self._wake:
+            self._stopping = True
+            self._wake.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def submit(self, spec: dict) -> int:
+        job_id = self.store.add(spec)
+        self._changed(job_id)
+        return job_id
+
+    def retry(self, job_id: int) -> bool:
+        ok = self.store.retry(job_id)
+        if ok:
+            self._changed(job_id)
+        return ok
+
+    def remove(self, job_id: int) -> bool:
+        ok = self.store.remove(job_id)
+        if ok:
+            self._changed(None)
+        return ok
+
+    def wait_idle(self, timeout: float | None = None) -> bool:
+        """未処理のジョブが無くなるまで待つ"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._wake:
+            while any(job.status in (*PENDING, UPLOADING) for job in self.store.jobs()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._wake.wait(remaining if remaining is not None else 1.0)
+        return True
+
+    def _changed(self, job_id: int | None):
+        with self._wake:
+            self._wake.notify_all()
+        if self.on_change:
+            try:
+                self.on_change(self.store.get(job_id) if job_id is not None else None)
+            except Exception as e:
+                logger.info(f"queue on_change failed: {e}")
+
+    def _wait_for(self, claim):
+        with self._wake:
+            while not self._stopping:
+                job = claim()
+                if job is not None:
+                    return job
+                self._wake.wait()
+        return None
+
+    def _run(self, job: Job):
+        if self.perf is None:
+            return None
+        return self.perf.run(job.id, Path(str(job.spec.get("file_path", ""))).name)
+
+    def _finish_run(self, job: Job, status: str):
+        if self.perf is not None:
+            self.perf.finish(job.id, status)
+
+    def _prepare_loop(self):
+        while (job := self._wait_for(lambda: self.store.claim_prepare(self.max_ahead))) is not None:
+            self._changed(job.id)
+            started = time.perf_counter()
+            try:
+                with perf_log.activate(self._run(job)), perf_log.stage("prepare"):
+                    prepared = self.prepare(job.spec)
+            except Exception as e:
+                logger.info(f"job {job.id}: prepare failed: {e}")
+                self.store.update(job.id, status=FAILED, error=str(e))
+                self._finish_run(job, FAILED)
+            else:
+                logger.info(f"job {job.id}: prepared in {time.perf_counter() - started:.2f}s")
+                self.store.update(job.id, status=PREPARED, prepared=prepared)
+            self._changed(job.id)
+
+    def _upload_loop(self):
+        while (job := self._wait_for(self.store.claim_upload)) is not None:
+            self._changed(job.id)
+            started = time.perf_counter()
+            try:
+                with perf_log.activate(self._run(job)), perf_log.stage("upload"):
+                    errors = self.upload(job.spec, job.prepared)
+            except Exception as e:
+                errors = {"": str(e)}
+            self._finish_run(job, FAILED if errors else DONE)
+            if errors:
+                logger.info(f"job {job.id}: upload failed: {errors}")
+                # 成功したアカウントは投稿先から外し、再試行では失敗分だけ送る
+                spec = dict(job.spec)
+                if "" not in errors and spec.get("accounts"):
+                    spec["accounts"] = [key for key in spec["accounts"] if key in errors]
+                self.store.update(
+                    job.id, status=FAILED, spec=json.dumps(spec, ensure_ascii=False),
+                    error="\n".join(f"{key}: {error}" if key else error for key, error in errors.items()),
+                )
+            else:
+                logger.info(f"job {job.id}: uploaded in {time.perf_counter() - started:.2f}s")
+                _discard(job.prepared)
+                self.store.update(job.id, status=DONE, prepared=None, error=None)
+            self._changed(job.id)